@@ -1,3 +1,8 @@
+"""
+Convert RAW files to a ROOT tree of the channels of the pulses. Needs
+PyROOT. muonic.analysis.export writes all pulses and events to HDF5 or
+NumPy files instead.
+"""
 import sys
 import gzip
 import bz2
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Measure the time to import muonic packages in fresh interpreters, as short
+lived batch jobs do, and check it against a budget. Importing a package
+must not load plotting, GUI or hardware modules, those are reported as
+violations as well.
+
+Exits with status 1 if a budget is exceeded or a forbidden module is
+loaded.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+
+# import time budget in seconds of each package
+BUDGETS = {
+    "muonic.analysis": 0.15,
+    "muonic.daq": 0.05,
+    "muonic.util": 0.05
+}
+
+# modules which must not be loaded by importing a package
+FORBIDDEN = ["matplotlib", "PyQt4", "scipy", "serial", "zmq"]
+
+# code run in the fresh interpreter
+MEASURE = """
+import sys
+from timeit import default_timer
+start = default_timer()
+import %s
+print(default_timer() - start)
+print(",".join([name for name in %r if name in sys.modules]))
+"""
+
+
+def measure(module, repeat):
+    """
+    Import a module in fresh interpreters.
+
+    :param module: name of the module
+    :type module: str
+    :param repeat: number of interpreters
+    :type repeat: int
+    :returns: tuple of float and list -- best import time and the
+              forbidden modules loaded
+    """
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        os.pardir))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + [p for p in [env.get("PYTHONPATH")] if p])
+
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", MEASURE % (module, FORBIDDEN)], env=env)
+        lines = output.decode("ascii").splitlines()
+        times.append(float(lines[0]))
+        loaded = [name for name in lines[1].split(",") if name]
+    return min(times), loaded
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Measure and check the import " +
+                                        "time of muonic packages")
+    parser.add_argument("modules", nargs="*", default=sorted(BUDGETS),
+                        help="packages to import (default: %s)" %
+                             ", ".join(sorted(BUDGETS)))
+    parser.add_argument("-n", "--repeat", dest="repeat", type=int, default=5,
+                        help="number of fresh interpreters per package")
+    parser.add_argument("-b", "--budget", dest="budget", type=float,
+                        default=None, help="budget in seconds for all " +
+                                           "packages")
+    args = parser.parse_args()
+
+    failed = False
+    for name in args.modules:
+        budget = args.budget or BUDGETS.get(name, 0.1)
+        elapsed, forbidden = measure(name, args.repeat)
+        ok = elapsed <= budget and not forbidden
+        failed = failed or not ok
+
+        print("%-20s %6.1f ms (budget %6.1f ms) %s%s" %
+              (name, 1000 * elapsed, 1000 * budget,
+               "ok" if ok else "FAILED",
+               "" if not forbidden else ", loads " + ", ".join(forbidden)))
+
+    sys.exit(1 if failed else 0)
@@ -1,5 +1,24 @@
 """
 scripts and classes used for data analysis
+
+Only the analyzer and the fit routines are imported with the package,
+which keep plotting and SciPy out of headless use. The other classes are
+imported from their submodules when they are first used.
 """
+from muonic.util.helpers import lazy_attributes
+
 from .analyzer import *
-from .fit import fit, gaussian_fit
+from .fit import fit, gaussian_fit, fit_histogram, FitResult
+from .fit import CHI_SQUARE, POISSON
+
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "Histogram": ".histogram",
+    "OnlineLifetimeEstimator": ".lifetime",
+    "bootstrap_fit": ".bootstrap",
+    "BootstrapResult": ".bootstrap",
+    "DECAY": ".bootstrap",
+    "VELOCITY": ".bootstrap",
+    "find_muons": ".coincidence",
+    "export_events": ".export",
+    "load_events": ".export"
+})
@@ -45,13 +45,16 @@ class PulseExtractor:
 
     :param logger: logger object
     :type logger: logging.Logger
-    :param filename: filename of the pulse file
-    :type filename: str
+    :param filename: filename of the pulse file, no pulses are written
+                     if this is None
+    :type filename: str or None
     """
 
     def __init__(self, logger, filename):
         self.logger = logger
-        self.pulse_file = WrappedFile(filename)
+        self.pulse_file = None
+        if filename is not None:
+            self.pulse_file = WrappedFile(filename)
         self._write_pulses = False
 
         # start time and duration
@@ -125,6 +128,9 @@ class PulseExtractor:
             self.measurement_duration += stop_time - self.start_time
             self.pulse_file.close()
 
+        if self.pulse_file is None:
+            return
+
         # only rename if file actually exists
         if os.path.exists(self.pulse_file.get_filename()):
             try:
@@ -137,6 +143,18 @@ class PulseExtractor:
             except (OSError, IOError):
                 pass
 
+    def store_pulses(self, pulses):
+        """
+        Write extracted pulses to the pulse file if writing pulses
+        is enabled.
+
+        :param pulses: extracted pulses
+        :type pulses: tuple
+        :returns: None
+        """
+        if self._write_pulses and pulses is not None:
+            self.pulse_file.write(repr(pulses) + '\n')
+
     def _calculate_edges(self, line, counter_diff=0):
         """
         get the leading and falling edges of the pulses
@@ -302,8 +320,7 @@ class PulseExtractor:
             extracted_pulses = (self.last_trigger_time, pulses["ch0"],
                                 pulses["ch1"], pulses["ch2"], pulses["ch3"])
 
-            if self._write_pulses:
-                self.pulse_file.write(repr(extracted_pulses) + '\n')
+            self.store_pulses(extracted_pulses)
 
             # as the pulses for the last event are done,
             # reinitialize data structures
@@ -336,6 +353,31 @@ class PulseExtractor:
         # end of if trigger flag
         self.last_trigger_count = trigger_count
 
+    def flush(self):
+        """
+        Get the pulses of the last event, which are otherwise only returned
+        with the next trigger, e.g. at the end of a file. Afterwards the
+        extraction starts over as before the first trigger.
+
+        Returns None if there was no trigger yet.
+
+        :returns: tuple or None
+        """
+        if self.ini:
+            return None
+        self.ini = True
+
+        self.last_re = self.re
+        self.last_fe = self.fe
+        pulses = self._order_and_clean_pulses()
+        extracted_pulses = (self.last_trigger_time, pulses["ch0"],
+                            pulses["ch1"], pulses["ch2"], pulses["ch3"])
+        self.store_pulses(extracted_pulses)
+
+        self.re = {"ch0": [], "ch1": [], "ch2": [], "ch3": []}
+        self.fe = {"ch0": [], "ch1": [], "ch2": [], "ch3": []}
+        return extracted_pulses
+
 
 class VelocityTrigger:
     """
@@ -0,0 +1,440 @@
+"""
+Provides the barometric correction of rates recorded in R files.
+
+R files are read in chunks of bytes into a structured array with one row
+per rate measurement. The barometric coefficient, and optionally a
+temperature coefficient, is fitted by weighted linear regression of the
+logarithm of the rate, with weights from the number of counts in each
+interval. Corrected rates are written in the R file format.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import logging
+import time
+import warnings
+
+import numpy as np
+
+from muonic.daq.decoder import find_lines
+from muonic.util import iter_line_chunks
+
+# bytes read from a file at once
+CHUNK_SIZE = 1 << 22
+
+# length of the date and time at the start of each line,
+# e.g. '2017-03-01 12:00:00.000'
+TIMESTAMP_LENGTH = 23
+
+# names of the rate columns
+RATE_NAMES = ["R0", "R1", "R2", "R3", "R trigger"]
+
+# number of values after the timestamp, rates and counts of the channels
+# and the trigger, interval length, pressure and temperature
+VALUE_COLUMNS = 13
+
+# a rate measurement
+RATE_DTYPE = np.dtype([("time", "datetime64[ms]"),
+                       ("rates", np.float64, (5,)),
+                       ("counts", np.float64, (5,)),
+                       ("delta_time", np.float64),
+                       ("pressure", np.float64),
+                       ("temperature", np.float64)])
+
+# header of R files
+HEADER = ("year month day hour minutes second milliseconds" +
+          " | R0 | R1 | R2 | R3 | R trigger | " +
+          " chan0 | chan1 | chan2 | chan3 | trigger | Delta_time |" +
+          " Pressure [mBar] |Temperature [C] |\n")
+
+
+def _to_rows(times, values):
+    """
+    Fill timestamps and values into rate measurements.
+
+    :param times: timestamps
+    :type times: numpy.ndarray of datetime64
+    :param values: values after the timestamp, one row per line
+    :type values: numpy.ndarray
+    :returns: numpy.ndarray of RATE_DTYPE
+    """
+    rows = np.zeros(len(times), dtype=RATE_DTYPE)
+    rows["time"] = times
+    rows["rates"] = values[:, 0:5]
+    rows["counts"] = values[:, 5:10]
+    rows["delta_time"] = values[:, 10]
+    rows["pressure"] = values[:, 11]
+    rows["temperature"] = values[:, 12]
+    return rows
+
+
+def _parse_chunk(data, logger):
+    """
+    Get the rate measurements of complete lines in a buffer. Comments and
+    the header are skipped.
+
+    :param data: buffer with complete lines
+    :type data: numpy.ndarray of uint8
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: numpy.ndarray of RATE_DTYPE
+    """
+    starts, ends = find_lines(data)
+
+    # measurements start with the year
+    first = data[starts]
+    valid = ((first >= ord("0")) & (first <= ord("9")) &
+             (ends - starts > TIMESTAMP_LENGTH))
+    starts, ends = starts[valid], ends[valid]
+
+    if not len(starts):
+        return np.zeros(0, dtype=RATE_DTYPE)
+
+    stamps = data[starts[:, None] + np.arange(TIMESTAMP_LENGTH)[None, :]]
+    stamps[:, 10] = ord("T")
+
+    # blank everything but the values of the measurements
+    inside = np.zeros(len(data) + 1, dtype=np.int8)
+    inside[starts + TIMESTAMP_LENGTH] += 1
+    inside[ends] -= 1
+    text = np.where(np.cumsum(inside[:-1]) > 0, data, ord(" "))
+
+    try:
+        times = stamps.view("S%d" % TIMESTAMP_LENGTH).ravel().astype(
+            "datetime64[ms]")
+    except ValueError:
+        times = None
+
+    with warnings.catch_warnings():
+        # an incomplete parse is detected by the number of values
+        warnings.simplefilter("ignore", DeprecationWarning)
+        values = np.fromstring(text.astype(np.uint8).tobytes(), sep=" ")
+
+    if times is not None and len(values) == len(starts) * VALUE_COLUMNS:
+        return _to_rows(times, values.reshape(-1, VALUE_COLUMNS))
+
+    # fall back to parsing the lines one by one
+    rows = []
+    for start, end in zip(starts, ends):
+        line = data[start:end].tobytes().decode("ascii", "replace")
+        fields = line.split()
+        try:
+            stamp = np.datetime64("T".join(fields[:2]), "ms")
+            line_values = [float(field) for field in fields[2:]]
+        except ValueError:
+            logger.debug("Skipping invalid rate line %s" % repr(line))
+            continue
+        # old files have no pressure and temperature columns
+        line_values += [np.nan] * (VALUE_COLUMNS - len(line_values))
+        rows.append(_to_rows(np.array([stamp]),
+                             np.array([line_values[:VALUE_COLUMNS]])))
+
+    skipped = len(starts) - len(rows)
+    if skipped:
+        logger.warning("Skipped %d invalid rate lines" % skipped)
+    if not rows:
+        return np.zeros(0, dtype=RATE_DTYPE)
+    return np.concatenate(rows)
+
+
+def iter_rates(filenames, chunk_size=CHUNK_SIZE, logger=None):
+    """
+    Read the rate measurements from R files chunk by chunk. Files may be
+    compressed with gzip or bzip2.
+
+    :param filenames: path or paths of the files
+    :type filenames: str or list of str
+    :param chunk_size: bytes read at once
+    :type chunk_size: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: generator of numpy.ndarray of RATE_DTYPE
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    if isinstance(filenames, str):
+        filenames = [filenames]
+
+    for filename in filenames:
+        for chunk in iter_line_chunks(filename, chunk_size):
+            yield _parse_chunk(np.frombuffer(chunk, dtype=np.uint8), logger)
+
+
+def load_rates(filenames, chunk_size=CHUNK_SIZE, logger=None):
+    """
+    Load the rate measurements from R files into one array, ordered by
+    time.
+
+    :param filenames: path or paths of the files
+    :type filenames: str or list of str
+    :param chunk_size: bytes read at once
+    :type chunk_size: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: numpy.ndarray of RATE_DTYPE
+    """
+    chunks = list(iter_rates(filenames, chunk_size, logger))
+    if not chunks:
+        return np.zeros(0, dtype=RATE_DTYPE)
+
+    rates = np.concatenate(chunks)
+    return rates[np.argsort(rates["time"], kind="mergesort")]
+
+
+class BarometricFit(object):
+    """
+    Coefficients of the dependency of a rate on pressure and temperature,
+    R = R_ref * exp(beta * (P - P_ref) + alpha * (T - T_ref)).
+
+    :param rate: rate at the reference pressure and temperature
+    :type rate: float
+    :param beta: barometric coefficient in 1/mBar
+    :type beta: float
+    :param alpha: temperature coefficient in 1/C, 0 if not fitted
+    :type alpha: float
+    :param covariance: covariance of log(rate), beta and alpha
+    :type covariance: numpy.ndarray
+    :param pressure: reference pressure in mBar
+    :type pressure: float
+    :param temperature: reference temperature in C
+    :type temperature: float
+    :param column: index of the fitted rate
+    :type column: int
+    :param measurements: number of fitted measurements
+    :type measurements: int
+    """
+
+    def __init__(self, rate, beta, alpha, covariance, pressure, temperature,
+                 column, measurements):
+        self.rate = rate
+        self.beta = beta
+        self.alpha = alpha
+        self.covariance = covariance
+        self.pressure = pressure
+        self.temperature = temperature
+        self.column = column
+        self.measurements = measurements
+
+    @property
+    def beta_error(self):
+        """
+        Standard error of the barometric coefficient.
+
+        :returns: float
+        """
+        return float(np.sqrt(self.covariance[1, 1]))
+
+    @property
+    def alpha_error(self):
+        """
+        Standard error of the temperature coefficient, 0 if not fitted.
+
+        :returns: float
+        """
+        if len(self.covariance) < 3:
+            return 0.
+        return float(np.sqrt(self.covariance[2, 2]))
+
+    def correction_factors(self, pressure, temperature):
+        """
+        Get the factors which correct rates to the reference pressure and
+        temperature.
+
+        :param pressure: pressure in mBar
+        :type pressure: numpy.ndarray
+        :param temperature: temperature in C
+        :type temperature: numpy.ndarray
+        :returns: numpy.ndarray
+        """
+        exponent = self.beta * (np.asarray(pressure) - self.pressure)
+        if self.alpha:
+            exponent = exponent + self.alpha * (np.asarray(temperature) -
+                                                self.temperature)
+        return np.exp(-exponent)
+
+    def __repr__(self):
+        return ("BarometricFit(%s=%.4g at %.1f mBar and %.1f C, " +
+                "beta=%.4g+-%.2g %%/mBar, alpha=%.4g+-%.2g %%/C, " +
+                "measurements=%d)") % (
+                    RATE_NAMES[self.column], self.rate, self.pressure,
+                    self.temperature, 100 * self.beta,
+                    100 * self.beta_error, 100 * self.alpha,
+                    100 * self.alpha_error, self.measurements)
+
+
+def fit_barometric(rates, column=4, temperature=False, logger=None):
+    """
+    Fit the barometric coefficient of a rate by weighted linear regression
+    of its logarithm on pressure and, optionally, temperature. The weight
+    of a measurement is its number of counts, the inverse variance of the
+    logarithm of its rate. Measurements without counts, pressure or
+    temperature are not used.
+
+    Raises ValueError if there are not enough measurements or if pressure
+    or temperature do not vary.
+
+    :param rates: rate measurements
+    :type rates: numpy.ndarray of RATE_DTYPE
+    :param column: index of the rate, 0-3 for the channels, 4 for the
+                   trigger
+    :type column: int
+    :param temperature: fit a temperature coefficient as well
+    :type temperature: bool
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: BarometricFit
+    :raises: ValueError
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    rate = rates["rates"][:, column]
+    counts = rates["counts"][:, column]
+    pressure = rates["pressure"]
+    temp = rates["temperature"]
+
+    used = (counts > 0) & (rate > 0) & np.isfinite(pressure)
+    if temperature:
+        used &= np.isfinite(temp)
+
+    parameters = 3 if temperature else 2
+    if used.sum() <= parameters:
+        raise ValueError("not enough rate measurements with pressure " +
+                         "readings to fit")
+
+    logger.debug("Fitting %d of %d rate measurements" %
+                 (used.sum(), len(rates)))
+
+    weights = counts[used]
+    reference_pressure = np.average(pressure[used], weights=weights)
+
+    reference_temperature = np.nan
+    known = np.isfinite(temp[used])
+    if known.any():
+        reference_temperature = np.average(temp[used][known],
+                                           weights=weights[known])
+
+    columns = [np.ones(used.sum()), pressure[used] - reference_pressure]
+    if temperature:
+        columns.append(temp[used] - reference_temperature)
+    design = np.column_stack(columns)
+
+    # a constant variable only rounds to a small offset from the reference
+    variables = [("pressure", pressure)]
+    if temperature:
+        variables.append(("temperature", temp))
+    for name, values in variables:
+        if not np.ptp(values[used]):
+            raise ValueError("%s does not vary, unable to fit" % name)
+
+    # normal equations of the weighted least squares
+    weighted = design * weights[:, None]
+    information = design.T.dot(weighted)
+    try:
+        # collinear variables leave a nearly singular matrix
+        scaled = design * np.sqrt(weights)[:, None]
+        if np.linalg.matrix_rank(scaled) < parameters:
+            raise np.linalg.LinAlgError("singular matrix")
+        covariance = np.linalg.inv(information)
+    except np.linalg.LinAlgError:
+        raise ValueError("pressure and temperature do not vary " +
+                         "independently, unable to fit")
+    coefficients = covariance.dot(weighted.T.dot(np.log(rate[used])))
+
+    # scale the errors by the goodness of fit
+    residuals = np.log(rate[used]) - design.dot(coefficients)
+    ndf = used.sum() - parameters
+    chisquare = np.sum(weights * residuals ** 2)
+    covariance = covariance * max(chisquare / ndf, 1.)
+
+    return BarometricFit(float(np.exp(coefficients[0])),
+                         float(coefficients[1]),
+                         float(coefficients[2]) if temperature else 0.,
+                         covariance, float(reference_pressure),
+                         float(reference_temperature), column,
+                         int(used.sum()))
+
+
+def correct_rates(rates, barometric_fit):
+    """
+    Get rate measurements with all rates and counts corrected to the
+    reference pressure and temperature of a fit. Measurements without
+    pressure get nan rates.
+
+    :param rates: rate measurements
+    :type rates: numpy.ndarray of RATE_DTYPE
+    :param barometric_fit: fitted coefficients
+    :type barometric_fit: BarometricFit
+    :returns: numpy.ndarray of RATE_DTYPE
+    """
+    factors = barometric_fit.correction_factors(rates["pressure"],
+                                                rates["temperature"])
+    corrected = rates.copy()
+    corrected["rates"] *= factors[:, None]
+    corrected["counts"] *= factors[:, None]
+    return corrected
+
+
+def write_rates(filename, rates, comment=None):
+    """
+    Write rate measurements in the R file format.
+
+    :param filename: path of the file
+    :type filename: str
+    :param rates: rate measurements
+    :type rates: numpy.ndarray of RATE_DTYPE
+    :param comment: comment written after the header
+    :type comment: str or None
+    :returns: None
+    """
+    stamps = np.char.replace(rates["time"].astype("S%d" % TIMESTAMP_LENGTH),
+                             b"T", b" ")
+    values = np.column_stack((rates["rates"], rates["counts"],
+                              rates["delta_time"], rates["pressure"],
+                              rates["temperature"]))
+
+    line_format = "%s" + " %f" * VALUE_COLUMNS + " \n"
+
+    with open(filename, "w") as rate_file:
+        rate_file.write(HEADER)
+        if comment is not None:
+            rate_file.write("# %s\n" % comment)
+        for stamp, row in zip(stamps.tolist(), values.tolist()):
+            rate_file.write(line_format % tuple([stamp.decode("ascii")] +
+                                                row))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Fit the barometric coefficient " +
+                                        "of the rates in R files and " +
+                                        "write corrected rates")
+    parser.add_argument("filenames", nargs="+",
+                        help="R files, may be compressed")
+    parser.add_argument("-c", "--column", dest="column", type=int,
+                        default=4, help="rate to fit, 0-3 for the " +
+                                        "channels, 4 for the trigger " +
+                                        "(default)")
+    parser.add_argument("-t", "--temperature", dest="temperature",
+                        action="store_true", default=False,
+                        help="fit a temperature coefficient as well")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="write the corrected rates to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    start = time.time()
+    measurements = load_rates(args.filenames)
+    loaded = time.time()
+    result = fit_barometric(measurements, args.column, args.temperature)
+    fitted = time.time()
+
+    print(result)
+    print("loaded %d measurements in %.3f s, fitted in %.3f s" %
+          (len(measurements), loaded - start, fitted - loaded))
+
+    if args.output is not None:
+        write_rates(args.output, correct_rates(measurements, result),
+                    "rates corrected to %.1f mBar with beta = %.4g %%/mBar" %
+                    (result.pressure, 100 * result.beta))
+        print("wrote corrected rates in %.3f s" % (time.time() - fitted))
@@ -0,0 +1,248 @@
+"""
+Provides bootstrap uncertainties for the decay and velocity fits.
+
+Replicas of a histogram are drawn at once from a multinomial distribution
+with the observed bin contents as probabilities, which is equivalent to
+resampling the recorded decay or flight times with replacement. Each
+replica is refitted, starting from the fit to the data, in a pool of
+processes and the uncertainty is given by percentiles of the refitted
+values.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import logging
+import multiprocessing as mp
+import time
+
+import numpy as np
+
+from muonic.analysis.fit import fit, gaussian_fit, CHI_SQUARE, POISSON
+
+# fits which can be bootstrapped
+DECAY = "decay"
+VELOCITY = "velocity"
+FIT_FUNCTIONS = {DECAY: fit, VELOCITY: gaussian_fit}
+
+# default number of replicas
+DEFAULT_REPLICAS = 1000
+
+# confidence level of a one sigma interval
+ONE_SIGMA = 0.6827
+
+# chunks of replicas per process, more chunks balance the load better
+CHUNKS_PER_PROCESS = 4
+
+
+class BootstrapResult(object):
+    """
+    Values of the parameter of interest fitted to bootstrap replicas.
+
+    :param value: value fitted to the data
+    :type value: float
+    :param values: values fitted to the replicas, nan for failed fits
+    :type values: numpy.ndarray
+    :param confidence: confidence level of the interval
+    :type confidence: float
+    """
+
+    def __init__(self, value, values, confidence=ONE_SIGMA):
+        self.value = value
+        self.values = values
+        self.confidence = confidence
+
+    @property
+    def failed(self):
+        """
+        Number of replicas which could not be fitted.
+
+        :returns: int
+        """
+        return int(np.isnan(self.values).sum())
+
+    def interval(self, confidence=None):
+        """
+        Get the percentile interval of the refitted values.
+
+        :param confidence: confidence level, the one of the result if None
+        :type confidence: float or None
+        :returns: tuple of float
+        """
+        if confidence is None:
+            confidence = self.confidence
+        tail = 50. * (1. - confidence)
+        lower, upper = np.nanpercentile(self.values, (tail, 100. - tail))
+        return float(lower), float(upper)
+
+    @property
+    def error(self):
+        """
+        Half width of the interval.
+
+        :returns: float
+        """
+        lower, upper = self.interval()
+        return 0.5 * (upper - lower)
+
+    def __repr__(self):
+        lower, upper = self.interval()
+        return ("BootstrapResult(value=%.4g, interval=(%.4g, %.4g), " +
+                "confidence=%.3g, replicas=%d, failed=%d)") % (
+                    self.value, lower, upper, self.confidence,
+                    len(self.values), self.failed)
+
+
+def resample_histogram(bincontent, replicas, random_state=None):
+    """
+    Draw bootstrap replicas of a histogram. Every replica has the same
+    number of entries as the histogram.
+
+    :param bincontent: bin contents
+    :type bincontent: numpy.ndarray
+    :param replicas: number of replicas
+    :type replicas: int
+    :param random_state: random number generator
+    :type random_state: numpy.random.RandomState or None
+    :returns: numpy.ndarray with one replica per row
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    bincontent = np.asarray(bincontent, dtype=float)
+    entries = int(round(bincontent.sum()))
+    if entries == 0:
+        return np.zeros((replicas, len(bincontent)), dtype=np.int64)
+    return random_state.multinomial(entries, bincontent / bincontent.sum(),
+                                    size=replicas)
+
+
+def _fit_replicas(args):
+    """
+    Fit replicas of a histogram. Runs in the worker processes.
+
+    :param args: name of the fit, replicas, binning, fit range, method and
+                 the fit to the data
+    :type args: tuple
+    :returns: numpy.ndarray -- fitted values, nan for failed fits
+    """
+    kind, histograms, binning, fitrange, method, previous = args
+    fit_function = FIT_FUNCTIONS[kind]
+    logger = logging.getLogger("muonic.bootstrap")
+    logger.setLevel(logging.ERROR)
+
+    values = np.full(len(histograms), np.nan)
+    for i, histogram in enumerate(histograms):
+        result = fit_function(histogram, binning=binning, fitrange=fitrange,
+                              method=method, previous=previous,
+                              logger=logger)
+        if result is not None and result.success:
+            values[i] = result.value
+    return values
+
+
+def bootstrap_fit(kind, bincontent, binning, fitrange=None,
+                  method=CHI_SQUARE, replicas=DEFAULT_REPLICAS,
+                  confidence=ONE_SIGMA, processes=None, seed=None,
+                  logger=None):
+    """
+    Get the bootstrap interval of the lifetime or the mean flight time
+    fitted to a histogram.
+
+    Returns None if the histogram cannot be fitted.
+
+    :param kind: fit to bootstrap, DECAY or VELOCITY
+    :type kind: str
+    :param bincontent: bin contents
+    :type bincontent: numpy.ndarray
+    :param binning: lower edge, upper edge and number of bin edges
+    :type binning: tuple
+    :param fitrange: lower and upper limit of the fit
+    :type fitrange: tuple or None
+    :param method: fit method, CHI_SQUARE or POISSON
+    :type method: str
+    :param replicas: number of replicas
+    :type replicas: int
+    :param confidence: confidence level of the interval
+    :type confidence: float
+    :param processes: number of worker processes, one per CPU if None,
+                      no pool if 1
+    :type processes: int or None
+    :param seed: seed of the resampling
+    :type seed: int or None
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: BootstrapResult or None
+    :raises: ValueError
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    if kind not in FIT_FUNCTIONS:
+        raise ValueError("unknown fit '%s'" % kind)
+
+    central = FIT_FUNCTIONS[kind](bincontent, binning=binning,
+                                  fitrange=fitrange, method=method,
+                                  logger=logger)
+    if central is None:
+        return None
+
+    histograms = resample_histogram(bincontent, replicas,
+                                    np.random.RandomState(seed))
+
+    if processes is None:
+        processes = mp.cpu_count()
+    processes = max(1, min(processes, replicas))
+
+    chunks = [(kind, histograms[indices], binning, fitrange, method,
+               central)
+              for indices in np.array_split(
+                  np.arange(replicas), processes * CHUNKS_PER_PROCESS)
+              if len(indices)]
+
+    if processes == 1:
+        values = [_fit_replicas(chunk) for chunk in chunks]
+    else:
+        pool = mp.Pool(processes)
+        try:
+            values = pool.map(_fit_replicas, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    result = BootstrapResult(central.value, np.concatenate(values),
+                             confidence)
+    if result.failed:
+        logger.debug("%d of %d bootstrap fits failed" %
+                     (result.failed, replicas))
+    return result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Bootstrap the lifetime fitted to " +
+                                        "simulated decays and report the " +
+                                        "runtime")
+    parser.add_argument("-n", "--decays", dest="decays", type=int,
+                        default=10000, help="number of decays")
+    parser.add_argument("-r", "--replicas", dest="replicas", type=int,
+                        default=DEFAULT_REPLICAS, help="number of replicas")
+    parser.add_argument("-p", "--processes", dest="processes", type=int,
+                        default=None, help="number of worker processes")
+    parser.add_argument("--poisson", dest="poisson", action="store_true",
+                        default=False, help="maximize the Poisson " +
+                                            "likelihood")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    decay_times = np.random.RandomState(0).exponential(2.197, args.decays)
+    bins = (0, 10, 21)
+    counts, _ = np.histogram(decay_times, np.linspace(*bins))
+
+    start = time.time()
+    bootstrap = bootstrap_fit(DECAY, counts, bins, fitrange=(1.5, 10.),
+                              method=POISSON if args.poisson else CHI_SQUARE,
+                              replicas=args.replicas,
+                              processes=args.processes, seed=0)
+    elapsed = time.time() - start
+
+    print(bootstrap)
+    print("%d replicas in %.2f s" % (args.replicas, elapsed))
@@ -0,0 +1,170 @@
+"""
+Provides an offline coincidence finder over the pulse times of the
+channels.
+
+The pulse times of each channel are kept in a sorted array. Coincidences
+of a combination of channels are found for all pulses at once with
+numpy.searchsorted, and coincidences close in time are merged into one
+muon, so no Python code runs per pulse.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import time
+
+import numpy as np
+
+# time window in seconds for which two pulses count as coincident
+COINC_WIND = 200e-9
+
+# coincidences closer than this time window in seconds belong to the
+# same muon
+MUON_WIND = 200e-9
+
+# combinations of channels with hits in both scintillators
+MUON_COMBINATIONS = ((0, 2), (0, 3), (1, 2), (1, 3))
+
+
+def find_coincidences(channel_times, combination, window=COINC_WIND):
+    """
+    Find the pulses of the first channel of a combination which have a
+    pulse in each of the other channels within the time window.
+
+    :param channel_times: sorted pulse times of each channel in seconds
+    :type channel_times: list of numpy.ndarray
+    :param combination: indices of the channels
+    :type combination: tuple of int
+    :param window: coincidence window in seconds
+    :type window: float
+    :returns: numpy.ndarray -- time of the earliest pulse of each
+              coincidence
+    """
+    anchors = np.asarray(channel_times[combination[0]], dtype=float)
+    earliest = anchors.copy()
+    found = np.ones(len(anchors), dtype=bool)
+
+    for channel in combination[1:]:
+        times = np.asarray(channel_times[channel], dtype=float)
+        if not len(times):
+            return np.zeros(0)
+
+        # first pulse which is not earlier than the window
+        index = np.searchsorted(times, anchors - window, side="left")
+        inside = index < len(times)
+        partner = times[np.minimum(index, len(times) - 1)]
+        found &= inside & (partner <= anchors + window)
+        earliest = np.minimum(earliest, partner)
+
+    return earliest[found]
+
+
+def find_muons(channel_times, combinations=MUON_COMBINATIONS,
+               coincidence_window=COINC_WIND, muon_window=MUON_WIND):
+    """
+    Find muons in the pulse times of the channels. A muon is a
+    coincidence of any of the combinations of channels. Coincidences
+    which follow each other within the muon window are merged into one
+    muon, its channels are those of all merged coincidences.
+
+    :param channel_times: sorted pulse times of each channel in seconds
+    :type channel_times: list of numpy.ndarray
+    :param combinations: combinations of channels which make a muon
+    :type combinations: tuple of tuple of int
+    :param coincidence_window: coincidence window in seconds
+    :type coincidence_window: float
+    :param muon_window: window in seconds in which coincidences belong to
+                        the same muon
+    :type muon_window: float
+    :returns: tuple of numpy.ndarray -- time of each muon and the mask of
+              its channels, one column per channel
+    """
+    coincidences = [find_coincidences(channel_times, combination,
+                                      coincidence_window)
+                    for combination in combinations]
+
+    # channels of the combination of each coincidence as bit mask
+    bits = [np.full(len(times), sum([1 << c for c in combination]),
+                    dtype=np.int64)
+            for times, combination in zip(coincidences, combinations)]
+
+    times = np.concatenate(coincidences + [np.zeros(0)])
+    order = np.argsort(times, kind="mergesort")
+    times = times[order]
+    bits = np.concatenate(bits + [np.zeros(0, dtype=np.int64)])[order]
+
+    if not len(times):
+        return times, np.zeros((0, len(channel_times)), dtype=bool)
+
+    # a muon starts with a coincidence which does not follow the previous
+    # one within the muon window
+    starts = np.flatnonzero(np.concatenate(
+        ([True], np.diff(times) >= muon_window)))
+
+    muon_bits = np.bitwise_or.reduceat(bits, starts)
+    mask = (muon_bits[:, None] >> np.arange(len(channel_times))) & 1
+    return times[starts], mask.astype(bool)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Find muons in simulated pulses " +
+                                        "and compare with a loop over the " +
+                                        "pulses")
+    parser.add_argument("-n", "--muons", dest="muons", type=int,
+                        default=100000, help="number of simulated muons")
+    parser.add_argument("-r", "--noise", dest="noise", type=float,
+                        default=1., help="uncorrelated pulses per muon and " +
+                                         "channel")
+    args = parser.parse_args()
+
+    random = np.random.RandomState(0)
+
+    # muons every 10 ms on average, each hits one scintillator pair
+    muon_starts = np.cumsum(random.exponential(10e-3, args.muons))
+    hits = [[] for _ in range(4)]
+    upper = random.randint(0, 2, args.muons)
+    lower = random.randint(2, 4, args.muons)
+    for channel in range(4):
+        hit = (upper == channel) | (lower == channel)
+        hits[channel].append(muon_starts[hit] +
+                             random.uniform(0, 50e-9, hit.sum()))
+        hits[channel].append(random.uniform(0, muon_starts[-1],
+                                            int(args.noise * args.muons)))
+    pulse_times = [np.sort(np.concatenate(h)) for h in hits]
+
+    start = time.time()
+    found_times, found_mask = find_muons(pulse_times)
+    vectorized = time.time() - start
+
+    # the coroutine of analysis_scripts/simple_reader.py, one pulse per send
+    def muon_finder(callback, muon=MUON_COMBINATIONS):
+        channels = {0: 0., 1: 0., 2: 0., 3: 0.}
+        last_pulse_time = 0.
+        while True:
+            channel, t = (yield)
+            if 0 < t - last_pulse_time < MUON_WIND or last_pulse_time == 0.:
+                channels[channel] = t
+            else:
+                for combination in muon:
+                    if all([channels[c] != 0. for c in combination]):
+                        callback(channels)
+                        break
+                for key in channels:
+                    channels[key] = 0.
+                channels[channel] = t
+            last_pulse_time = t
+
+    start = time.time()
+    loop_times = []
+    finder = muon_finder(lambda c: loop_times.append(
+        min([t for t in c.values() if t != 0.])))
+    next(finder)
+    for pulse in sorted([(channel, t) for channel in range(4)
+                         for t in pulse_times[channel].tolist()],
+                        key=lambda p: p[1]):
+        finder.send(pulse)
+    loop = time.time() - start
+
+    print("%d muons simulated, %d found, %d found by the loop" %
+          (args.muons, len(found_times), len(loop_times)))
+    print("channels hit: %s" % found_mask.sum(axis=0).tolist())
+    print("vectorized %.3f s, loop %.3f s, %.0f times faster" %
+          (vectorized, loop, loop / vectorized))
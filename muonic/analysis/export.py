@@ -0,0 +1,496 @@
+"""
+Provides the export of the events of RAW files to columnar storage.
+
+The events are extracted like in the offline analysis and written in
+chunks of columns, one table of events and one table of pulses, to HDF5
+files if h5py is installed or to directories of NumPy '.npz' files. Both
+can be appended to and are read back in chunks, so the events can be
+analyzed with NumPy without parsing the RAW files again.
+
+An event has the GPS time of its trigger line in milliseconds since the
+epoch, the trigger time in seconds since the start of the day, the index
+of its first pulse, its number of pulses and a bit mask of the channels
+with pulses. A pulse has the index of its event, its channel and the
+times of its rising and falling edge relative to the trigger and its
+width in ns.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import glob
+import logging
+import os
+import time
+
+import numpy as np
+
+from muonic.analysis.offline import CHANNELS, CHUNK_SIZE, iter_events
+from muonic.daq.exceptions import DAQMissingDependencyError
+
+# events collected before they are written at once
+EXPORT_BATCH = 100000
+
+# columns of the event and pulse tables
+EVENT_COLUMNS = (("gps_time", np.int64), ("trigger_time", np.float64),
+                 ("first_pulse", np.int64), ("pulses", np.uint16),
+                 ("channels", np.uint8))
+PULSE_COLUMNS = (("event", np.int64), ("channel", np.uint8),
+                 ("rising", np.float32), ("falling", np.float32),
+                 ("width", np.float32))
+
+# names of the tables
+EVENTS = "events"
+PULSES = "pulses"
+
+# suffixes of HDF5 files, other paths are directories of '.npz' chunks
+HDF5_SUFFIXES = (".h5", ".hdf5")
+
+# rows of the chunks of HDF5 datasets
+HDF5_CHUNK_ROWS = 1 << 16
+
+# name of the '.npz' chunks in a directory
+NPZ_CHUNK = "chunk-%06d.npz"
+
+# gzip level of HDF5 files
+DEFAULT_LEVEL = 4
+
+
+def _is_hdf5(path):
+    """
+    Check if a path is an HDF5 file by its suffix.
+
+    :param path: path of the export
+    :type path: str
+    :returns: bool
+    """
+    return path.lower().endswith(HDF5_SUFFIXES)
+
+
+def _import_h5py():
+    """
+    Import h5py.
+
+    :returns: module
+    :raises: DAQMissingDependencyError
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise DAQMissingDependencyError("no h5py installed...")
+    return h5py
+
+
+def _empty_table(columns):
+    """
+    Get a table without rows.
+
+    :param columns: names and types of the columns
+    :type columns: tuple
+    :returns: dict of numpy.ndarray
+    """
+    return dict((name, np.zeros(0, dtype=dtype)) for name, dtype in columns)
+
+
+class HDF5EventWriter(object):
+    """
+    Writes events to an HDF5 file with a group of resizable datasets for
+    each table. Needs h5py.
+
+    :param filename: path of the file
+    :type filename: str
+    :param compression: compress the datasets with gzip
+    :type compression: bool
+    :param level: gzip level
+    :type level: int
+    :param append: append to an existing file instead of replacing it
+    :type append: bool
+    :raises: DAQMissingDependencyError
+    """
+
+    def __init__(self, filename, compression=True, level=DEFAULT_LEVEL,
+                 append=False):
+        h5py = _import_h5py()
+        self.filename = filename
+        self._file = h5py.File(filename, "a" if append else "w")
+
+        options = {}
+        if compression:
+            options = {"compression": "gzip", "compression_opts": level,
+                       "shuffle": True}
+
+        for table, columns in ((EVENTS, EVENT_COLUMNS),
+                               (PULSES, PULSE_COLUMNS)):
+            group = self._file.require_group(table)
+            for name, dtype in columns:
+                if name not in group:
+                    group.create_dataset(name, shape=(0,), maxshape=(None,),
+                                         dtype=dtype,
+                                         chunks=(HDF5_CHUNK_ROWS,),
+                                         **options)
+
+        self.events = len(self._file[EVENTS]["gps_time"])
+        self.pulses = len(self._file[PULSES]["event"])
+
+    def write(self, events, pulses):
+        """
+        Append rows to the tables.
+
+        :param events: columns of the events
+        :type events: dict of numpy.ndarray
+        :param pulses: columns of the pulses
+        :type pulses: dict of numpy.ndarray
+        :returns: None
+        """
+        for table, columns, rows in ((EVENTS, events, self.events),
+                                     (PULSES, pulses, self.pulses)):
+            group = self._file[table]
+            for name, values in columns.items():
+                dataset = group[name]
+                dataset.resize((rows + len(values),))
+                dataset[rows:] = values
+
+        self.events += len(events["gps_time"])
+        self.pulses += len(pulses["event"])
+
+    def close(self):
+        """
+        Close the file.
+
+        :returns: None
+        """
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class NPZEventWriter(object):
+    """
+    Writes events to a directory with one '.npz' file for each chunk.
+    Each file holds the columns of both tables and the indices of its
+    first event and pulse.
+
+    :param directory: path of the directory
+    :type directory: str
+    :param compression: compress the files with zlib
+    :type compression: bool
+    :param append: append to existing chunks instead of replacing them
+    :type append: bool
+    """
+
+    def __init__(self, directory, compression=True, append=False):
+        self.directory = directory
+        self.compression = compression
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        chunks = _npz_chunks(directory)
+        if not append:
+            for filename in chunks:
+                os.remove(filename)
+            chunks = []
+
+        self.chunks = len(chunks)
+        self.events = 0
+        self.pulses = 0
+        if chunks:
+            with np.load(chunks[-1]) as last:
+                self.events = (int(last["event_offset"]) +
+                               len(last["gps_time"]))
+                self.pulses = (int(last["pulse_offset"]) +
+                               len(last["event"]))
+
+    def write(self, events, pulses):
+        """
+        Write rows of the tables to a new chunk.
+
+        :param events: columns of the events
+        :type events: dict of numpy.ndarray
+        :param pulses: columns of the pulses
+        :type pulses: dict of numpy.ndarray
+        :returns: None
+        """
+        columns = dict(events)
+        columns.update(pulses)
+        columns["event_offset"] = np.int64(self.events)
+        columns["pulse_offset"] = np.int64(self.pulses)
+
+        filename = os.path.join(self.directory, NPZ_CHUNK % self.chunks)
+        if self.compression:
+            np.savez_compressed(filename, **columns)
+        else:
+            np.savez(filename, **columns)
+
+        self.chunks += 1
+        self.events += len(events["gps_time"])
+        self.pulses += len(pulses["event"])
+
+    def close(self):
+        """
+        Nothing to close, every chunk is written at once.
+
+        :returns: None
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_event_writer(path, compression=True, level=DEFAULT_LEVEL,
+                      append=False):
+    """
+    Get the writer for a path, HDF5 for '.h5' and '.hdf5' files and
+    '.npz' chunks otherwise.
+
+    :param path: path of the export
+    :type path: str
+    :param compression: compress the data
+    :type compression: bool
+    :param level: gzip level of HDF5 files
+    :type level: int
+    :param append: append to an existing export
+    :type append: bool
+    :returns: HDF5EventWriter or NPZEventWriter
+    :raises: DAQMissingDependencyError
+    """
+    if _is_hdf5(path):
+        return HDF5EventWriter(path, compression, level, append)
+    return NPZEventWriter(path, compression, append)
+
+
+def _to_columns(batch, first_event, first_pulse):
+    """
+    Convert a batch of events to columns.
+
+    :param batch: GPS times and events as returned by iter_events
+    :type batch: list of tuple
+    :param first_event: index of the first event of the batch
+    :type first_event: int
+    :param first_pulse: index of the first pulse of the batch
+    :type first_pulse: int
+    :returns: tuple of dict of numpy.ndarray
+    """
+    counts = []
+    masks = []
+    channels = []
+    edges = []
+    for _, event in batch:
+        count = 0
+        mask = 0
+        for channel in range(CHANNELS):
+            channel_pulses = event[channel + 1]
+            if channel_pulses:
+                mask |= 1 << channel
+                count += len(channel_pulses)
+                channels.extend([channel] * len(channel_pulses))
+                edges.extend(channel_pulses)
+        counts.append(count)
+        masks.append(mask)
+
+    events = _empty_table(EVENT_COLUMNS)
+    pulses = _empty_table(PULSE_COLUMNS)
+    if not batch:
+        return events, pulses
+
+    counts = np.array(counts, dtype=np.int64)
+    gps_times = np.array([gps_time for gps_time, _ in batch],
+                         dtype="datetime64[ms]")
+    events["gps_time"] = gps_times.astype(np.int64)
+    events["trigger_time"] = np.array([event[0] for _, event in batch],
+                                      dtype=np.float64)
+    events["first_pulse"] = first_pulse + np.cumsum(counts) - counts
+    events["pulses"] = counts.astype(np.uint16)
+    events["channels"] = np.array(masks, dtype=np.uint8)
+
+    edges = np.array(edges, dtype=np.float64).reshape(-1, 2)
+    pulses["event"] = np.repeat(
+        np.arange(first_event, first_event + len(batch)), counts)
+    pulses["channel"] = np.array(channels, dtype=np.uint8)
+    pulses["rising"] = edges[:, 0].astype(np.float32)
+    pulses["falling"] = edges[:, 1].astype(np.float32)
+    pulses["width"] = (edges[:, 1] - edges[:, 0]).astype(np.float32)
+    return events, pulses
+
+
+def export_events(filenames, path, compression=True, level=DEFAULT_LEVEL,
+                  append=False, chunk_size=CHUNK_SIZE, logger=None):
+    """
+    Export the events of RAW files. Events without a valid GPS time get
+    the smallest int64 as GPS time.
+
+    :param filenames: path or paths of the RAW files
+    :type filenames: str or list of str
+    :param path: path of the export, see open_event_writer
+    :type path: str
+    :param compression: compress the data
+    :type compression: bool
+    :param level: gzip level of HDF5 files
+    :type level: int
+    :param append: append to an existing export
+    :type append: bool
+    :param chunk_size: bytes read at once
+    :type chunk_size: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: int -- number of exported events
+    :raises: DAQMissingDependencyError
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    exported = 0
+    with open_event_writer(path, compression, level, append) as writer:
+        batch = []
+        for event in iter_events(filenames, chunk_size, logger,
+                                 with_gps_time=True):
+            batch.append(event)
+            if len(batch) < EXPORT_BATCH:
+                continue
+            writer.write(*_to_columns(batch, writer.events, writer.pulses))
+            exported += len(batch)
+            batch = []
+
+        if batch:
+            writer.write(*_to_columns(batch, writer.events, writer.pulses))
+            exported += len(batch)
+
+    logger.info("Exported %d events to %s" % (exported, path))
+    return exported
+
+
+def _npz_chunks(directory):
+    """
+    Get the chunks of an '.npz' export in order.
+
+    :param directory: path of the directory
+    :type directory: str
+    :returns: list of str
+    """
+    return sorted(glob.glob(os.path.join(directory, "chunk-*.npz")))
+
+
+def iter_event_chunks(path, chunk_rows=EXPORT_BATCH):
+    """
+    Read an export in chunks. Chunks of '.npz' exports are read as they
+    were written, HDF5 files are read in chunks of a number of events.
+    The GPS time is returned as numpy.datetime64.
+
+    :param path: path of the export
+    :type path: str
+    :param chunk_rows: events of the chunks read from HDF5 files
+    :type chunk_rows: int
+    :returns: generator of tuple of dict of numpy.ndarray
+    :raises: DAQMissingDependencyError
+    """
+    if _is_hdf5(path):
+        chunks = _iter_hdf5_chunks(path, chunk_rows)
+    else:
+        chunks = _iter_npz_chunks(path)
+
+    for events, pulses in chunks:
+        events["gps_time"] = events["gps_time"].view("datetime64[ms]")
+        yield events, pulses
+
+
+def _iter_hdf5_chunks(filename, chunk_rows):
+    """
+    Read an HDF5 export in chunks of a number of events.
+
+    :param filename: path of the file
+    :type filename: str
+    :param chunk_rows: events of a chunk
+    :type chunk_rows: int
+    :returns: generator of tuple of dict of numpy.ndarray
+    :raises: DAQMissingDependencyError
+    """
+    h5py = _import_h5py()
+    with h5py.File(filename, "r") as hdf5_file:
+        event_group = hdf5_file[EVENTS]
+        pulse_group = hdf5_file[PULSES]
+        rows = len(event_group["gps_time"])
+        for start in range(0, rows, chunk_rows):
+            stop = min(start + chunk_rows, rows)
+            events = dict((name, event_group[name][start:stop])
+                          for name, _ in EVENT_COLUMNS)
+            first = int(events["first_pulse"][0])
+            last = int(events["first_pulse"][-1] + events["pulses"][-1])
+            pulses = dict((name, pulse_group[name][first:last])
+                          for name, _ in PULSE_COLUMNS)
+            yield events, pulses
+
+
+def _iter_npz_chunks(directory):
+    """
+    Read an '.npz' export chunk by chunk.
+
+    :param directory: path of the directory
+    :type directory: str
+    :returns: generator of tuple of dict of numpy.ndarray
+    """
+    for filename in _npz_chunks(directory):
+        with np.load(filename) as chunk:
+            events = dict((name, chunk[name]) for name, _ in EVENT_COLUMNS)
+            pulses = dict((name, chunk[name]) for name, _ in PULSE_COLUMNS)
+        yield events, pulses
+
+
+def load_events(path):
+    """
+    Read a whole export.
+
+    :param path: path of the export
+    :type path: str
+    :returns: tuple of dict of numpy.ndarray -- events and pulses
+    :raises: DAQMissingDependencyError
+    """
+    events = _empty_table(EVENT_COLUMNS)
+    events["gps_time"] = events["gps_time"].view("datetime64[ms]")
+    pulses = _empty_table(PULSE_COLUMNS)
+    chunks = list(iter_event_chunks(path))
+    for table, index in ((events, 0), (pulses, 1)):
+        for name in table:
+            table[name] = np.concatenate(
+                [table[name]] + [chunk[index][name] for chunk in chunks])
+    return events, pulses
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Export the events of RAW files " +
+                                        "to HDF5 ('.h5', '.hdf5') or to a " +
+                                        "directory of '.npz' chunks")
+    parser.add_argument("filenames", metavar="FILE", nargs="+",
+                        help="RAW files")
+    parser.add_argument("-o", "--output", dest="output", required=True,
+                        help="HDF5 file or directory")
+    parser.add_argument("-a", "--append", dest="append",
+                        action="store_true", help="append to the output")
+    parser.add_argument("-u", "--uncompressed", dest="compression",
+                        action="store_false",
+                        help="do not compress the output")
+    parser.add_argument("-l", "--level", dest="level", type=int,
+                        default=DEFAULT_LEVEL, help="gzip level of HDF5")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    start = time.time()
+    exported = export_events(args.filenames, args.output, args.compression,
+                             args.level, args.append)
+    print("exported %d events in %.2f s" % (exported, time.time() - start))
+
+    start = time.time()
+    events, pulses = load_events(args.output)
+    print("read %d events and %d pulses in %.3f s" %
+          (len(events["gps_time"]), len(pulses["event"]),
+           time.time() - start))
+    for channel in range(CHANNELS):
+        widths = pulses["width"][pulses["channel"] == channel]
+        if len(widths):
+            print("channel %d: %d pulses, median width %.1f ns" %
+                  (channel, len(widths), np.median(widths)))
@@ -1,284 +1,492 @@
 """
-Script for performing a fit to a histogramm of recorded 
+Script for performing a fit to a histogramm of recorded
 time differences for the use with QNet
+
+Models provide their analytic derivatives, so the fits converge in a few
+iterations and are cheap enough to be repeated on every update of a
+histogram. Bins are fitted either by least squares or, for bins with few
+entries, by maximizing the Poisson likelihood.
 """
 from __future__ import print_function
+import abc
+from future.utils import with_metaclass
+import logging
 import sys
 
-from matplotlib import pylab
 import numpy
-import scipy.optimize as optimize
+
+# fit methods
+CHI_SQUARE = "chisquare"
+POISSON = "poisson"
 
 
-def fit(bincontent=None, binning=(0, 10, 21), fitrange=None):
+class FitModel(with_metaclass(abc.ABCMeta, object)):
+    """
+    Base class of the fit models. A model evaluates a function of the bin
+    centers and its derivatives with respect to the parameters.
     """
-    Fit function
 
-    :param bincontent:
-    :param binning:
-    :param fitrange:
-    :returns:
+    # parameter names
+    PARAMETERS = ()
+    # index of the parameter shown as fit result
+    VALUE_INDEX = 0
+    # bounds of the parameters for the likelihood fit
+    BOUNDS = ()
+
+    @abc.abstractmethod
+    def __call__(self, p, x):
+        """
+        Evaluate the model.
+
+        :param p: parameters
+        :type p: numpy.ndarray
+        :param x: bin centers
+        :type x: numpy.ndarray
+        :returns: numpy.ndarray
+        """
+        return
+
+    @abc.abstractmethod
+    def jacobian(self, p, x):
+        """
+        Get the derivatives of the model with respect to the parameters.
+
+        :param p: parameters
+        :type p: numpy.ndarray
+        :param x: bin centers
+        :type x: numpy.ndarray
+        :returns: numpy.ndarray -- one row per bin, one column per parameter
+        """
+        return
+
+    @abc.abstractmethod
+    def guess(self, x, y):
+        """
+        Get start parameters for the fit from the data.
+
+        :param x: bin centers
+        :type x: numpy.ndarray
+        :param y: bin contents
+        :type y: numpy.ndarray
+        :returns: numpy.ndarray
+        """
+        return
+
+
+class DecayModel(FitModel):
     """
-    def decay(p, x):
+    Exponential decay on top of a constant background:
+    p[0] * exp(-x / p[1]) + p[2]
+    """
+
+    PARAMETERS = ("amplitude", "lifetime", "background")
+    VALUE_INDEX = 1
+    BOUNDS = ((0., None), (1e-6, None), (0., None))
+
+    def __call__(self, p, x):
         return p[0] * numpy.exp(-x / p[1]) + p[2]
-    
-    def error(p, x, y):
-        return decay(p, x) - y
-    
-    if bincontent is None:
-        nbins = 10
-        xmin = 1.0
-        xmax = 20.0
-
-        times = [float(l) for l in open(sys.argv[1]).readlines()
-                 if xmin < float(l) < xmax]
-
-        print(len(times), "decay times")
-
-        # nbins = optimalbins.optbinsize(times, 1, 80)
-        # print(nbins, "Optimalbins selects nbins")
-        # nbins = optimalbins.optbinsize(times, 1, 30)
-
-        print("Nbins:", nbins)
-        
-        bin_edges = numpy.linspace(binning[0], binning[1], binning[2])
-        bin_centers = bin_edges[:-1] + 0.5 * (bin_edges[1] - bin_edges[0])
-        
-        hist, edges = numpy.histogram(times, bin_edges)
-        
-        # hist = hist[:-1]
-        p0 = numpy.array([200, 2.0, 5])
-        
-        output = optimize.leastsq(error, p0, args=(bin_centers, hist),
-                                  full_output=1)
-        p = output[0]
-        covar = output[1]
-        
-        print("Fit parameters:", p)
-        print("Covariance matrix:", covar)
-        
-        chisquare=0.
-        deviations=error(p, bin_centers, hist)
-
-        for i, d in enumerate(deviations):
-            chisquare += d * d / decay(p, bin_centers[i])
-        
-        params = {"legend.fontsize": 13}
-
-        pylab.rcParams.update(params)
-        
-        fitx = numpy.linspace(xmin, xmax, 100)
-
-        pylab.plot(bin_centers, hist, "b^", fitx, decay(p, fitx), "b-")
-        pylab.ylim(0, max(hist) + 100)
-        pylab.xlabel("Decay time in microseconds")
-        pylab.ylabel("Events in time bin")
-        # pylab.legend(("Data","Fit: (%4.2f +- %4.2f) microsec," +
-        #               "chisq / ndf=%4.2f" % (p[1], numpy.sqrt(covar[1][1]),
-        #                                      chisquare / (nbins - len(p)))))
-        pylab.legend(("Data","Fit: (%4.2f) microsec," +
-                      "chisq/ndf=%4.2f" % p[1], chisquare / (nbins - len(p))))
-
-        pylab.grid()
-        pylab.savefig("fit.png")
-    else:
-        # this is then used for the mudecay window in muonic.
-        # we have to adjust the bins to the values of the used histogram.
-        if len(bincontent) == 0:
-            print("WARNING: Empty bins.")
-            return None
-    
-        bins = numpy.linspace(binning[0], binning[1], binning[2])
-        bin_centers = bins[:-1] + 0.5 * (bins[1] - bins[0])
-        if fitrange is not None:
-            if fitrange[0] < binning[0]:
-                fitrange = (binning[0], fitrange[1])
-            if fitrange[1] > binning[1]:
-                fitrange = (fitrange[0], binning[1])
-
-            bin_mask = [(bin_centers <= fitrange[1]) &
-                        (bin_centers >= fitrange[0])]
-            bin_centers_ = numpy.asarray([x for x in bin_centers
-                                          if fitrange[0] <= x <= fitrange[1]])
-
-            if len(bin_centers_) < 3:
-                print("WARNING: fit range too small. " +
-                      "Skipping fitting. Try with larger fit range.")
-                return None
-            else:
-                bin_centers = bin_centers_
-                bincontent = bincontent[bin_mask]
-
-        # we cut the leading edge of the distribution away for the fit 
-        glob_max = max(bincontent)
-        cut = 0
-        for i in enumerate(bincontent):
-            if i[1] == glob_max:
-                cut = i[0]
-
-        cut_bincontent = bincontent[cut:]
-        # cut_bincenter = bin_centers[cut]
-        cut_bincenters = bin_centers[cut:]
-
-        # # maybe something for the future..
-        # nbins = optimalbins.optbinsize(cut_bincontent, 1, 20)
-        # fit_bins = numpy.linspace(cut_bincenter, 20, nbins)
-        # fit_bin_centers = fit_bins[:-1] + 0.5 * (fit_bins[1] - fit_bins[0])
-        # fit_bincontent = numpy.zeros(len(fit_bin_centers))
-
-        # # the bincontent must be redistributed to fit_bincontent
-        # for binindex_fit in xrange(len(fit_bincontent)):
-        #     for binindex,content in enumerate(bincontent):
-        #         if bin_centers[binindex] <= fit_bin_centers[binindex_fit]:
-        #             fit_bincontent[binindex_fit] += content
-
-        p0 = numpy.array([200, 2.0, 5])
-
-        # output = optimize.leastsq(error, p0,
-        #                           args=(fit_bin_centers,fitbincontent),
-        #                           full_output=1)
-        output = optimize.leastsq(error, p0,
-                                  args=(cut_bincenters, cut_bincontent),
-                                  full_output=1)
-
-        p = output[0]
-        covar = output[1]
-        
-        print("Fit parameters:", p)
-        print("Covariance matrix:", covar)
-        
-        chisquare = 0.
-        deviations = error(p, cut_bincenters, cut_bincontent)
-
-        for i, d in enumerate(deviations):
-            chisquare += d * d / decay(p, cut_bincenters[i])
-        
-        params = {"legend.fontsize": 13}
-
-        pylab.rcParams.update(params)
-        
-        # nbins = 84
-        nbins = len(bins)
-        xmin = cut_bincenters[0]
-        xmax = cut_bincenters[-1]
-
-        fitx = numpy.linspace(xmin, xmax, 100)
-
-        # return (bin_centers, bincontent, fitx,
-        #         decay, p, covar, chisquare, nbins)
-        return (cut_bincenters, cut_bincontent, fitx,
-                decay, p, covar, chisquare, nbins)
-     
-
-def gaussian_fit(bincontent, binning=(0, 2, 10), fitrange=None):
+
+    def jacobian(self, p, x):
+        e = numpy.exp(-x / p[1])
+        return numpy.column_stack((e, p[0] * x * e / p[1] ** 2,
+                                   numpy.ones_like(x)))
+
+    def guess(self, x, y):
+        return numpy.array([max(y.max(), 1.) * numpy.exp(x[0] / 2.), 2.,
+                            max(y.min(), 0.)])
+
+
+class GaussianModel(FitModel):
+    """
+    Gaussian with area p[0], width p[1] and mean p[2]
     """
-    Guassian fit function
 
-    :param bincontent:
-    :param binning:
-    :param fitrange:
-    :returns:
+    PARAMETERS = ("area", "sigma", "mean")
+    VALUE_INDEX = 2
+    BOUNDS = ((0., None), (1e-6, None), (None, None))
+
+    def __call__(self, p, x):
+        return (p[0] / (p[1] * numpy.sqrt(2 * numpy.pi)) *
+                numpy.exp(-0.5 * ((x - p[2]) / p[1]) ** 2))
+
+    def jacobian(self, p, x):
+        z = (x - p[2]) / p[1]
+        g = numpy.exp(-0.5 * z ** 2) / (p[1] * numpy.sqrt(2 * numpy.pi))
+        return numpy.column_stack((g, p[0] * g * (z ** 2 - 1) / p[1],
+                                   p[0] * g * z / p[1]))
+
+    def guess(self, x, y):
+        weight = y.sum()
+        if weight <= 0:
+            return numpy.array([1., max(x[-1] - x[0], 1e-3), x.mean()])
+        mean = (y * x).sum() / weight
+        sigma = numpy.sqrt(max((y * x ** 2).sum() / weight - mean ** 2,
+                               1e-6))
+        return numpy.array([weight * (x[1] - x[0]) if len(x) > 1 else weight,
+                            sigma, mean])
+
+
+class FitResult(object):
+    """
+    Result of a fit to a histogram.
+
+    :param model: fitted model
+    :type model: FitModel
+    :param params: fitted parameters
+    :type params: numpy.ndarray
+    :param covariance: covariance matrix of the parameters, None if it
+                       could not be estimated
+    :type covariance: numpy.ndarray or None
+    :param x: bin centers used in the fit
+    :type x: numpy.ndarray
+    :param y: bin contents used in the fit
+    :type y: numpy.ndarray
+    :param method: fit method, CHI_SQUARE or POISSON
+    :type method: str
+    :param success: True if the fit converged
+    :type success: bool
     """
-    def gauss(p, x):
-        return (p[0] * (1 / (p[1] * numpy.sqrt(2 * numpy.pi))) *
-                numpy.exp(-0.5 * (((x - p[2]) / p[1]) ** 2)))
-    
-    def error(p, x, y):
-        return gauss(p, x) - y
-    
-    if len(bincontent) == 0:
-        print("WARNING: Empty bins.")
-        return None
-    
-    # this is then used for the mudecay window in muonic.
-    # we have to adjust the bins to the values of the used histogram.
 
+    def __init__(self, model, params, covariance, x, y, method, success):
+        self.model = model
+        self.params = params
+        self.covariance = covariance
+        self.x = x
+        self.y = y
+        self.method = method
+        self.success = success
+
+        expected = model(params, x)
+        self.chisquare = float(numpy.sum((y - expected) ** 2 /
+                                         numpy.maximum(expected, 1e-12)))
+        self.ndf = len(x) - len(params)
+
+    @property
+    def errors(self):
+        """
+        Standard errors of the parameters, zero if unknown.
+
+        :returns: numpy.ndarray
+        """
+        if self.covariance is None:
+            return numpy.zeros(len(self.params))
+        return numpy.sqrt(numpy.absolute(numpy.diag(self.covariance)))
+
+    @property
+    def value(self):
+        """
+        The parameter of interest, e.g. the lifetime of a decay.
+
+        :returns: float
+        """
+        return self.params[self.model.VALUE_INDEX]
+
+    @property
+    def error(self):
+        """
+        Standard error of the parameter of interest.
+
+        :returns: float
+        """
+        return self.errors[self.model.VALUE_INDEX]
+
+    @property
+    def chisquare_per_ndf(self):
+        """
+        Reduced chi-square, infinite without degrees of freedom.
+
+        :returns: float
+        """
+        if self.ndf <= 0:
+            return float("inf")
+        return self.chisquare / self.ndf
+
+    def curve(self, points=100):
+        """
+        Sample the fitted model over the fitted bins.
+
+        :param points: number of points
+        :type points: int
+        :returns: tuple of numpy.ndarray
+        """
+        fitx = numpy.linspace(self.x[0], self.x[-1], points)
+        return fitx, self.model(self.params, fitx)
+
+    def __repr__(self):
+        return "FitResult(%s, chisquare/ndf=%.3g)" % (
+            ", ".join(["%s=%.4g+-%.2g" % (name, value, error)
+                       for name, value, error in
+                       zip(self.model.PARAMETERS, self.params,
+                           self.errors)]),
+            self.chisquare_per_ndf)
+
+
+def fit_histogram(model, x, y, method=CHI_SQUARE, p0=None):
+    """
+    Fit a model to histogram bins.
+
+    With CHI_SQUARE, the residuals are weighted with the statistical error
+    of the bins, sqrt(max(y, 1)). With POISSON, the Poisson likelihood of
+    the bin contents is maximized, which is unbiased for bins with few or
+    no entries.
+
+    :param model: model to fit
+    :type model: FitModel
+    :param x: bin centers
+    :type x: numpy.ndarray
+    :param y: bin contents
+    :type y: numpy.ndarray
+    :param method: fit method, CHI_SQUARE or POISSON
+    :type method: str
+    :param p0: start parameters, guessed from the data if None
+    :type p0: numpy.ndarray
+    :returns: FitResult
+    :raises: ValueError
+    """
+    # SciPy takes longer to import than the rest of the analysis
+    import scipy.optimize as optimize
+    from scipy.special import xlogy
+
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+
+    if p0 is None:
+        p0 = model.guess(x, y)
+    p0 = numpy.asarray(p0, dtype=float)
+
+    if method == CHI_SQUARE:
+        sigma = numpy.sqrt(numpy.maximum(y, 1.))
+
+        def residuals(p):
+            return (model(p, x) - y) / sigma
+
+        def jacobian(p):
+            return model.jacobian(p, x) / sigma[:, None]
+
+        p, cov_x, _, _, status = optimize.leastsq(
+                residuals, p0, Dfun=jacobian, full_output=1)
+        return FitResult(model, p, cov_x, x, y, method, status in (1, 2, 3, 4))
+
+    if method == POISSON:
+        def deviance(p):
+            f = numpy.maximum(model(p, x), 1e-12)
+            return 2. * numpy.sum(f - y + xlogy(y, y) - xlogy(y, f))
+
+        def gradient(p):
+            f = numpy.maximum(model(p, x), 1e-12)
+            return 2. * model.jacobian(p, x).T.dot(1. - y / f)
+
+        bounds = list(model.BOUNDS)
+        result = optimize.minimize(deviance, p0, jac=gradient,
+                                   method="L-BFGS-B", bounds=bounds)
+        p = result.x
+
+        # the inverse of the Fisher information is the covariance
+        f = numpy.maximum(model(p, x), 1e-12)
+        jac = model.jacobian(p, x)
+        try:
+            covariance = numpy.linalg.inv(jac.T.dot(jac / f[:, None]))
+        except numpy.linalg.LinAlgError:
+            covariance = None
+        return FitResult(model, p, covariance, x, y, method, result.success)
+
+    raise ValueError("unknown fit method '%s'" % method)
+
+
+def _select_bins(bincontent, binning, fitrange, logger):
+    """
+    Get the bin centers and contents within the fit range.
+
+    Returns None if the fit range contains less than three bins.
+
+    :param bincontent: bin contents
+    :type bincontent: numpy.ndarray
+    :param binning: lower edge, upper edge and number of bin edges
+    :type binning: tuple
+    :param fitrange: lower and upper limit of the fit
+    :type fitrange: tuple or None
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: tuple of numpy.ndarray or None
+    """
     bins = numpy.linspace(binning[0], binning[1], binning[2])
     bin_centers = bins[:-1] + 0.5 * (bins[1] - bins[0])
+    bincontent = numpy.asarray(bincontent, dtype=float)
 
     if fitrange is not None:
-        if fitrange[0] < binning[0]:
-            fitrange = (binning[0], fitrange[1])
-        if fitrange[1] > binning[1]:
-            fitrange = (fitrange[0], binning[1])
-        bin_mask = [(bin_centers <= fitrange[1]) &
-                    (bin_centers >= fitrange[0])]
-        bin_centers_ = numpy.asarray([x for x in bin_centers
-                                      if fitrange[0] <= x <= fitrange[1]])
-        if len(bin_centers_) < 3:
-            print("WARNING: fit range too small. " +
-                  "Skipping fitting. Try with larger fit range.")
+        low = max(fitrange[0], binning[0])
+        high = min(fitrange[1], binning[1])
+        bin_mask = (bin_centers >= low) & (bin_centers <= high)
+
+        if bin_mask.sum() < 3:
+            logger.warning("Fit range too small. Skipping fitting. " +
+                           "Try with larger fit range.")
             return None
-        else:
-            bin_centers = bin_centers_
-            bincontent = bincontent[bin_mask]
-
-    # # we cut the leading edge of the distribution away for the fit
-    # glob_max = max(bincontent)
-    # cut = 0
-    # for i in enumerate(bincontent):
-    #     if i[1] == glob_max:
-    #         cut = i[0]
-
-    cut_bincontent = bincontent  # [cut:]
-    # cut_bincenter = bin_centers  # [cut]
-    cut_bincenters = bin_centers  # [cut:]
-
-    # # maybe something for the future..
-    # nbins = optimalbins.optbinsize(cut_bincontent, 1, 20)
-    # fit_bins = numpy.linspace(cut_bincenter, 20, nbins)
-    # fit_bin_centers = fit_bins[:-1] + 0.5 * (fit_bins[1] - fit_bins[0])
-    # fit_bincontent = numpy.zeros(len(fit_bin_centers))
-
-    # # the bincontent must be redistributed to fit_bincontent
-    # for binindex_fit in xrange(len(fit_bincontent)):
-    #     for binindex, content in enumerate(bincontent):
-    #         if bin_centers[binindex] <= fit_bin_centers[binindex_fit]:
-    #             fit_bincontent[binindex_fit] += content
-
-    wsum = cut_bincontent.sum()
-    mean = (cut_bincontent * cut_bincenters).sum() / wsum
-    meansquared = (cut_bincontent * cut_bincenters ** 2).sum() / wsum
-
-    var = meansquared - mean ** 2
-
-    # p0 = numpy.array([20, 1.0, 5])
-    p0 = numpy.array([max(cut_bincontent), var, mean])
-
-    # output = optimize.leastsq(error, p0,
-    #                           args=(fit_bin_centers, fitbincontent),
-    #                           full_output=1)
-    output = optimize.leastsq(error, p0,
-                              args=(cut_bincenters, cut_bincontent),
-                              full_output=1)
-
-    p = output[0]
-    covar = output[1]
-    
-    print("Fit parameters:", p)
-    print("Covariance matrix:", covar)
-    
-    chisquare = 0.
-    deviations = error(p, cut_bincenters, cut_bincontent)
-
-    for i, d in enumerate(deviations):
-        chisquare += d*d/gauss(p,cut_bincenters[i])
-    
-    params = {"legend.fontsize": 13}
-
-    pylab.rcParams.update(params)
-    
-    # nbins = 84
-    nbins = len(bins)
-    xmin = cut_bincenters[0]
-    xmax = cut_bincenters[-1]
-
-    fitx = numpy.linspace(xmin, xmax, 100)
-
-    # return (bin_centers, bincontent, fitx, decay, p, covar, chisquare, nbins)
-    return (cut_bincenters, cut_bincontent, fitx,
-            gauss, p, covar, chisquare, nbins)
-     
+
+        bin_centers = bin_centers[bin_mask]
+        bincontent = bincontent[bin_mask]
+
+    return bin_centers, bincontent
+
+
+def fit(bincontent, binning=(0, 10, 21), fitrange=None, method=CHI_SQUARE,
+        previous=None, logger=None):
+    """
+    Fit an exponential decay to a histogram of decay times. The bins
+    before the maximum of the histogram are not fitted.
+
+    Returns None if there is nothing to fit.
+
+    :param bincontent: bin contents
+    :type bincontent: numpy.ndarray
+    :param binning: lower edge, upper edge and number of bin edges
+    :type binning: tuple
+    :param fitrange: lower and upper limit of the fit
+    :type fitrange: tuple or None
+    :param method: fit method, CHI_SQUARE or POISSON
+    :type method: str
+    :param previous: result of a previous fit to start from
+    :type previous: FitResult
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: FitResult or None
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    if len(bincontent) == 0:
+        logger.warning("Empty bins.")
+        return None
+
+    selected = _select_bins(bincontent, binning, fitrange, logger)
+    if selected is None:
+        return None
+    bin_centers, bincontent = selected
+
+    # we cut the leading edge of the distribution away for the fit
+    cut = len(bincontent) - 1 - numpy.argmax(bincontent[::-1])
+    if len(bincontent) - cut < 3:
+        logger.warning("Not enough bins after the maximum. Skipping fitting.")
+        return None
+
+    return _fit_with_warm_start(DecayModel(), bin_centers[cut:],
+                                bincontent[cut:], method, previous)
+
+
+def gaussian_fit(bincontent, binning=(0, 2, 10), fitrange=None,
+                 method=CHI_SQUARE, previous=None, logger=None):
+    """
+    Fit a gaussian to a histogram, e.g. of flight times.
+
+    Returns None if there is nothing to fit.
+
+    :param bincontent: bin contents
+    :type bincontent: numpy.ndarray
+    :param binning: lower edge, upper edge and number of bin edges
+    :type binning: tuple
+    :param fitrange: lower and upper limit of the fit
+    :type fitrange: tuple or None
+    :param method: fit method, CHI_SQUARE or POISSON
+    :type method: str
+    :param previous: result of a previous fit to start from
+    :type previous: FitResult
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: FitResult or None
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    if len(bincontent) == 0:
+        logger.warning("Empty bins.")
+        return None
+
+    selected = _select_bins(bincontent, binning, fitrange, logger)
+    if selected is None:
+        return None
+
+    return _fit_with_warm_start(GaussianModel(), selected[0], selected[1],
+                                method, previous)
+
+
+def _fit_with_warm_start(model, x, y, method, previous):
+    """
+    Fit starting from the parameters of a previous successful fit of the
+    same model, or from a guess.
+
+    :param model: model to fit
+    :type model: FitModel
+    :param x: bin centers
+    :type x: numpy.ndarray
+    :param y: bin contents
+    :type y: numpy.ndarray
+    :param method: fit method, CHI_SQUARE or POISSON
+    :type method: str
+    :param previous: result of a previous fit
+    :type previous: FitResult or None
+    :returns: FitResult
+    """
+    p0 = None
+    if (previous is not None and previous.success and
+            type(previous.model) is type(model)):
+        p0 = previous.params
+
+    result = fit_histogram(model, x, y, method, p0)
+
+    if p0 is not None and not result.success:
+        # the histogram changed too much, start over
+        result = fit_histogram(model, x, y, method)
+    return result
+
+
+def fit_file(filename, binning=(0, 10, 21), xmin=1.0, xmax=20.0,
+             output="fit.png"):
+    """
+    Fit the decay times in a D file or a file with one time per line and
+    plot the fit.
+
+    :param filename: file with decay times in microseconds
+    :type filename: str
+    :param binning: lower edge, upper edge and number of bin edges
+    :type binning: tuple
+    :param xmin: minimum decay time
+    :type xmin: float
+    :param xmax: maximum decay time
+    :type xmax: float
+    :param output: file name of the plot
+    :type output: str
+    :returns: FitResult or None
+    """
+    # only needed for the plot
+    from matplotlib import pylab
+    from muonic.analysis.unbinned import load_decay_times
+
+    times = load_decay_times(filename)
+    times = times[(times > xmin) & (times < xmax)]
+
+    print(len(times), "decay times")
+
+    bin_edges = numpy.linspace(binning[0], binning[1], binning[2])
+    hist, _ = numpy.histogram(times, bin_edges)
+
+    result = fit(hist, binning)
+    if result is None:
+        return None
+
+    print(result)
+
+    fitx, fity = result.curve()
+    pylab.rcParams.update({"legend.fontsize": 13})
+    pylab.plot(result.x, result.y, "b^", fitx, fity, "b-")
+    pylab.ylim(0, max(hist) + 100)
+    pylab.xlabel("Decay time in microseconds")
+    pylab.ylabel("Events in time bin")
+    pylab.legend(("Data", "Fit: (%4.2f +- %4.2f) microsec, chisq/ndf=%4.2f" %
+                  (result.value, result.error, result.chisquare_per_ndf)))
+    pylab.grid()
+    pylab.savefig(output)
+    return result
+
 
 if __name__ == '__main__':
-    fit()
+    fit_file(sys.argv[1])
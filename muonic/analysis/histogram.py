@@ -0,0 +1,257 @@
+"""
+Provides a histogram with fixed bins which keeps track of values outside
+of the bins. Histograms can be merged, rebinned and saved, so they can be
+accumulated independently of their display.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import time
+
+import numpy as np
+
+
+class Histogram(object):
+    """
+    Histogram with fixed bins and under- and overflow. Like in
+    numpy.histogram, the bins include their lower edge, the last bin
+    includes its upper edge as well.
+
+    Raises ValueError if the bin edges are not increasing.
+
+    :param edges: bin edges
+    :type edges: list or tuple or numpy.ndarray
+    :raises: ValueError
+    """
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+
+        widths = np.diff(self.edges)
+        if self.edges.ndim != 1 or len(widths) < 1 or (widths <= 0).any():
+            raise ValueError("bin edges have to be increasing")
+
+        self.counts = np.zeros(len(widths), dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+        # equal bins are found by arithmetic instead of a search
+        self._uniform = np.allclose(widths, widths[0])
+
+    @classmethod
+    def from_binning(cls, binning):
+        """
+        Create a histogram with equal bins.
+
+        :param binning: lower edge, upper edge and number of bin edges
+        :type binning: tuple
+        :returns: Histogram
+        """
+        return cls(np.linspace(binning[0], binning[1], binning[2]))
+
+    @property
+    def bins(self):
+        """
+        Number of bins.
+
+        :returns: int
+        """
+        return len(self.counts)
+
+    @property
+    def centers(self):
+        """
+        Centers of the bins.
+
+        :returns: numpy.ndarray
+        """
+        return 0.5 * (self.edges[1:] + self.edges[:-1])
+
+    @property
+    def widths(self):
+        """
+        Widths of the bins.
+
+        :returns: numpy.ndarray
+        """
+        return np.diff(self.edges)
+
+    @property
+    def entries(self):
+        """
+        Number of filled values including under- and overflow.
+
+        :returns: int
+        """
+        return int(self.counts.sum()) + self.underflow + self.overflow
+
+    def _find_bins(self, values):
+        """
+        Get the bin index of each value, -1 for underflow and the number of
+        bins for overflow.
+
+        :param values: finite values
+        :type values: numpy.ndarray
+        :returns: numpy.ndarray of int64
+        """
+        if self._uniform:
+            scale = self.bins / (self.edges[-1] - self.edges[0])
+            indices = np.floor((values - self.edges[0]) * scale)
+            indices = np.clip(indices, -1, self.bins).astype(np.int64)
+
+            # correct rounding errors at the bin edges
+            inside = np.flatnonzero((indices >= 0) & (indices < self.bins))
+            bins = indices[inside]
+            bins -= values[inside] < self.edges[bins]
+            bins += values[inside] >= self.edges[bins + 1]
+            indices[inside] = bins
+        else:
+            indices = np.searchsorted(self.edges, values, side="right") - 1
+
+        # the upper edge belongs to the last bin
+        indices[values == self.edges[-1]] = self.bins - 1
+        return indices
+
+    def fill(self, values):
+        """
+        Fill values into the histogram. Values which are not finite are
+        ignored.
+
+        :param values: values
+        :type values: list or numpy.ndarray or float
+        :returns: None
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+
+        if not len(values):
+            return
+
+        indices = self._find_bins(values)
+        underflow = indices < 0
+        overflow = indices >= self.bins
+
+        self.underflow += int(underflow.sum())
+        self.overflow += int(overflow.sum())
+        self.counts += np.bincount(indices[~(underflow | overflow)],
+                                   minlength=self.bins)
+
+    def reset(self):
+        """
+        Clear all counts.
+
+        :returns: None
+        """
+        self.counts[:] = 0
+        self.underflow = 0
+        self.overflow = 0
+
+    def copy(self):
+        """
+        Get a copy of the histogram.
+
+        :returns: Histogram
+        """
+        histogram = Histogram(self.edges)
+        histogram.counts[:] = self.counts
+        histogram.underflow = self.underflow
+        histogram.overflow = self.overflow
+        return histogram
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram with the same bins.
+
+        Raises ValueError if the bins differ.
+
+        :param other: histogram to add
+        :type other: Histogram
+        :returns: Histogram -- this histogram
+        :raises: ValueError
+        """
+        if (len(other.edges) != len(self.edges) or
+                not np.allclose(other.edges, self.edges)):
+            raise ValueError("histograms with different bins cannot " +
+                             "be merged")
+
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    def rebin(self, factor):
+        """
+        Get a histogram with 'factor' adjacent bins combined.
+
+        Raises ValueError if the number of bins is not a multiple of the
+        factor.
+
+        :param factor: number of bins to combine
+        :type factor: int
+        :returns: Histogram
+        :raises: ValueError
+        """
+        if factor < 1 or self.bins % factor:
+            raise ValueError("%d bins cannot be combined by %d" %
+                             (self.bins, factor))
+
+        histogram = Histogram(self.edges[::factor])
+        histogram.counts[:] = self.counts.reshape(-1, factor).sum(axis=1)
+        histogram.underflow = self.underflow
+        histogram.overflow = self.overflow
+        return histogram
+
+    def save(self, filename):
+        """
+        Save the histogram to a NumPy '.npz' file.
+
+        :param filename: path of the file
+        :type filename: str
+        :returns: None
+        """
+        with open(filename, "wb") as histogram_file:
+            np.savez(histogram_file, edges=self.edges, counts=self.counts,
+                     underflow=self.underflow, overflow=self.overflow)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a histogram saved with 'save'.
+
+        :param filename: path of the file
+        :type filename: str
+        :returns: Histogram
+        """
+        with np.load(filename) as data:
+            histogram = cls(data["edges"])
+            histogram.counts[:] = data["counts"]
+            histogram.underflow = int(data["underflow"])
+            histogram.overflow = int(data["overflow"])
+        return histogram
+
+    def __repr__(self):
+        return ("Histogram(bins=%d, range=(%g, %g), entries=%d, " +
+                "underflow=%d, overflow=%d)") % (
+                    self.bins, self.edges[0], self.edges[-1], self.entries,
+                    self.underflow, self.overflow)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Fill random values into a " +
+                                        "histogram and report the rate")
+    parser.add_argument("-n", "--values", dest="values", type=int,
+                        default=10000000, help="number of values")
+    parser.add_argument("-c", "--chunk", dest="chunk", type=int,
+                        default=1000, help="values filled at once")
+    args = parser.parse_args()
+
+    data = np.random.RandomState(0).exponential(2.197, args.values)
+    hist = Histogram.from_binning((0, 10, 21))
+
+    start = time.time()
+    for i in range(0, len(data), args.chunk):
+        hist.fill(data[i:i + args.chunk])
+    elapsed = time.time() - start
+
+    print(hist)
+    print("filled %d values in chunks of %d in %.2f s: %.0f values/s" %
+          (len(data), args.chunk, elapsed, len(data) / elapsed))
@@ -0,0 +1,284 @@
+"""
+Provides an online estimate of the muon lifetime which is updated with
+every decay instead of refitting the whole histogram.
+
+Decay times are filled into a fine histogram, which is a sufficient
+statistic for the fit up to the bin width. The lifetime and the fraction
+of flat background in the fit range are estimated by maximizing the
+likelihood of a truncated exponential plus constant background. Every
+update performs one Fisher scoring step starting from the previous
+estimate, so the cost per decay only depends on the number of bins and
+not on the number of recorded decays.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import logging
+import time
+
+import numpy as np
+
+# minimum number of decays in the fit range before estimating
+MIN_DECAYS = 10
+
+# upper limit for the fraction of background
+MAX_BACKGROUND_FRACTION = 0.99
+
+# scoring steps when starting from the mean decay time
+STARTUP_ITERATIONS = 10
+
+
+class OnlineLifetimeEstimator(object):
+    """
+    Streaming maximum likelihood estimate of the muon lifetime.
+
+    The histogram spans 'histrange' so the fit range can be changed at any
+    time without losing decays. The fit range is rounded to the bin
+    edges.
+
+    :param fitrange: lower and upper limit of the decay times used in the
+                     estimate
+    :type fitrange: tuple
+    :param histrange: lower and upper limit of the recorded decay times
+    :type histrange: tuple
+    :param bins: number of bins of the histogram
+    :type bins: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, fitrange=(1.5, 10.), histrange=(0., 20.), bins=400,
+                 logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+
+        self.histrange = (float(histrange[0]), float(histrange[1]))
+        self.edges = np.linspace(self.histrange[0], self.histrange[1],
+                                 bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self._scale = bins / (self.histrange[1] - self.histrange[0])
+
+        self.lifetime = float("nan")
+        self.background_fraction = 0.
+        self.covariance = None
+
+        self.fitrange = None
+        self._first = 0
+        self._last = bins
+        self._total = 0
+        self._sum = 0.
+        self.set_fit_range(fitrange)
+
+    def set_fit_range(self, fitrange):
+        """
+        Change the fit range. The estimate restarts from the mean decay
+        time in the new range.
+
+        :param fitrange: lower and upper limit of the decay times
+        :type fitrange: tuple
+        :returns: None
+        """
+        first = int(np.clip(np.round((fitrange[0] - self.histrange[0]) *
+                                     self._scale), 0, len(self.counts)))
+        last = int(np.clip(np.round((fitrange[1] - self.histrange[0]) *
+                                    self._scale), first, len(self.counts)))
+
+        self._first, self._last = first, last
+        self.fitrange = (self.edges[first], self.edges[last])
+
+        counts = self.counts[first:last]
+        centers = 0.5 * (self.edges[first:last] +
+                         self.edges[first + 1:last + 1])
+        self._total = int(counts.sum())
+        self._sum = float(np.dot(counts, centers - self.fitrange[0]))
+
+        self.lifetime = float("nan")
+        self.background_fraction = 0.
+        self.covariance = None
+        self.update()
+
+    def reset(self):
+        """
+        Forget all decays.
+
+        :returns: None
+        """
+        self.counts[:] = 0
+        self.set_fit_range(self.fitrange)
+
+    @property
+    def decays(self):
+        """
+        Number of decays in the fit range.
+
+        :returns: int
+        """
+        return self._total
+
+    @property
+    def lifetime_error(self):
+        """
+        Standard error of the lifetime, nan if there is no estimate.
+
+        :returns: float
+        """
+        if self.covariance is None:
+            return float("nan")
+        return float(np.sqrt(abs(self.covariance[0, 0])))
+
+    def add(self, decay_time, update=True):
+        """
+        Record a decay and update the estimate.
+
+        :param decay_time: decay time
+        :type decay_time: float
+        :param update: update the estimate
+        :type update: bool
+        :returns: bool -- True if the decay is within the fit range
+        """
+        index = int(np.floor((decay_time - self.histrange[0]) * self._scale))
+
+        if index < 0 or index >= len(self.counts):
+            return False
+
+        self.counts[index] += 1
+
+        if not self._first <= index < self._last:
+            return False
+
+        self._total += 1
+        self._sum += (0.5 * (self.edges[index] + self.edges[index + 1]) -
+                      self.fitrange[0])
+
+        if update:
+            self.update()
+        return True
+
+    def add_many(self, decay_times, update=True):
+        """
+        Record several decays and update the estimate once.
+
+        :param decay_times: decay times
+        :type decay_times: iterable of float
+        :param update: update the estimate
+        :type update: bool
+        :returns: int -- number of decays within the fit range
+        """
+        added = sum([self.add(decay_time, update=False)
+                     for decay_time in decay_times])
+        if update and added:
+            self.update()
+        return added
+
+    def _probabilities(self, lifetime, background_fraction):
+        """
+        Get the probability of each bin in the fit range and its
+        derivatives with respect to the lifetime and the background
+        fraction.
+
+        :param lifetime: lifetime
+        :type lifetime: float
+        :param background_fraction: fraction of background
+        :type background_fraction: float
+        :returns: tuple of numpy.ndarray
+        """
+        edges = self.edges[self._first:self._last + 1] - self.fitrange[0]
+        exp = np.exp(-edges / lifetime)
+        d_exp = edges * exp / lifetime ** 2
+
+        signal = exp[:-1] - exp[1:]
+        d_signal = d_exp[:-1] - d_exp[1:]
+        norm = exp[0] - exp[-1]
+        d_norm = d_exp[0] - d_exp[-1]
+
+        shape = signal / norm
+        d_shape = (d_signal - shape * d_norm) / norm
+        flat = np.diff(edges) / (edges[-1] - edges[0])
+
+        probabilities = ((1. - background_fraction) * shape +
+                         background_fraction * flat)
+        return (probabilities, (1. - background_fraction) * d_shape,
+                flat - shape)
+
+    def update(self, iterations=1):
+        """
+        Improve the estimate by Fisher scoring steps, starting from the
+        previous estimate.
+
+        :param iterations: number of steps
+        :type iterations: int
+        :returns: None
+        """
+        if self._total < MIN_DECAYS or self._last - self._first < 3:
+            return
+
+        if not np.isfinite(self.lifetime):
+            # the mean neglects truncation and background but is close
+            self.lifetime = max(self._sum / self._total,
+                                1. / self._scale)
+            self.background_fraction = 0.
+            iterations = max(iterations, STARTUP_ITERATIONS)
+
+        counts = self.counts[self._first:self._last]
+
+        for _ in range(iterations):
+            probabilities, d_lifetime, d_background = self._probabilities(
+                self.lifetime, self.background_fraction)
+            probabilities = np.maximum(probabilities, 1e-300)
+
+            derivatives = np.vstack((d_lifetime, d_background))
+            score = np.dot(derivatives, counts / probabilities)
+            information = self._total * np.dot(
+                derivatives / probabilities, derivatives.T)
+
+            try:
+                covariance = np.linalg.inv(information)
+            except np.linalg.LinAlgError:
+                self.logger.debug("Singular information matrix, keeping " +
+                                  "lifetime estimate")
+                return
+
+            step = np.dot(covariance, score)
+            self.lifetime = float(np.clip(self.lifetime + step[0],
+                                          0.5 * self.lifetime,
+                                          2. * self.lifetime))
+            self.background_fraction = float(np.clip(
+                self.background_fraction + step[1], 0.,
+                MAX_BACKGROUND_FRACTION))
+            self.covariance = covariance
+
+    def __repr__(self):
+        return ("OnlineLifetimeEstimator(lifetime=%.4g+-%.2g, " +
+                "background_fraction=%.3g, decays=%d)") % (
+                    self.lifetime, self.lifetime_error,
+                    self.background_fraction, self.decays)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Estimate the lifetime of " +
+                                        "simulated decays online and " +
+                                        "report the update rate")
+    parser.add_argument("-n", "--decays", dest="decays", type=int,
+                        default=100000, help="number of decays")
+    parser.add_argument("-t", "--lifetime", dest="lifetime", type=float,
+                        default=2.197, help="true lifetime")
+    parser.add_argument("-b", "--background", dest="background", type=float,
+                        default=0.1, help="fraction of flat background")
+    args = parser.parse_args()
+
+    random = np.random.RandomState(0)
+    n_background = int(args.background * args.decays)
+    times = np.concatenate((
+        random.exponential(args.lifetime, args.decays - n_background),
+        random.uniform(0., 20., n_background)))
+    random.shuffle(times)
+
+    estimator = OnlineLifetimeEstimator()
+    start = time.time()
+    for decay_time in times:
+        estimator.add(decay_time)
+    elapsed = time.time() - start
+
+    print(estimator)
+    print("%d updates in %.2f s: %.1f us per decay" %
+          (len(times), elapsed, 1e6 * elapsed / len(times)))
@@ -0,0 +1,496 @@
+"""
+Provides a single pass offline analysis of RAW files.
+
+Files are read in chunks of bytes, trigger lines are found with the
+vectorized decoder and handed to the pulse extractor, which builds the
+events. Every event is passed to each of the selected analyses, so any
+mix of analyses takes one pass over the data with constant memory.
+"""
+from __future__ import print_function
+import abc
+from collections import OrderedDict
+from future.utils import with_metaclass
+import logging
+import os
+
+import numpy as np
+
+from muonic.analysis.analyzer import PulseExtractor, DecayTriggerThorough
+from muonic.analysis.analyzer import VelocityTrigger
+from muonic.analysis.histogram import Histogram
+from muonic.daq.decoder import find_lines, decode_lines, gps_times
+from muonic.util import iter_line_chunks
+
+# bytes read from a file at once
+CHUNK_SIZE = 1 << 22
+
+# channels of the detector
+CHANNELS = 4
+
+# longer times between triggers in seconds are pauses or jumps of the
+# trigger time and not counted as intervals
+MAX_TRIGGER_INTERVAL = 60.
+
+# values collected before they are filled into a histogram at once
+FILL_BATCH = 10000
+
+
+def _extract_events(chunk, extractor, logger):
+    """
+    Run the pulse extraction on the trigger lines in a buffer. The pulses
+    are returned together with the GPS time of the trigger line which
+    completed them, i.e. the start of the next event.
+
+    :param chunk: buffer with complete lines
+    :type chunk: bytes
+    :param extractor: pulse extractor of the file
+    :type extractor: PulseExtractor
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: generator of tuple of numpy.datetime64 and tuple
+    """
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    starts, ends = find_lines(data)
+    decoded = decode_lines(data, starts, ends)
+    times = gps_times(data, starts, decoded)
+
+    for i in np.flatnonzero(decoded["trigger_line"]).tolist():
+        line = chunk[starts[i]:ends[i]].decode("ascii")
+        try:
+            pulses = extractor.extract(line)
+        except (ValueError, IndexError):
+            logger.debug("Unable to extract pulses from line '%s'" % line)
+            continue
+        if pulses is not None:
+            yield times[i], pulses
+
+
+def iter_events(filenames, chunk_size=CHUNK_SIZE, logger=None,
+                with_gps_time=False):
+    """
+    Read the events from RAW files. Files may be compressed with gzip or
+    bzip2. Events are tuples of the trigger time and the pulses of each
+    channel as returned by PulseExtractor.extract. With GPS time, pairs
+    of the GPS time of the trigger line and the event are returned.
+
+    :param filenames: path or paths of the files
+    :type filenames: str or list of str
+    :param chunk_size: bytes read at once
+    :type chunk_size: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param with_gps_time: return the GPS time with each event
+    :type with_gps_time: bool
+    :returns: generator of tuple
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    if isinstance(filenames, str):
+        filenames = [filenames]
+
+    for filename in filenames:
+        logger.info("Analyzing %s" % filename)
+
+        # files are separate measurements, events do not continue
+        extractor = PulseExtractor(logger, None)
+        # the event before the first trigger is empty
+        first = True
+
+        for chunk in iter_line_chunks(filename, chunk_size):
+            for gps_time, pulses in _extract_events(chunk, extractor,
+                                                    logger):
+                if first:
+                    first = False
+                elif with_gps_time:
+                    yield trigger_gps_time, pulses
+                else:
+                    yield pulses
+                trigger_gps_time = gps_time
+
+        # the last event is not completed by a following trigger
+        pulses = extractor.flush()
+        if pulses is not None:
+            if with_gps_time:
+                yield trigger_gps_time, pulses
+            else:
+                yield pulses
+
+
+class OfflineAnalysis(with_metaclass(abc.ABCMeta, object)):
+    """
+    Base class of the analyses, which fill histograms from events. Values
+    are collected and filled in batches, since filling a histogram costs
+    about as much for one value as for thousands.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+    # name of the analysis on the command line
+    name = None
+
+    # lower edge, upper edge and number of bin edges
+    binning = None
+
+    # unit of the histogrammed values
+    unit = ""
+
+    def __init__(self, logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+        self.histograms = OrderedDict()
+        self._pending = {}
+
+    def add_histogram(self, name):
+        """
+        Add a histogram with the binning of the analysis.
+
+        :param name: name of the histogram
+        :type name: str
+        :returns: None
+        """
+        self.histograms[name] = Histogram.from_binning(self.binning)
+        self._pending[name] = []
+
+    def fill(self, name, values):
+        """
+        Collect values for a histogram.
+
+        :param name: name of the histogram
+        :type name: str
+        :param values: values
+        :type values: list
+        :returns: None
+        """
+        pending = self._pending[name]
+        pending.extend(values)
+        if len(pending) >= FILL_BATCH:
+            self.histograms[name].fill(pending)
+            del pending[:]
+
+    def flush(self):
+        """
+        Fill the collected values into the histograms.
+
+        :returns: None
+        """
+        for name, pending in self._pending.items():
+            if pending:
+                self.histograms[name].fill(pending)
+                del pending[:]
+
+    @abc.abstractmethod
+    def process(self, pulses):
+        """
+        Analyze an event.
+
+        :param pulses: trigger time and pulses of each channel
+        :type pulses: tuple
+        :returns: None
+        """
+        return
+
+    def summary(self):
+        """
+        Get a summary of the results.
+
+        :returns: list of str
+        """
+        self.flush()
+        lines = []
+        for name, histogram in self.histograms.items():
+            counts = histogram.counts
+            mean = np.nan
+            if counts.sum():
+                mean = np.average(histogram.centers, weights=counts)
+            lines.append("%s: %d entries, %d underflow, %d overflow, " %
+                         (name, counts.sum(), histogram.underflow,
+                          histogram.overflow) +
+                         "mean %.4g %s" % (mean, self.unit))
+        return lines
+
+    def save(self, directory):
+        """
+        Save the histograms to NumPy '.npz' files named after the
+        histograms.
+
+        :param directory: directory of the files
+        :type directory: str
+        :returns: list of str -- paths of the files
+        """
+        self.flush()
+        filenames = []
+        for name, histogram in self.histograms.items():
+            filename = os.path.join(directory, "%s.npz" % name)
+            histogram.save(filename)
+            filenames.append(filename)
+        return filenames
+
+
+class DecayAnalysis(OfflineAnalysis):
+    """
+    Decay times of muons stopping in the detector, triggered like in the
+    muon decay widget.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param single_channel: channel of the single pulse
+    :type single_channel: int
+    :param double_channel: channel of the double pulse
+    :type double_channel: int
+    :param veto_channel: veto channel
+    :type veto_channel: int
+    :param fitrange: lower and upper limit of the lifetime fit
+    :type fitrange: tuple
+    """
+    name = "decay"
+    binning = (0, 10, 21)
+    unit = "microseconds"
+
+    def __init__(self, logger=None, single_channel=0, double_channel=1,
+                 veto_channel=2, fitrange=(1.5, 10.)):
+        OfflineAnalysis.__init__(self, logger)
+        self.trigger = DecayTriggerThorough(self.logger)
+        # index 0 of the events is the trigger time
+        self.channels = (single_channel + 1, double_channel + 1,
+                         veto_channel + 1)
+        self.fitrange = fitrange
+        self.add_histogram("decay")
+
+    def process(self, pulses):
+        single, double, veto = self.channels
+        decay = self.trigger.trigger(pulses, single_channel=single,
+                                     double_channel=double,
+                                     veto_channel=veto)
+        if decay is not None:
+            self.fill("decay", [decay / 1000.])
+
+    def summary(self):
+        from muonic.analysis.fit import fit, POISSON
+
+        lines = OfflineAnalysis.summary(self)
+        histogram = self.histograms["decay"]
+        result = fit(histogram.counts, binning=self.binning,
+                     fitrange=self.fitrange, method=POISSON,
+                     logger=self.logger)
+        if result is not None and result.success:
+            lines.append("decay: lifetime %.3f +- %.3f %s" %
+                         (result.value, result.error, self.unit))
+        return lines
+
+
+class SinglesDecayAnalysis(OfflineAnalysis):
+    """
+    Decay times from a second pulse in the same channel, for each channel
+    on its own. This needs no coincidence and works with single paddles.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+    name = "singles-decay"
+    binning = (0, 10, 21)
+    unit = "microseconds"
+
+    def __init__(self, logger=None):
+        OfflineAnalysis.__init__(self, logger)
+        self.trigger = DecayTriggerThorough(self.logger)
+        self.names = ["singles_decay_ch%d" % channel
+                      for channel in range(CHANNELS)]
+        for name in self.names:
+            self.add_histogram(name)
+
+    def process(self, pulses):
+        # there is an artifact at the end of the trigger window
+        max_decay_time = self.trigger.trigger_window - 1000
+        for channel, name in enumerate(self.names):
+            channel_pulses = pulses[channel + 1]
+            if len(channel_pulses) < 2:
+                continue
+            # rising edges, falling edges might be virtual
+            decay = channel_pulses[-1][0] - channel_pulses[0][0]
+            if 0 < decay < max_decay_time:
+                self.fill(name, [decay / 1000.])
+
+
+class VelocityAnalysis(OfflineAnalysis):
+    """
+    Flight times between two channels, triggered like in the velocity
+    widget.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param upper_channel: upper channel
+    :type upper_channel: int
+    :param lower_channel: lower channel
+    :type lower_channel: int
+    """
+    name = "velocity"
+    binning = (0., 30, 25)
+    unit = "ns"
+
+    def __init__(self, logger=None, upper_channel=0, lower_channel=1):
+        OfflineAnalysis.__init__(self, logger)
+        self.trigger = VelocityTrigger(self.logger)
+        self.upper_channel = upper_channel + 1
+        self.lower_channel = lower_channel + 1
+        self.add_histogram("velocity")
+
+    def process(self, pulses):
+        flight_time = self.trigger.trigger(pulses,
+                                           upper_channel=self.upper_channel,
+                                           lower_channel=self.lower_channel)
+        if flight_time is not None and flight_time > 0:
+            self.fill("velocity", [flight_time])
+
+
+class DirectionAnalysis(OfflineAnalysis):
+    """
+    Direction of muons from the order of the first pulses in two
+    channels. A muon is downgoing if it hits the upper channel first.
+    Muons which hit both channels at the same time have no known
+    direction and are not used for the fraction of upgoing muons.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param upper_channel: upper channel
+    :type upper_channel: int
+    :param lower_channel: lower channel
+    :type lower_channel: int
+    """
+    name = "direction"
+    binning = (-50., 50., 41)
+    unit = "ns"
+
+    def __init__(self, logger=None, upper_channel=0, lower_channel=1):
+        OfflineAnalysis.__init__(self, logger)
+        self.upper_channel = upper_channel + 1
+        self.lower_channel = lower_channel + 1
+        self.downgoing = 0
+        self.upgoing = 0
+        self.simultaneous = 0
+        self.add_histogram("direction")
+
+    def process(self, pulses):
+        upper = pulses[self.upper_channel]
+        lower = pulses[self.lower_channel]
+        if not upper or not lower:
+            return
+
+        difference = lower[0][0] - upper[0][0]
+        if difference > 0:
+            self.downgoing += 1
+        elif difference < 0:
+            self.upgoing += 1
+        else:
+            self.simultaneous += 1
+        self.fill("direction", [difference])
+
+    def summary(self):
+        lines = OfflineAnalysis.summary(self)
+        total = self.upgoing + self.downgoing
+        if total or self.simultaneous:
+            fraction = np.nan
+            if total:
+                fraction = float(self.upgoing) / total
+            lines.append("direction: %d upgoing, %d downgoing, " %
+                         (self.upgoing, self.downgoing) +
+                         "%d simultaneous, " % self.simultaneous +
+                         "fraction of upgoing %.4f" % fraction)
+        return lines
+
+
+class PulseWidthAnalysis(OfflineAnalysis):
+    """
+    Widths of the pulses of each channel.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+    name = "pulse-width"
+    binning = (0., 100., 30)
+    unit = "ns"
+
+    def __init__(self, logger=None):
+        OfflineAnalysis.__init__(self, logger)
+        self.names = ["pulse_width_ch%d" % channel
+                      for channel in range(CHANNELS)]
+        for name in self.names:
+            self.add_histogram(name)
+
+    def process(self, pulses):
+        for channel, name in enumerate(self.names):
+            channel_pulses = pulses[channel + 1]
+            if channel_pulses:
+                self.fill(name, [fe - le for le, fe in channel_pulses])
+
+
+class TriggerIntervalAnalysis(OfflineAnalysis):
+    """
+    Time between subsequent triggers. The mean interval and the trigger
+    rate are calculated from all intervals including the overflow, but
+    without longer pauses and jumps of the trigger time.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+    name = "trigger-interval"
+    binning = (0., 500., 101)
+    unit = "ms"
+
+    def __init__(self, logger=None):
+        OfflineAnalysis.__init__(self, logger)
+        self.last_trigger_time = None
+        self.intervals = 0
+        self.total_time = 0.
+        self.add_histogram("trigger_interval")
+
+    def process(self, pulses):
+        trigger_time = pulses[0]
+        if self.last_trigger_time is not None:
+            interval = trigger_time - self.last_trigger_time
+            # the trigger time restarts at midnight
+            if 0 <= interval < MAX_TRIGGER_INTERVAL:
+                self.intervals += 1
+                self.total_time += interval
+                self.fill("trigger_interval", [1e3 * interval])
+        self.last_trigger_time = trigger_time
+
+    def summary(self):
+        lines = OfflineAnalysis.summary(self)
+        if self.intervals and self.total_time > 0:
+            lines.append("trigger-interval: mean %.4g ms, rate %.4g Hz" %
+                         (1e3 * self.total_time / self.intervals,
+                          self.intervals / self.total_time))
+        return lines
+
+
+# analyses by their name on the command line
+ANALYSES = OrderedDict([(analysis.name, analysis) for analysis in (
+    DecayAnalysis, SinglesDecayAnalysis, VelocityAnalysis,
+    DirectionAnalysis, PulseWidthAnalysis, TriggerIntervalAnalysis)])
+
+
+def analyze_files(filenames, analyses, chunk_size=CHUNK_SIZE, logger=None):
+    """
+    Run analyses over the events of RAW files in one pass.
+
+    :param filenames: path or paths of the files
+    :type filenames: str or list of str
+    :param analyses: analyses to run
+    :type analyses: list of OfflineAnalysis
+    :param chunk_size: bytes read at once
+    :type chunk_size: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: int -- number of events
+    """
+    events = 0
+    for pulses in iter_events(filenames, chunk_size, logger):
+        events += 1
+        for analysis in analyses:
+            analysis.process(pulses)
+
+    for analysis in analyses:
+        analysis.flush()
+    return events
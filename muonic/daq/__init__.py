@@ -1,10 +1,27 @@
 """
 Provide a connection to the QNet DAQ cards via python-serial. For software
 testing and development, (very) dumb DAQ card simulator is available.
+
+The connection, provider, archive and index classes are imported from their
+submodules when they are first used, so importing the package loads
+neither serial nor zmq nor NumPy.
 """
+from muonic.util.helpers import lazy_attributes
+
 from .exceptions import DAQIOError, DAQMissingDependencyError
-from .simulation import DAQSimulationConnection, DAQSimulationServer
-from .connection import DAQConnection, DAQServer
-from .provider import DAQClient, DAQProvider
 
-__all__ = ["exceptions", "simulation", "connection", "provider"]
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "DAQSimulationConnection": ".simulation",
+    "DAQSimulationServer": ".simulation",
+    "DAQConnection": ".connection",
+    "DAQServer": ".connection",
+    "DAQClient": ".provider",
+    "DAQProvider": ".provider",
+    "MultiDAQProvider": ".multi",
+    "ArchiveReader": ".archive",
+    "ArchiveWriter": ".archive",
+    "TimeIndex": ".index"
+})
+
+__all__ = ["exceptions", "simulation", "connection", "provider",
+           "multi"]
@@ -0,0 +1,522 @@
+"""
+Provides block compressed archives of RAW files with an index for random
+access.
+
+An archive is a sequence of independently compressed blocks of whole
+lines with a fixed uncompressed size. gzip archives are valid multi-member
+gzip files and can still be read sequentially by any tool. A sidecar index
+holds the byte offset, the first and last trigger count and the first and
+last GPS time of each block, so a time range is read by decompressing only
+the blocks which cover it. Blocks are decompressed in parallel threads,
+zlib and zstd release the GIL while decompressing.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+import logging
+import multiprocessing as mp
+import time
+import zlib
+
+import numpy as np
+
+from muonic.daq.decoder import find_lines, decode_lines, gps_times
+from muonic.daq.decoder import trim_lines
+from muonic.daq.exceptions import DAQMissingDependencyError
+from muonic.util import open_data_file
+
+# uncompressed size of a block in bytes
+BLOCK_SIZE = 1 << 20
+
+# compression of the blocks
+GZIP = "gzip"
+ZSTD = "zstd"
+COMPRESSIONS = (GZIP, ZSTD)
+
+# default compression levels
+DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3}
+
+# suffix of the index file
+INDEX_SUFFIX = ".idx"
+
+# zlib window bits for gzip members
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# blocks decompressed per thread at once
+BLOCKS_PER_THREAD = 4
+
+# a block of the archive
+BLOCK_DTYPE = np.dtype([("offset", np.int64),
+                        ("length", np.int64),
+                        ("size", np.int64),
+                        ("lines", np.int64),
+                        ("first_count", np.uint32),
+                        ("last_count", np.uint32),
+                        ("first_time", "datetime64[ms]"),
+                        ("last_time", "datetime64[ms]")])
+
+
+def _to_datetime64(value):
+    """
+    Convert a time to numpy.datetime64 with millisecond resolution.
+
+    :param value: time
+    :type value: datetime.datetime or numpy.datetime64 or str or None
+    :returns: numpy.datetime64 or None
+    """
+    if value is None:
+        return None
+    return np.datetime64(value, "ms")
+
+
+def _compress_function(compression, level):
+    """
+    Get a function which compresses a block.
+
+    Raises DAQMissingDependencyError if zstd is requested but the
+    zstandard package is not installed and ValueError for unknown
+    compressions.
+
+    :param compression: GZIP or ZSTD
+    :type compression: str
+    :param level: compression level
+    :type level: int
+    :returns: function
+    :raises: DAQMissingDependencyError, ValueError
+    """
+    if compression == GZIP:
+        def compress(data):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+            return compressor.compress(data) + compressor.flush()
+        return compress
+    elif compression == ZSTD:
+        try:
+            import zstandard
+        except ImportError:
+            raise DAQMissingDependencyError("no zstandard installed...")
+        return zstandard.ZstdCompressor(level=level).compress
+    raise ValueError("unknown compression '%s'" % compression)
+
+
+def _decompress_function(compression):
+    """
+    Get a function which decompresses a block.
+
+    Raises DAQMissingDependencyError if zstd is requested but the
+    zstandard package is not installed and ValueError for unknown
+    compressions.
+
+    :param compression: GZIP or ZSTD
+    :type compression: str
+    :returns: function
+    :raises: DAQMissingDependencyError, ValueError
+    """
+    if compression == GZIP:
+        return lambda data: zlib.decompress(data, GZIP_WBITS)
+    elif compression == ZSTD:
+        try:
+            import zstandard
+        except ImportError:
+            raise DAQMissingDependencyError("no zstandard installed...")
+        return zstandard.ZstdDecompressor().decompress
+    raise ValueError("unknown compression '%s'" % compression)
+
+
+def describe_block(data):
+    """
+    Get the number of lines and the first and last trigger count and GPS
+    time of a block. Counts and times of blocks without trigger lines are
+    zero and NaT.
+
+    :param data: block of complete lines
+    :type data: bytes
+    :returns: numpy.ndarray of BLOCK_DTYPE with one element, offset and
+              lengths are not set
+    """
+    block = np.zeros(1, dtype=BLOCK_DTYPE)
+    block["first_time"] = block["last_time"] = np.datetime64("NaT", "ms")
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    starts, ends = find_lines(buf)
+    decoded = decode_lines(buf, starts, ends)
+    block["lines"] = len(starts)
+    block["size"] = len(data)
+
+    triggers = np.flatnonzero(decoded["trigger_line"])
+    if len(triggers):
+        block["first_count"] = decoded["counter"][triggers[0]]
+        block["last_count"] = decoded["counter"][triggers[-1]]
+
+    times = gps_times(buf, starts, decoded)
+    times = times[~np.isnat(times)]
+    if len(times):
+        block["first_time"] = times[0]
+        block["last_time"] = times[-1]
+    return block
+
+
+def load_index(filename):
+    """
+    Load the index of an archive.
+
+    :param filename: path of the archive
+    :type filename: str
+    :returns: tuple of numpy.ndarray of BLOCK_DTYPE and the compression
+    """
+    with np.load(filename + INDEX_SUFFIX) as index:
+        return index["blocks"], str(index["compression"])
+
+
+class ArchiveWriter(object):
+    """
+    Write DAQ output to a block compressed archive. Data is collected
+    until a block is full, the block ends at the last complete line. The
+    index is written when the archive is closed.
+
+    Raises DAQMissingDependencyError if zstd is requested but the
+    zstandard package is not installed and ValueError for unknown
+    compressions.
+
+    :param filename: path of the archive
+    :type filename: str
+    :param block_size: uncompressed size of the blocks in bytes
+    :type block_size: int
+    :param compression: GZIP or ZSTD
+    :type compression: str
+    :param level: compression level, the default of the compression if
+                  None
+    :type level: int or None
+    :param logger: logger object
+    :type logger: logging.Logger
+    :raises: DAQMissingDependencyError, ValueError
+    """
+
+    def __init__(self, filename, block_size=BLOCK_SIZE, compression=GZIP,
+                 level=None, logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+
+        if level is None:
+            level = DEFAULT_LEVELS.get(compression)
+
+        self.filename = filename
+        self.block_size = block_size
+        self.compression = compression
+        self._compress = _compress_function(compression, level)
+        self._file = open(filename, "wb")
+        self._pending = []
+        self._pending_size = 0
+        self._offset = 0
+        self.blocks = []
+
+    def write(self, data):
+        """
+        Write DAQ output.
+
+        :param data: DAQ output, may end within a line
+        :type data: bytes
+        :returns: None
+        """
+        self._pending.append(data)
+        self._pending_size += len(data)
+
+        if self._pending_size < self.block_size:
+            return
+
+        data = b"".join(self._pending)
+        start = 0
+        while len(data) - start >= self.block_size:
+            end = data.rfind(b"\n", start, start + self.block_size) + 1
+            if end <= start:
+                # a line longer than a block
+                end = data.find(b"\n", start + self.block_size) + 1
+                if not end:
+                    break
+            self._write_block(data[start:end])
+            start = end
+
+        self._pending = [data[start:]]
+        self._pending_size = len(data) - start
+
+    def _write_block(self, data):
+        """
+        Compress a block and add it to the index.
+
+        :param data: complete lines
+        :type data: bytes
+        :returns: None
+        """
+        compressed = self._compress(data)
+        block = describe_block(data)
+        block["offset"] = self._offset
+        block["length"] = len(compressed)
+
+        self._file.write(compressed)
+        self._offset += len(compressed)
+        self.blocks.append(block)
+
+    @property
+    def index(self):
+        """
+        The blocks written so far.
+
+        :returns: numpy.ndarray of BLOCK_DTYPE
+        """
+        if not self.blocks:
+            return np.zeros(0, dtype=BLOCK_DTYPE)
+        return np.concatenate(self.blocks)
+
+    def close(self):
+        """
+        Write the remaining data and the index and close the archive.
+
+        :returns: None
+        """
+        if self._file is None:
+            return
+
+        data = b"".join(self._pending)
+        if data:
+            self._write_block(data)
+        self._pending = []
+        self._pending_size = 0
+        self._file.close()
+        self._file = None
+
+        blocks = self.index
+        with open(self.filename + INDEX_SUFFIX, "wb") as index_file:
+            np.savez(index_file, blocks=blocks, compression=self.compression)
+
+        self.logger.debug("Wrote %d blocks to %s" %
+                          (len(blocks), self.filename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def create_archive(filenames, archive, block_size=BLOCK_SIZE,
+                   compression=GZIP, level=None, logger=None):
+    """
+    Create a block compressed archive of RAW files. The input files may
+    be compressed with gzip or bzip2.
+
+    :param filenames: path or paths of the RAW files
+    :type filenames: str or list of str
+    :param archive: path of the archive
+    :type archive: str
+    :param block_size: uncompressed size of the blocks in bytes
+    :type block_size: int
+    :param compression: GZIP or ZSTD
+    :type compression: str
+    :param level: compression level, the default of the compression if
+                  None
+    :type level: int or None
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: numpy.ndarray of BLOCK_DTYPE -- the index
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+
+    with ArchiveWriter(archive, block_size, compression, level,
+                       logger) as writer:
+        for filename in filenames:
+            text_file = open_data_file(filename)
+            chunk = b""
+            try:
+                while True:
+                    last, chunk = chunk, text_file.buffer.read(block_size)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+            finally:
+                text_file.close()
+            # lines do not continue in the next file
+            if last and not last.endswith(b"\n"):
+                writer.write(b"\n")
+    return writer.index
+
+
+class ArchiveReader(object):
+    """
+    Random access to a block compressed archive by its index.
+
+    Raises IOError if the index does not exist.
+
+    :param filename: path of the archive
+    :type filename: str
+    :param threads: number of threads for decompression, one per CPU if
+                    None
+    :type threads: int or None
+    :param logger: logger object
+    :type logger: logging.Logger
+    :raises: IOError
+    """
+
+    def __init__(self, filename, threads=None, logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+
+        self.filename = filename
+        self.blocks, self.compression = load_index(filename)
+        self._decompress = _decompress_function(self.compression)
+
+        if threads is None:
+            threads = mp.cpu_count()
+        self.threads = max(1, threads)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def select(self, start=None, end=None):
+        """
+        Get the indices of the blocks with GPS times in a time range.
+        Blocks without GPS times are only selected if no range is given.
+
+        :param start: start of the range, open if None
+        :type start: datetime.datetime or numpy.datetime64 or str or None
+        :param end: end of the range, included, open if None
+        :type end: datetime.datetime or numpy.datetime64 or str or None
+        :returns: numpy.ndarray of int
+        """
+        start, end = _to_datetime64(start), _to_datetime64(end)
+        if start is None and end is None:
+            return np.arange(len(self.blocks))
+
+        selected = ~np.isnat(self.blocks["first_time"])
+        if start is not None:
+            selected &= self.blocks["last_time"] >= start
+        if end is not None:
+            selected &= self.blocks["first_time"] <= end
+        return np.flatnonzero(selected)
+
+    def _read_compressed(self, archive_file, block):
+        """
+        Read a compressed block.
+
+        :param archive_file: the opened archive
+        :type archive_file: file
+        :param block: index of the block
+        :type block: int
+        :returns: bytes
+        """
+        archive_file.seek(int(self.blocks["offset"][block]))
+        return archive_file.read(int(self.blocks["length"][block]))
+
+    def read_block(self, block):
+        """
+        Read and decompress a block.
+
+        :param block: index of the block
+        :type block: int
+        :returns: bytes
+        """
+        with open(self.filename, "rb") as archive_file:
+            return self._decompress(self._read_compressed(archive_file,
+                                                          block))
+
+    def iter_blocks(self, blocks):
+        """
+        Decompress blocks in parallel threads and yield them in order.
+
+        :param blocks: indices of the blocks
+        :type blocks: list or numpy.ndarray of int
+        :returns: generator of bytes
+        """
+        batch = self.threads * BLOCKS_PER_THREAD
+        pool = ThreadPool(self.threads) if self.threads > 1 else None
+
+        try:
+            with open(self.filename, "rb") as archive_file:
+                for i in range(0, len(blocks), batch):
+                    compressed = [self._read_compressed(archive_file, block)
+                                  for block in blocks[i:i + batch]]
+                    if pool is None:
+                        decompressed = [self._decompress(data)
+                                        for data in compressed]
+                    else:
+                        decompressed = pool.map(self._decompress, compressed)
+                    for data in decompressed:
+                        yield data
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def read(self, start=None, end=None):
+        """
+        Read the lines in a time range, from the first trigger line at or
+        after the start to the last trigger line at or before the end.
+        Only the blocks covering the range are decompressed.
+
+        :param start: start of the range, open if None
+        :type start: datetime.datetime or numpy.datetime64 or str or None
+        :param end: end of the range, included, open if None
+        :type end: datetime.datetime or numpy.datetime64 or str or None
+        :returns: bytes
+        """
+        blocks = self.select(start, end)
+        data = list(self.iter_blocks(blocks))
+        if not data:
+            return b""
+
+        start, end = _to_datetime64(start), _to_datetime64(end)
+        data[0] = trim_lines(data[0], start, None)
+        data[-1] = trim_lines(data[-1], None, end)
+        return b"".join(data)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Create a block compressed archive " +
+                                        "of RAW files and compare reading a " +
+                                        "time range with reading the whole " +
+                                        "archive")
+    parser.add_argument("filenames", nargs="+",
+                        help="RAW files, may be compressed")
+    parser.add_argument("-o", "--output", dest="output", required=True,
+                        help="path of the archive")
+    parser.add_argument("-c", "--compression", dest="compression",
+                        choices=COMPRESSIONS, default=GZIP,
+                        help="compression of the blocks (default gzip)")
+    parser.add_argument("-b", "--block-size", dest="block_size", type=int,
+                        default=BLOCK_SIZE, help="uncompressed size of the " +
+                                                 "blocks in bytes")
+    parser.add_argument("-m", "--minutes", dest="minutes", type=float,
+                        default=5., help="length of the time range read " +
+                                         "from the middle of the archive")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    start_time = time.time()
+    index = create_archive(args.filenames, args.output, args.block_size,
+                           args.compression)
+    elapsed = time.time() - start_time
+    size, length = index["size"].sum(), index["length"].sum()
+    print("archived %d bytes in %d blocks in %.2f s, compressed to %.1f %%" %
+          (size, len(index), elapsed, 100. * length / max(size, 1)))
+
+    reader = ArchiveReader(args.output)
+    known = index[~np.isnat(index["first_time"])]
+    if not len(known):
+        raise SystemExit("no GPS times in the archive")
+
+    middle = known["first_time"][len(known) // 2]
+    delta = np.timedelta64(int(60e3 * args.minutes), "ms")
+
+    start_time = time.time()
+    selection = reader.read(middle, middle + delta)
+    elapsed = time.time() - start_time
+    print("read %d bytes from %s to %s in %.3f s" %
+          (len(selection), middle, middle + delta, elapsed))
+
+    start_time = time.time()
+    total = sum([len(block) for block in reader.iter_blocks(
+        np.arange(len(reader)))])
+    print("read all %d bytes in %.3f s with %d threads" %
+          (total, time.time() - start_time, reader.threads))
@@ -0,0 +1,130 @@
+"""
+Provides the batching of lines read from the DAQ card. The reader process
+hands over all lines read in one go as a batch together with a sequence
+number and a monotonic receipt timestamp, so that the consumer can measure
+the queue latency, detect lost batches and stamp events with the time they
+were actually received.
+"""
+from __future__ import print_function
+from collections import deque
+import logging
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # python 2 has no monotonic clock in the standard library
+    monotonic = time.time
+
+
+class BatchWriter(object):
+    """
+    Puts batches of lines into the outgoing queue of the reader process.
+    Each batch is a tuple of the sequence number, the monotonic receipt
+    time and the list of items.
+
+    :param out_queue: queue for outgoing data
+    :type out_queue: multiprocessing.Queue
+    """
+
+    def __init__(self, out_queue):
+        self.out_queue = out_queue
+        self.sequence = 0
+
+    def put(self, items, receipt_time=None):
+        """
+        Put a batch of items into the outgoing queue. Empty batches are
+        dropped without consuming a sequence number.
+
+        :param items: lines or decoded events read from the DAQ
+        :type items: list
+        :param receipt_time: monotonic time the items were read, defaults
+                             to now
+        :type receipt_time: float
+        :returns: None
+        """
+        if not items:
+            return
+
+        if receipt_time is None:
+            receipt_time = monotonic()
+
+        self.out_queue.put((self.sequence, receipt_time, items))
+        self.sequence += 1
+
+
+class BatchReader(object):
+    """
+    Unpacks batches received from the reader process and keeps track of
+    sequence gaps and queue latency.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+
+        self.pending = deque()
+        self.next_sequence = 0
+        self.lost_batches = 0
+        self.latency = 0.
+        self.max_latency = 0.
+        self.receipt_time = None
+
+        # offset to convert monotonic receipt times to wall clock times
+        self._wall_offset = time.time() - monotonic()
+
+    def feed(self, batch):
+        """
+        Unpack a batch and append its items to the pending items.
+
+        :param batch: batch as put by BatchWriter
+        :type batch: tuple
+        :returns: None
+        """
+        sequence, receipt_time, items = batch
+
+        if sequence > self.next_sequence:
+            lost = sequence - self.next_sequence
+            self.lost_batches += lost
+            self.logger.warning("Lost %d batch(es) of DAQ lines before " %
+                                lost + "batch %d" % sequence)
+        self.next_sequence = sequence + 1
+
+        self.latency = monotonic() - receipt_time
+        self.max_latency = max(self.max_latency, self.latency)
+
+        self.pending.extend([(item, receipt_time) for item in items])
+
+    def pop(self):
+        """
+        Get the next pending item and remember its receipt time.
+
+        Raises IndexError if no items are pending.
+
+        :returns: str or tuple
+        :raises: IndexError
+        """
+        item, self.receipt_time = self.pending.popleft()
+        return item
+
+    def wall_time(self, receipt_time=None):
+        """
+        Convert a monotonic receipt time to seconds since the epoch.
+        Defaults to the receipt time of the last popped item.
+
+        :param receipt_time: monotonic receipt time
+        :type receipt_time: float
+        :returns: float or None
+        """
+        if receipt_time is None:
+            receipt_time = self.receipt_time
+        if receipt_time is None:
+            return None
+        return receipt_time + self._wall_offset
+
+    def __len__(self):
+        return len(self.pending)
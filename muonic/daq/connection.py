@@ -12,13 +12,9 @@ import serial
 import subprocess
 from time import sleep
 
-try:
-    import zmq
-except ImportError:
-    # DAQMissingDependencyError will be raised when trying to use zmq
-    pass
-
 from muonic.daq import DAQMissingDependencyError
+from muonic.daq.batch import BatchWriter, monotonic
+from muonic.daq.reconnect import CommandJournal, ReconnectManager
 
 
 class BaseDAQConnection(with_metaclass(abc.ABCMeta, object)):
@@ -27,62 +23,98 @@ class BaseDAQConnection(with_metaclass(abc.ABCMeta, object)):
 
     Raises SystemError if serial connection cannot be established.
 
+    The device is looked up with 'which_tty_daq' unless it is given
+    explicitly or by the environment variable MUONIC_DAQ_DEVICE.
+
     :param logger: logger object
     :type logger: logging.Logger
+    :param device: path of the tty device, e.g. of a virtual DAQ card
+    :type device: str
     :raises: SystemError
     """
+    DEVICE_ENV_VARIABLE = "MUONIC_DAQ_DEVICE"
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, device=None):
         if logger is None:
             logger = logging.getLogger()
         self.logger = logger
         self.running = 1
 
+        if device is None:
+            device = os.getenv(self.DEVICE_ENV_VARIABLE)
+        self.device = device
+
         try:
             self.serial_port = self.get_serial_port()
         except serial.SerialException as e:
-            self.logger.fatal("SerialException thrown! Value: %s" % e.message)
+            self.logger.fatal("SerialException thrown! Value: %s" % str(e))
             raise SystemError(e)
 
-    def get_serial_port(self):
+    def find_device(self):
         """
         Check out which device (/dev/tty) is used for DAQ communication.
+        If a device is configured, device discovery is skipped.
 
         Raises OSError if binary 'which_tty_daq' cannot be found.
 
-        :returns: serial.Serial -- serial connection port
+        :returns: str -- path of the device
         :raises: OSError
         """
-        connected = False
-        serial_port = None
+        if self.device is not None:
+            return self.device
 
         def get_dev_path(script):
             tty = subprocess.Popen(
                     [script], stdout=subprocess.PIPE).communicate()[0]
-            return "/dev/%s" % tty.rstrip('\n')
+            return "/dev/%s" % tty.decode("ascii").rstrip('\n')
 
-        while not connected:
-            try:
-                dev = get_dev_path("which_tty_daq")
-            except OSError:
-                # try using package script ../../bin/which_tty_daq
-                which_tty_daq = os.path.abspath(
-                        os.path.join(os.path.dirname(__file__), os.pardir,
-                                     os.pardir, 'bin', 'which_tty_daq'))
+        try:
+            return get_dev_path("which_tty_daq")
+        except OSError:
+            # try using package script ../../bin/which_tty_daq
+            which_tty_daq = os.path.abspath(
+                    os.path.join(os.path.dirname(__file__), os.pardir,
+                                 os.pardir, 'bin', 'which_tty_daq'))
+
+            if not os.path.exists(which_tty_daq):
+                raise OSError("Can not find binary which_tty_daq")
+
+            return get_dev_path(which_tty_daq)
+
+    def open_serial_port(self):
+        """
+        Try once to open the serial port of the DAQ card.
+
+        Raises serial.SerialException if the port cannot be opened and
+        OSError if the device cannot be found.
+
+        :returns: serial.Serial -- serial connection port
+        :raises: serial.SerialException, OSError
+        """
+        dev = self.find_device()
 
-                if not os.path.exists(which_tty_daq):
-                    raise OSError("Can not find binary which_tty_daq")
+        self.logger.info("Daq found at %s", dev)
+        self.logger.info("trying to connect...")
 
-                dev = get_dev_path(which_tty_daq)
+        return serial.Serial(port=dev, baudrate=115200, bytesize=8,
+                             parity='N', stopbits=1, timeout=0.5,
+                             xonxoff=True)
 
-            self.logger.info("Daq found at %s", dev)
-            self.logger.info("trying to connect...")
+    def get_serial_port(self):
+        """
+        Open the serial port of the DAQ card. Retries every 5 seconds until
+        the connection is established.
+
+        Raises OSError if binary 'which_tty_daq' cannot be found.
+
+        :returns: serial.Serial -- serial connection port
+        :raises: OSError
+        """
+        serial_port = None
 
+        while serial_port is None:
             try:
-                serial_port = serial.Serial(port=dev, baudrate=115200,
-                                            bytesize=8, parity='N', stopbits=1,
-                                            timeout=0.5, xonxoff=True)
-                connected = True
+                serial_port = self.open_serial_port()
             except serial.SerialException as e:
                 self.logger.error(e)
                 self.logger.error("Waiting 5 seconds")
@@ -117,16 +149,67 @@ class DAQConnection(BaseDAQConnection):
 
     :param in_queue: queue for incoming data
     :type in_queue: multiprocessing.Queue
-    :param out_queue: queue for outgoing data
+    :param out_queue: queue for outgoing batches of lines, see
+                      muonic.daq.batch.BatchWriter
     :type out_queue: multiprocessing.Queue
     :param logger: logger object
     :type logger: logging.Logger
+    :param parser: parser to validate and decode lines before they are
+                   put into the outgoing queue
+    :type parser: muonic.daq.parser.DAQLineParser
+    :param device: path of the tty device
+    :type device: str
+    :param journal_queue: queue with configuration commands to replay after
+                          a reconnect
+    :type journal_queue: multiprocessing.Queue
+    :param downtime: shared value to accumulate the downtime in seconds
+    :type downtime: multiprocessing.Value
     """
 
-    def __init__(self, in_queue, out_queue, logger=None):
-        BaseDAQConnection.__init__(self, logger)
+    # maximum number of lines per batch, keeps latency bounded at high rates
+    MAX_BATCH_SIZE = 1000
+
+    def __init__(self, in_queue, out_queue, logger=None, parser=None,
+                 device=None, journal_queue=None, downtime=None):
+        BaseDAQConnection.__init__(self, logger, device)
         self.in_queue = in_queue
         self.out_queue = out_queue
+        self.batch_writer = BatchWriter(out_queue)
+        self.parser = parser
+        self.journal_queue = journal_queue
+        self.journal = CommandJournal()
+        self.reconnect_manager = ReconnectManager(
+                self.open_serial_port, self.logger, self.journal, downtime)
+
+    def _update_journal(self):
+        """
+        Record configuration commands sent to the DAQ in the journal.
+
+        :returns: None
+        """
+        if self.journal_queue is None:
+            return
+
+        while True:
+            try:
+                self.journal.record(self.journal_queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def _put(self, lines, receipt_time=None):
+        """
+        Put a batch of lines read from the DAQ into the outgoing queue.
+
+        :param lines: DAQ messages
+        :type lines: list of str
+        :param receipt_time: monotonic time the lines were read
+        :type receipt_time: float
+        :returns: None
+        """
+        if self.parser is not None:
+            lines = [item for item in map(self.parser.parse, lines)
+                     if item is not None]
+        self.batch_writer.put(lines, receipt_time)
 
     def read(self):
         """
@@ -139,23 +222,32 @@ class DAQConnection(BaseDAQConnection):
         sleep_time = min_sleep_time  #seconds
 
         while self.running:
+            self._update_journal()
             try:
                 if self.serial_port.inWaiting():
+                    lines = []
+                    receipt_time = monotonic()
                     while self.serial_port.inWaiting():
-                        self.out_queue.put(self.serial_port.readline().strip())
+                        lines.append(self.serial_port.readline().decode(
+                                "ascii", "replace").strip())
+                        if len(lines) >= self.MAX_BATCH_SIZE:
+                            self._put(lines, receipt_time)
+                            lines = []
+                            receipt_time = monotonic()
+                    self._put(lines, receipt_time)
                     sleep_time = max(sleep_time / 2, min_sleep_time)
                 else:
                     sleep_time = min(1.5 * sleep_time, max_sleep_time)
                 sleep(sleep_time)
             except (IOError, OSError):
-                self.logger.error("IOError")
-                self.serial_port.close()
-                self.serial_port = self.get_serial_port()
-                # this has to be implemented in the future
-                # for now, we assume that the card does not forget
-                # its settings, only because the USB connection is
-                # broken
-                # self.setup_daq.setup(self.commandqueue)
+                self.logger.error("IOError, connection to DAQ lost")
+                # commands sent right before the dropout have to be replayed
+                self._update_journal()
+                self.serial_port, lines = self.reconnect_manager.reconnect(
+                        self.serial_port)
+                # the TL and DC replies let the consumers update their view
+                # of the card configuration
+                self._put(lines)
 
     def write(self):
         """
@@ -167,20 +259,42 @@ class DAQConnection(BaseDAQConnection):
             try:
                 while self.in_queue.qsize():
                     try:
-                        self.serial_port.write(str(self.in_queue.get(0)) +
-                                               "\r")
+                        self._write(self.in_queue.get(0))
                     except (queue.Empty, serial.SerialTimeoutException):
                         pass
             except NotImplementedError:
                 self.logger.debug("Running Mac version of muonic.")
                 while True:
                     try:
-                        self.serial_port.write(str(self.in_queue.get(
-                                timeout=0.01)) + "\r")
+                        self._write(self.in_queue.get(timeout=0.01))
                     except (queue.Empty, serial.SerialTimeoutException):
                         pass
             sleep(0.1)
 
+    def _write(self, command):
+        """
+        Write a command to the DAQ. If the connection is lost, the port is
+        reopened and the command is sent again. Replaying the configuration
+        is left to the reader.
+
+        :param command: DAQ command
+        :type command: str
+        :returns: None
+        """
+        data = (str(command) + "\r").encode("ascii")
+        try:
+            self.serial_port.write(data)
+        except serial.SerialTimeoutException:
+            raise
+        except (IOError, OSError):
+            self.logger.error("IOError while writing to DAQ")
+            # the writer has its own port, so it reconnects on its own
+            writer_reconnect = ReconnectManager(self.open_serial_port,
+                                                self.logger)
+            self.serial_port = writer_reconnect.reconnect(
+                    self.serial_port)[0]
+            self.serial_port.write(data)
+
 
 class DAQServer(BaseDAQConnection):
     """
@@ -194,16 +308,24 @@ class DAQServer(BaseDAQConnection):
     :type port: int
     :param logger: logger object
     :type logger: logging.Logger
+    :param device: path of the tty device
+    :type device: str
     :raises: DAQMissingDependencyError
     """
 
-    def __init__(self, address='127.0.0.1', port=5556, logger=None):
-        BaseDAQConnection.__init__(self, logger)
+    def __init__(self, address='127.0.0.1', port=5556, logger=None,
+                 device=None):
+        BaseDAQConnection.__init__(self, logger, device)
         try:
-            self.socket = zmq.Context().socket(zmq.PAIR)
-            self.socket.bind("tcp://%s:%d" % (address, port))
-        except NameError:
+            # zmq is only imported when it is used, it is optional
+            import zmq
+        except ImportError:
             raise DAQMissingDependencyError("no zmq installed...")
+        self.socket = zmq.Context().socket(zmq.PAIR)
+        self.socket.bind("tcp://%s:%d" % (address, port))
+        self.journal = CommandJournal()
+        self.reconnect_manager = ReconnectManager(
+                self.open_serial_port, self.logger, self.journal)
 
     def serve(self):
         """
@@ -228,20 +350,19 @@ class DAQServer(BaseDAQConnection):
             try:
                 if self.serial_port.inWaiting():
                     while self.serial_port.inWaiting():
-                        self.socket.send(self.serial_port.readline().strip())
+                        self.socket.send_string(
+                                self.serial_port.readline().decode(
+                                    "ascii", "replace").strip())
                     sleep_time = max(sleep_time / 2, min_sleep_time)
                 else:
                     sleep_time = min(1.5 * sleep_time, max_sleep_time)
                 sleep(sleep_time)
             except (IOError, OSError):
-                self.logger.error("IOError")
-                self.serial_port.close()
-                self.serial_port = self.get_serial_port()
-                # this has to be implemented in the future
-                # for now, we assume that the card does not forget
-                # its settings, only because the USB connection is
-                # broken
-                # self.setup_daq.setup(self.commandqueue)
+                self.logger.error("IOError, connection to DAQ lost")
+                self.serial_port, lines = self.reconnect_manager.reconnect(
+                        self.serial_port)
+                for line in lines:
+                    self.socket.send_string(line)
 
     def write(self):
         """
@@ -251,7 +372,8 @@ class DAQServer(BaseDAQConnection):
         """
         while self.running:
             msg = self.socket.recv_string()
-            self.serial_port.write(str(msg) + "\r")
+            self.journal.record(msg)
+            self.serial_port.write((str(msg) + "\r").encode("ascii"))
             sleep(0.1)
 
 
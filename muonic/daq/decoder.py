@@ -0,0 +1,258 @@
+"""
+Provides vectorized decoding of DAQ output held in a byte buffer, e.g. a
+memory mapped RAW file. Lines are located and the fields of trigger lines
+are decoded with NumPy in one go instead of splitting every line.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import time
+
+import numpy as np
+
+from muonic.analysis.analyzer import BIT5, BIT7
+from muonic.daq.generator import COUNTER_POS, DATE_POS, EDGE_POS
+from muonic.daq.generator import LINE_LENGTH, LINE_TEMPLATE, ONE_PPS_POS
+from muonic.daq.generator import TIME_POS
+
+# length of a trigger line without line ending
+TRIGGER_LINE_LENGTH = LINE_LENGTH - 1
+
+# columns which separate the fields of a trigger line
+SEPARATOR_POS = [i for i in range(TRIGGER_LINE_LENGTH)
+                 if LINE_TEMPLATE[i:i + 1] == b" "]
+
+# decoded fields of a line
+DECODED_DTYPE = np.dtype([("trigger_line", np.bool_),
+                          ("counter", np.uint32),
+                          ("edges", np.uint8, (8,)),
+                          ("one_pps", np.uint32)])
+
+# columns of 'YYYY-mm-ddTHH:MM:SS.fff' filled from the date 'ddmmyy' and
+# the time 'HHMMSS.fff' of a trigger line as (column, source, width), the
+# century is added
+_ISO_FROM_DATE = [(2, 4, 2), (5, 2, 2), (8, 0, 2)]
+_ISO_FROM_TIME = [(11, 0, 2), (14, 2, 2), (17, 4, 2), (19, 6, 4)]
+_ISO_TEMPLATE = np.frombuffer(b"20yy-mm-ddTHH:MM:SS.fff", dtype=np.uint8)
+
+# value of each hex digit, -1 for other characters
+_HEX_VALUES = np.full(256, -1, dtype=np.int16)
+for _i, _c in enumerate("0123456789ABCDEF"):
+    _HEX_VALUES[ord(_c)] = _i
+    _HEX_VALUES[ord(_c.lower())] = _i
+
+
+def find_lines(data):
+    """
+    Get the start and end offsets of the non-empty lines in a buffer. Line
+    endings are not part of the lines.
+
+    :param data: buffer
+    :type data: numpy.ndarray of uint8
+    :returns: tuple of numpy.ndarray
+    """
+    newlines = np.flatnonzero(data == ord("\n"))
+    starts = np.concatenate(([0], newlines + 1)).astype(np.int64)
+    ends = np.concatenate((newlines, [len(data)])).astype(np.int64)
+
+    # strip carriage returns
+    has_cr = ends > starts
+    has_cr[has_cr] = data[ends[has_cr] - 1] == ord("\r")
+    ends -= has_cr
+
+    non_empty = ends > starts
+    return starts[non_empty], ends[non_empty]
+
+
+def _decode_hex(chars):
+    """
+    Decode rows of hex digits.
+
+    :param chars: characters, one number per row
+    :type chars: numpy.ndarray of uint8
+    :returns: tuple of numpy.ndarray -- values and validity of each row
+    """
+    digits = _HEX_VALUES[chars]
+    valid = (digits >= 0).all(axis=1)
+    values = np.zeros(len(chars), dtype=np.uint32)
+    for column in range(chars.shape[1]):
+        values = (values << 4) | (digits[:, column] & 0xF).astype(np.uint32)
+    return values, valid
+
+
+def decode_lines(data, starts, ends):
+    """
+    Decode the trigger lines in a buffer. Lines which are not trigger lines
+    have 'trigger_line' set to False and all other fields set to zero.
+
+    :param data: buffer
+    :type data: numpy.ndarray of uint8
+    :param starts: start offsets of the lines
+    :type starts: numpy.ndarray
+    :param ends: end offsets of the lines
+    :type ends: numpy.ndarray
+    :returns: numpy.ndarray of DECODED_DTYPE
+    """
+    decoded = np.zeros(len(starts), dtype=DECODED_DTYPE)
+
+    candidates = np.flatnonzero(ends - starts == TRIGGER_LINE_LENGTH)
+    if not len(candidates):
+        return decoded
+
+    lines = data[starts[candidates, None] +
+                 np.arange(TRIGGER_LINE_LENGTH)[None, :]]
+
+    valid = (lines[:, SEPARATOR_POS] == ord(" ")).all(axis=1)
+
+    counter, ok = _decode_hex(lines[:, COUNTER_POS:COUNTER_POS + 8])
+    valid &= ok
+    one_pps, ok = _decode_hex(lines[:, ONE_PPS_POS:ONE_PPS_POS + 8])
+    valid &= ok
+
+    edges = np.zeros((len(candidates), 8), dtype=np.uint8)
+    for i, pos in enumerate(EDGE_POS):
+        values, ok = _decode_hex(lines[:, pos:pos + 2])
+        edges[:, i] = values
+        valid &= ok
+
+    rows = candidates[valid]
+    decoded["trigger_line"][rows] = True
+    decoded["counter"][rows] = counter[valid]
+    decoded["edges"][rows] = edges[valid]
+    decoded["one_pps"][rows] = one_pps[valid]
+
+    return decoded
+
+
+def trigger_flags(decoded):
+    """
+    Get the trigger flags of decoded lines.
+
+    :param decoded: decoded lines
+    :type decoded: numpy.ndarray of DECODED_DTYPE
+    :returns: numpy.ndarray of bool
+    """
+    return (decoded["edges"][:, 0] & BIT7) != 0
+
+
+def leading_edges(decoded):
+    """
+    Get the valid leading edges of decoded lines per channel.
+
+    :param decoded: decoded lines
+    :type decoded: numpy.ndarray of DECODED_DTYPE
+    :returns: numpy.ndarray of bool with one column per channel
+    """
+    return (decoded["edges"][:, 0::2] & BIT5) != 0
+
+
+def gps_times(data, starts, decoded):
+    """
+    Get the GPS time of decoded lines, i.e. the UTC time of the last 1PPS
+    before the line. Lines which are not trigger lines or carry no valid
+    date and time get NaT.
+
+    :param data: buffer
+    :type data: numpy.ndarray of uint8
+    :param starts: start offsets of the lines
+    :type starts: numpy.ndarray
+    :param decoded: decoded lines
+    :type decoded: numpy.ndarray of DECODED_DTYPE
+    :returns: numpy.ndarray of datetime64[ms]
+    """
+    times = np.full(len(decoded), np.datetime64("NaT", "ms"))
+    rows = np.flatnonzero(decoded["trigger_line"])
+    if not len(rows):
+        return times
+
+    iso = np.empty((len(rows), len(_ISO_TEMPLATE)), dtype=np.uint8)
+    iso[:] = _ISO_TEMPLATE
+    for pos, fields in ((DATE_POS, _ISO_FROM_DATE),
+                        (TIME_POS, _ISO_FROM_TIME)):
+        for column, source, width in fields:
+            iso[:, column:column + width] = data[
+                starts[rows, None] + pos + source + np.arange(width)]
+
+    # without GPS the date is zero
+    digits = np.delete(iso, [4, 7, 10, 13, 16, 19], axis=1)
+    valid = (((digits >= ord("0")) & (digits <= ord("9"))).all(axis=1) &
+             (iso[:, 5:7] != ord("0")).any(axis=1) &
+             (iso[:, 8:10] != ord("0")).any(axis=1))
+    iso = iso[valid]
+    rows = rows[valid]
+
+    stamps = iso.view("S%d" % len(_ISO_TEMPLATE)).ravel()
+    try:
+        times[rows] = stamps.astype("datetime64[ms]")
+    except ValueError:
+        # convert one by one to skip impossible dates
+        for row, stamp in zip(rows, stamps):
+            try:
+                times[row] = np.datetime64(stamp.decode("ascii"), "ms")
+            except ValueError:
+                pass
+    return times
+
+
+def trim_lines(data, start=None, end=None):
+    """
+    Remove the lines before the first trigger line with a GPS time at or
+    after the start and from the first trigger line with a GPS time after
+    the end.
+
+    :param data: complete lines
+    :type data: bytes
+    :param start: start of the time range, open if None
+    :type start: numpy.datetime64 or None
+    :param end: end of the time range, included, open if None
+    :type end: numpy.datetime64 or None
+    :returns: bytes
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    starts, ends = find_lines(buf)
+    times = gps_times(buf, starts, decode_lines(buf, starts, ends))
+    known = np.flatnonzero(~np.isnat(times))
+
+    first, last = 0, len(data)
+    if start is not None:
+        inside = known[times[known] >= start]
+        first = starts[inside[0]] if len(inside) else len(data)
+    if end is not None:
+        after = known[times[known] > end]
+        last = starts[after[0]] if len(after) else len(data)
+    return data[first:max(first, last)]
+
+
+def cumulative_scalers(decoded):
+    """
+    Get the scalers of channels 0 to 3 and of the trigger after each line,
+    i.e. the cumulative counts of leading edges and trigger flags. Row i
+    holds the counts of the first i lines.
+
+    :param decoded: decoded lines
+    :type decoded: numpy.ndarray of DECODED_DTYPE
+    :returns: numpy.ndarray of int64 with shape (len(decoded) + 1, 5)
+    """
+    scalers = np.zeros((len(decoded) + 1, 5), dtype=np.int64)
+    np.cumsum(leading_edges(decoded), axis=0, out=scalers[1:, :4])
+    np.cumsum(trigger_flags(decoded), out=scalers[1:, 4])
+    return scalers
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Decode a RAW file and report the " +
+                                        "decoding rate")
+    parser.add_argument("filename", help="uncompressed RAW file")
+    args = parser.parse_args()
+
+    start = time.time()
+    buf = np.fromfile(args.filename, dtype=np.uint8)
+    line_starts, line_ends = find_lines(buf)
+    result = decode_lines(buf, line_starts, line_ends)
+    elapsed = time.time() - start
+
+    print("decoded %d lines (%d trigger lines, %d triggers) in %.3f s: " %
+          (len(result), result["trigger_line"].sum(),
+           trigger_flags(result).sum(), elapsed) +
+          "%.0f lines/s" % (len(result) / elapsed))
+    print("leading edges per channel: %s" %
+          leading_edges(result).sum(axis=0).tolist())
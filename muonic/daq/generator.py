@@ -0,0 +1,432 @@
+"""
+Provides a generator for DAQ trigger lines from configurable physics.
+Events are generated and encoded in NumPy batches, so that extraction and
+triggers can be load tested far above the rates of a real card.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import datetime
+import time
+
+import numpy as np
+
+from muonic.analysis.analyzer import BIT5, BIT7, DEFAULT_FREQUENCY, TMC_TICK
+
+# range of the trigger and 1PPS counters
+COUNTER_RANGE = 1 << 32
+
+# a trigger line with its newline, the fields are filled in by position
+LINE_TEMPLATE = (b"00000000 00 00 00 00 00 00 00 00 00000000 " +
+                 b"000000.000 000000 A 07 0 +0000\n")
+LINE_LENGTH = len(LINE_TEMPLATE)
+
+# positions of the fields in LINE_TEMPLATE
+COUNTER_POS = 0
+EDGE_POS = [9, 12, 15, 18, 21, 24, 27, 30]
+ONE_PPS_POS = 33
+TIME_POS = 42
+DATE_POS = 53
+VALID_POS = 60
+
+# two hex digits for each byte value, as one 16 bit word per byte value
+_HEX_WORDS = np.array([[ord(c) for c in "%02X" % i] for i in range(256)],
+                      dtype=np.uint8).view(np.uint16).ravel()
+
+
+def _encode_hex(buf, pos, values, digits):
+    """
+    Write values as upper case hex numbers with leading zeros into the
+    columns of the line buffer starting at pos.
+
+    :param buf: line buffer
+    :type buf: numpy.ndarray
+    :param pos: first column
+    :type pos: int
+    :param values: values to encode, one per line
+    :type values: numpy.ndarray
+    :param digits: number of hex digits, either 2 or 8
+    :type digits: int
+    :returns: None
+    """
+    dtype = ">u4" if digits == 8 else np.uint8
+    values = values.astype(dtype).view(np.uint8).reshape(len(values), -1)
+    buf[:, pos:pos + digits] = np.take(_HEX_WORDS, values).view(np.uint8)
+
+
+def _encode_dec(buf, pos, values, digits):
+    """
+    Write values as decimal numbers with leading zeros into the columns of
+    the line buffer starting at pos.
+
+    :param buf: line buffer
+    :type buf: numpy.ndarray
+    :param pos: first column
+    :type pos: int
+    :param values: values to encode, one per line
+    :type values: numpy.ndarray
+    :param digits: number of decimal digits
+    :type digits: int
+    :returns: None
+    """
+    powers = 10 ** np.arange(digits - 1, -1, -1, dtype=np.int64)
+    buf[:, pos:pos + digits] = (
+            (values.astype(np.int64)[:, None] // powers) % 10 + ord("0"))
+
+
+class EventGenerator(object):
+    """
+    Generates DAQ trigger lines for muons crossing a detector stack.
+
+    Muons arrive as a Poisson process and hit each channel with the
+    channel's efficiency, which models the coincidence geometry. Pulses
+    are delayed by the flight time to the channel and have a gaussian
+    width. A fraction of the muons stops in the decay channel and causes a
+    second pulse after an exponentially distributed decay time. Uncorrelated
+    noise pulses are added to each channel within the trigger window.
+
+    Edges are encoded like the card does: one line per counter tick of
+    40 ns, the time within the tick in TMC ticks. Counters roll over at
+    32 bit. With GPS, the 1PPS counter, time and date fields follow the
+    simulated time.
+
+    :param rate: muon rate in 1/s
+    :type rate: float
+    :param efficiencies: probability of each channel to see a muon
+    :type efficiencies: list of float
+    :param noise_rates: rates of uncorrelated pulses per channel in 1/s
+    :type noise_rates: list of float
+    :param decay_fraction: fraction of muons decaying in the detector
+    :type decay_fraction: float
+    :param decay_channel: channel in which the muons stop and decay
+    :type decay_channel: int
+    :param lifetime: muon lifetime in ns
+    :type lifetime: float
+    :param flight_times: mean flight time to each channel in ns
+    :type flight_times: list of float
+    :param flight_time_sigma: spread of the flight times in ns
+    :type flight_time_sigma: float
+    :param pulse_width: mean pulse width in ns
+    :type pulse_width: float
+    :param pulse_width_sigma: spread of the pulse widths in ns
+    :type pulse_width_sigma: float
+    :param window: trigger window in ns
+    :type window: float
+    :param frequency: counter frequency in Hz
+    :type frequency: float
+    :param start_count: initial value of the trigger counter
+    :type start_count: int
+    :param start_time: UTC time of the first event, GPS fields are left
+                       invalid if None
+    :type start_time: datetime.datetime or None
+    :param seed: seed for the random numbers
+    :type seed: int or None
+    """
+
+    COUNTER_TICK = 1e9 / DEFAULT_FREQUENCY  # ns
+
+    # number of muons generated at once
+    CHUNK_SIZE = 16384
+
+    def __init__(self, rate=10., efficiencies=(1., 1., 1., 1.),
+                 noise_rates=(0., 0., 0., 0.), decay_fraction=0.01,
+                 decay_channel=1, lifetime=2197., flight_times=(0., 0., 0., 0.),
+                 flight_time_sigma=1., pulse_width=30., pulse_width_sigma=5.,
+                 window=10000., frequency=DEFAULT_FREQUENCY, start_count=0,
+                 start_time=None, seed=None):
+        self.rate = rate
+        self.efficiencies = np.asarray(efficiencies, dtype=float)
+        self.noise_rates = np.asarray(noise_rates, dtype=float)
+        self.decay_fraction = decay_fraction
+        self.decay_channel = decay_channel
+        self.lifetime = lifetime
+        self.flight_times = np.asarray(flight_times, dtype=float)
+        self.flight_time_sigma = flight_time_sigma
+        self.pulse_width = pulse_width
+        self.pulse_width_sigma = pulse_width_sigma
+        self.window = window
+        self.frequency = int(frequency)
+        self.start_time = start_time
+
+        try:
+            self.random = np.random.default_rng(seed)
+        except AttributeError:
+            # numpy < 1.17
+            self.random = np.random.RandomState(seed)
+
+        # counter ticks since start, not rolled over
+        self._ticks = int(start_count)
+        self._start_count = int(start_count)
+
+        # true decay times of the last batch in ns
+        self.decay_times = np.empty(0)
+
+    def _edges(self, n_events):
+        """
+        Generate the edges of n events relative to their muon arrival.
+
+        :param n_events: number of events
+        :type n_events: int
+        :returns: tuple of event index, channel, kind (0 for rising, 1 for
+                  falling edge) and time in ns as numpy.ndarray
+        """
+        rnd = self.random
+        pulse_events = []
+        pulse_channels = []
+        pulse_times = []
+
+        # muon hits
+        hits = rnd.uniform(0., 1., (n_events, 4)) < self.efficiencies
+        ev, ch = np.nonzero(hits)
+        ch = ch.astype(np.int64)
+        pulse_events.append(ev)
+        pulse_channels.append(ch)
+        pulse_times.append(self.flight_times[ch] +
+                           rnd.normal(0., self.flight_time_sigma, len(ev)))
+
+        # decays of stopped muons
+        decays = np.flatnonzero(rnd.uniform(0., 1., n_events) <
+                                self.decay_fraction)
+        self.decay_times = rnd.exponential(self.lifetime, len(decays))
+        pulse_events.append(decays)
+        pulse_channels.append(np.full(len(decays), self.decay_channel,
+                                      dtype=ch.dtype))
+        pulse_times.append(self.flight_times[self.decay_channel] +
+                           self.decay_times)
+
+        # uncorrelated noise within the trigger window
+        for channel, noise_rate in enumerate(self.noise_rates):
+            if noise_rate <= 0:
+                continue
+            counts = rnd.poisson(noise_rate * self.window * 1e-9, n_events)
+            noise_events = np.repeat(np.arange(n_events), counts)
+            pulse_events.append(noise_events)
+            pulse_channels.append(np.full(len(noise_events), channel,
+                                          dtype=ch.dtype))
+            pulse_times.append(rnd.uniform(0., self.window,
+                                           len(noise_events)))
+
+        ev = np.concatenate(pulse_events)
+        ch = np.concatenate(pulse_channels)
+        rising = np.concatenate(pulse_times)
+        widths = np.maximum(rnd.normal(self.pulse_width,
+                                       self.pulse_width_sigma, len(ev)),
+                            TMC_TICK)
+
+        n_pulses = len(ev)
+        kind = np.repeat(np.array([0, 1], dtype=np.int64), n_pulses)
+
+        return (np.concatenate([ev, ev]), np.concatenate([ch, ch]), kind,
+                np.concatenate([rising, rising + widths]))
+
+    def generate(self, n_events):
+        """
+        Generate the trigger lines of n events. Muons missing all channels
+        do not trigger and are skipped.
+
+        :param n_events: number of muons
+        :type n_events: int
+        :returns: numpy.ndarray -- lines as rows of ASCII characters, each
+                  terminated by a newline
+        """
+        if n_events <= self.CHUNK_SIZE:
+            return self._generate(n_events)
+
+        # smaller arrays stay in the CPU caches
+        chunks = []
+        decay_times = []
+        for start in range(0, n_events, self.CHUNK_SIZE):
+            chunks.append(self._generate(min(self.CHUNK_SIZE,
+                                             n_events - start)))
+            decay_times.append(self.decay_times)
+        self.decay_times = np.concatenate(decay_times)
+        return np.concatenate(chunks)
+
+    def _generate(self, n_events):
+        """
+        Generate the trigger lines of n events in one go.
+
+        :param n_events: number of muons
+        :type n_events: int
+        :returns: numpy.ndarray
+        """
+        ev, ch, kind, t = self._edges(n_events)
+
+        # the trigger is the first rising edge of the event, all times are
+        # relative to the counter tick it falls into
+        first_time = np.full(n_events, np.inf)
+        np.minimum.at(first_time, ev, t)
+        offset = (self.random.uniform(0., self.COUNTER_TICK, n_events) -
+                  first_time)
+        t += offset[ev]
+
+        # edges after the trigger window are not recorded by the card
+        inside = t < self.window
+        ev, ch, kind, t = ev[inside], ch[inside], kind[inside], t[inside]
+
+        # times are positive, so truncation rounds down
+        tick = (t * (1. / self.COUNTER_TICK)).astype(np.int64)
+        tmc = np.minimum(((t - tick * self.COUNTER_TICK) *
+                          (1. / TMC_TICK)).astype(np.int64), 31)
+
+        # all properties of an edge packed into one sortable key:
+        # event and tick, channel, kind and TMC time
+        max_tick = int(self.window // self.COUNTER_TICK) + 1
+        key = ((((ev * max_tick + tick) << 2 | ch) << 1 | kind) << 5) | tmc
+        # the edges are mostly ordered by event already, which makes the
+        # stable sort (timsort) much faster than quicksort
+        key = np.sort(key, kind="mergesort")
+
+        # a line holds one edge per channel and kind, more edges in the
+        # same counter tick go into additional lines in order of time
+        group_key = key >> 5
+        new_group = np.r_[True, group_key[1:] != group_key[:-1]]
+        group_start = np.flatnonzero(new_group)
+        slot = np.arange(len(key)) - group_start[np.cumsum(new_group) - 1]
+
+        max_slot = int(slot.max()) + 1 if len(slot) else 1
+        line_key = (key >> 8) * max_slot + slot
+        if max_slot > 1:
+            # only the few edges in additional lines are out of order
+            order = np.argsort(line_key, kind="mergesort")
+            new_line = np.r_[True, line_key[order][1:] !=
+                             line_key[order][:-1]]
+            line = np.empty(len(key), dtype=np.int64)
+            line[order] = np.cumsum(new_line) - 1
+            line_keys = line_key[order][new_line]
+        else:
+            new_line = np.r_[True, line_key[1:] != line_key[:-1]]
+            line = np.cumsum(new_line) - 1
+            line_keys = line_key[new_line]
+
+        n_lines = len(line_keys)
+        line_event = line_keys // (max_tick * max_slot)
+        line_tick = (line_keys // max_slot) % max_tick
+
+        edges = np.zeros(n_lines * 8, dtype=np.uint8)
+        edges[line * 8 + ((key >> 5) & 7)] = BIT5 | (key & 31)
+        edges = edges.reshape(n_lines, 8)
+
+        # trigger flag on the first line of each event
+        first_line = np.r_[True, line_event[1:] != line_event[:-1]]
+        edges[first_line, 0] |= BIT7
+
+        # arrival of the events in counter ticks, the next event can only
+        # trigger after the window of the last one
+        triggered = np.zeros(n_events, dtype=bool)
+        triggered[line_event] = True
+        gaps = self.random.exponential(self.frequency / float(self.rate),
+                                       n_events)
+        gaps = np.maximum(gaps, self.window / self.COUNTER_TICK + 1)
+        gaps[~triggered] = 0
+        arrival = self._ticks + np.cumsum(gaps).astype(np.int64)
+        if n_events:
+            self._ticks = int(arrival[-1])
+
+        ticks = arrival[line_event] + line_tick
+
+        return self._encode(ticks, edges)
+
+    def _encode(self, ticks, edges):
+        """
+        Encode the trigger lines.
+
+        :param ticks: counter ticks since start of the lines
+        :type ticks: numpy.ndarray
+        :param edges: RE0, FE0, ..., RE3, FE3 bytes of the lines
+        :type edges: numpy.ndarray
+        :returns: numpy.ndarray
+        """
+        n_lines = len(ticks)
+        buf = np.empty((n_lines, LINE_LENGTH), dtype=np.uint8)
+        buf[:] = np.frombuffer(LINE_TEMPLATE, dtype=np.uint8)
+
+        _encode_hex(buf, COUNTER_POS, ticks & (COUNTER_RANGE - 1), 8)
+
+        # the edge fields are evenly spaced, so all are encoded at once
+        edge_columns = buf[:, EDGE_POS[0]:EDGE_POS[-1] + 3].reshape(
+                n_lines, 8, 3)
+        edge_columns[:, :, :2] = np.take(_HEX_WORDS, edges).view(
+                np.uint8).reshape(n_lines, 8, 2)
+
+        if self.start_time is None:
+            buf[:, VALID_POS] = ord("V")
+            _encode_hex(buf, ONE_PPS_POS, np.zeros(n_lines, dtype=np.int64),
+                        8)
+            return buf
+
+        # the 1PPS counter holds the counter value of the last full second,
+        # time and date belong to this second. These fields are encoded once
+        # per second and copied to the lines.
+        seconds = (ticks - self._start_count) // self.frequency
+        new_second = np.r_[True, seconds[1:] != seconds[:-1]]
+        unique_seconds = seconds[new_second]
+        n_seconds = len(unique_seconds)
+
+        gps = np.empty((n_seconds, LINE_LENGTH), dtype=np.uint8)
+        _encode_hex(gps, ONE_PPS_POS,
+                    (self._start_count + unique_seconds * self.frequency) &
+                    (COUNTER_RANGE - 1), 8)
+
+        start = self.start_time
+        start_of_day = (start.hour * 3600 + start.minute * 60 + start.second)
+        days, seconds_of_day = np.divmod(unique_seconds + start_of_day, 86400)
+
+        _encode_dec(gps, TIME_POS, (seconds_of_day // 3600) * 10000 +
+                    (seconds_of_day // 60 % 60) * 100 +
+                    seconds_of_day % 60, 6)
+
+        dates = np.zeros(n_seconds, dtype=np.int64)
+        for day in np.unique(days):
+            date = start.date() + datetime.timedelta(days=int(day))
+            dates[days == day] = (date.day * 10000 + date.month * 100 +
+                                  date.year % 100)
+        _encode_dec(gps, DATE_POS, dates, 6)
+
+        # the fixed characters in between are copied along, they are the
+        # same in all lines
+        gps[:, TIME_POS - 1] = ord(" ")
+        gps[:, TIME_POS + 6:TIME_POS + 10] = np.frombuffer(b".000",
+                                                           dtype=np.uint8)
+        gps[:, DATE_POS - 1] = ord(" ")
+        buf[:, ONE_PPS_POS:DATE_POS + 6] = \
+            gps[np.cumsum(new_second) - 1, ONE_PPS_POS:DATE_POS + 6]
+
+        return buf
+
+    def generate_lines(self, n_events):
+        """
+        Generate the trigger lines of n events as strings.
+
+        :param n_events: number of muons
+        :type n_events: int
+        :returns: list of str
+        """
+        data = self.generate(n_events).tobytes().decode("ascii")
+        return data.splitlines()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Generate DAQ trigger lines or " +
+                                        "measure the generator throughput")
+    parser.add_argument("-n", "--events", dest="events", type=int,
+                        default=100000, help="number of muons")
+    parser.add_argument("-r", "--rate", dest="rate", type=float, default=10.,
+                        help="muon rate in 1/s")
+    parser.add_argument("--seed", dest="seed", type=int, default=None,
+                        help="seed for the random numbers")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="write the lines to this file")
+    args = parser.parse_args()
+
+    generator = EventGenerator(rate=args.rate, seed=args.seed,
+                               start_time=datetime.datetime.utcnow())
+    start = time.time()
+    lines = generator.generate(args.events)
+    elapsed = time.time() - start
+
+    if args.output is not None:
+        with open(args.output, "wb") as output:
+            output.write(lines.tobytes())
+
+    print("generated %d lines of %d muons in %.3f s: %.0f lines/s" %
+          (len(lines), args.events, elapsed, len(lines) / elapsed))
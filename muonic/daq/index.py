@@ -0,0 +1,373 @@
+"""
+Provides a sparse time index of RAW files for seeking to a GPS time.
+
+One pass over a RAW file records the byte offset and trigger count of the
+first trigger line of every interval of GPS seconds, and the offsets of
+the lines which mark the start and the end of a run. The index is kept in
+a sidecar file which is only appended to, so it can be updated while the
+file grows. Reading a time range then starts at the indexed offset instead
+of at byte 0.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import logging
+import os
+import time
+
+import numpy as np
+
+from muonic.daq.decoder import find_lines, decode_lines, gps_times
+from muonic.daq.decoder import trim_lines
+from muonic.util import iter_line_chunks
+
+# bytes read from a file at once
+CHUNK_SIZE = 1 << 22
+
+# GPS seconds per index entry
+INDEX_INTERVAL = 10
+
+# suffix of the index file
+INDEX_SUFFIX = ".tidx"
+
+# first bytes of an index file
+MAGIC = b"muonic time index 1\n"
+
+# kinds of index entries
+TIME_ENTRY = 0
+RUN_START = 1
+RUN_STOP = 2
+# the offset up to which the file is indexed, always the last entry
+END_ENTRY = 3
+
+# lines which mark the start and the end of a run
+RUN_START_MARKER = b"run from:"
+RUN_STOP_MARKER = b"# stopped run"
+
+# an entry of the index
+ENTRY_DTYPE = np.dtype([("offset", np.int64),
+                        ("time", "datetime64[s]"),
+                        ("count", np.uint32),
+                        ("kind", np.uint8)])
+
+
+def _index_chunk(data, offset, interval, last_bucket):
+    """
+    Get the index entries of complete lines in a buffer.
+
+    :param data: buffer with complete lines
+    :type data: bytes
+    :param offset: offset of the buffer in the file
+    :type offset: int
+    :param interval: GPS seconds per entry
+    :type interval: int
+    :param last_bucket: interval of the last indexed line, None at the
+                        start of the file
+    :type last_bucket: int or None
+    :returns: tuple of numpy.ndarray of ENTRY_DTYPE and the interval of
+              the last line with GPS time
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    starts, ends = find_lines(buf)
+    decoded = decode_lines(buf, starts, ends)
+    times = gps_times(buf, starts, decoded).astype("datetime64[s]")
+
+    # a new entry wherever the interval of the GPS time changes
+    rows = np.flatnonzero(~np.isnat(times))
+    buckets = times[rows].astype(np.int64) // interval
+    previous = np.concatenate((
+        [-1 if last_bucket is None else last_bucket], buckets[:-1]))
+    rows = rows[buckets != previous]
+    if len(buckets):
+        last_bucket = int(buckets[-1])
+
+    entries = np.zeros(len(rows), dtype=ENTRY_DTYPE)
+    entries["offset"] = offset + starts[rows]
+    entries["time"] = times[rows]
+    entries["count"] = decoded["counter"][rows]
+    entries["kind"] = TIME_ENTRY
+
+    # run markers are comments, there are only a few of them
+    markers = []
+    for row in np.flatnonzero(buf[starts] == ord("#")).tolist():
+        line = data[starts[row]:ends[row]]
+        if line.startswith(RUN_STOP_MARKER):
+            kind = RUN_STOP
+        elif RUN_START_MARKER in line:
+            kind = RUN_START
+        else:
+            continue
+        known = rows[rows < row]
+        marker = np.zeros(1, dtype=ENTRY_DTYPE)
+        marker["offset"] = offset + starts[row]
+        marker["time"] = times[known[-1]] if len(known) else \
+            np.datetime64("NaT", "s")
+        marker["kind"] = kind
+        markers.append(marker)
+
+    if markers:
+        entries = np.concatenate([entries] + markers)
+        entries = entries[np.argsort(entries["offset"], kind="mergesort")]
+    return entries, last_bucket
+
+
+class TimeIndex(object):
+    """
+    Sparse time index of a RAW file, stored in a sidecar file next to it.
+    The index is loaded if it exists and brought up to date with update.
+    Compressed files cannot be indexed.
+
+    :param filename: path of the RAW file
+    :type filename: str
+    :param interval: GPS seconds per index entry
+    :type interval: int
+    :param chunk_size: bytes read at once
+    :type chunk_size: int
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, filename, interval=INDEX_INTERVAL,
+                 chunk_size=CHUNK_SIZE, logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+
+        self.filename = filename
+        self.index_filename = filename + INDEX_SUFFIX
+        self.interval = interval
+        self.chunk_size = chunk_size
+
+        self.entries = np.zeros(0, dtype=ENTRY_DTYPE)
+        # bytes of the file which are indexed
+        self.scanned = 0
+        self._last_bucket = None
+        # the index file has to be written again instead of appended to
+        self._rewrite = True
+        self._load()
+
+    def _load(self):
+        """
+        Load the index file if it exists and is valid.
+
+        :returns: None
+        """
+        if not os.path.exists(self.index_filename):
+            return
+
+        with open(self.index_filename, "rb") as index_file:
+            if index_file.read(len(MAGIC)) != MAGIC:
+                self.logger.warning("Ignoring invalid time index %s" %
+                                    self.index_filename)
+                return
+            data = index_file.read()
+
+        # a partly written entry at the end is ignored
+        entries = np.frombuffer(data, dtype=ENTRY_DTYPE,
+                                count=len(data) // ENTRY_DTYPE.itemsize)
+        if (len(data) % ENTRY_DTYPE.itemsize or not len(entries) or
+                entries["kind"][-1] != END_ENTRY):
+            self.logger.warning("Ignoring incomplete time index %s" %
+                                self.index_filename)
+            return
+
+        self.entries = entries[:-1].copy()
+        self.scanned = int(entries["offset"][-1])
+        self._rewrite = False
+        times = self.times
+        if len(times):
+            self._last_bucket = int(times[-1].astype(np.int64) //
+                                    self.interval)
+
+    def _save(self, entries):
+        """
+        Append entries to the index file and move the end entry. If the
+        index file is missing, invalid or outdated, it is written again
+        with all entries.
+
+        :param entries: new entries, the last ones of the index
+        :type entries: numpy.ndarray of ENTRY_DTYPE
+        :returns: None
+        """
+        end = np.zeros(1, dtype=ENTRY_DTYPE)
+        end["offset"] = self.scanned
+        end["time"] = np.datetime64("NaT", "s")
+        end["kind"] = END_ENTRY
+
+        if self._rewrite:
+            index_file = open(self.index_filename, "wb")
+            index_file.write(MAGIC)
+            entries = self.entries
+            self._rewrite = False
+        else:
+            index_file = open(self.index_filename, "r+b")
+            # overwrite the previous end entry
+            index_file.seek(-ENTRY_DTYPE.itemsize, os.SEEK_END)
+
+        with index_file:
+            index_file.write(entries.tobytes())
+            index_file.write(end.tobytes())
+            index_file.truncate()
+
+    @property
+    def times(self):
+        """
+        The GPS times of the time entries.
+
+        :returns: numpy.ndarray of datetime64[s]
+        """
+        return self.entries["time"][self.entries["kind"] == TIME_ENTRY]
+
+    @property
+    def runs(self):
+        """
+        The entries which mark the start or the end of a run.
+
+        :returns: numpy.ndarray of ENTRY_DTYPE
+        """
+        kinds = self.entries["kind"]
+        return self.entries[(kinds == RUN_START) | (kinds == RUN_STOP)]
+
+    def reset(self):
+        """
+        Forget the index, the next update indexes the whole file and
+        writes the index file again.
+
+        :returns: None
+        """
+        self.entries = np.zeros(0, dtype=ENTRY_DTYPE)
+        self.scanned = 0
+        self._last_bucket = None
+        self._rewrite = True
+
+    def update(self):
+        """
+        Index the lines added to the file since the last update. Lines
+        which are not complete yet are left for the next update. If the
+        file got shorter, it is indexed again from the start.
+
+        :returns: int -- number of new entries
+        """
+        size = os.path.getsize(self.filename)
+        if size < self.scanned:
+            self.logger.info("%s got shorter, indexing it again" %
+                             self.filename)
+            self.reset()
+
+        new_entries = []
+        offset = self.scanned
+        for chunk in iter_line_chunks(self.filename, self.chunk_size,
+                                      offset, incomplete=False):
+            entries, self._last_bucket = _index_chunk(
+                chunk, offset, self.interval, self._last_bucket)
+            new_entries.append(entries)
+            offset += len(chunk)
+
+        if offset == self.scanned and not self._rewrite:
+            return 0
+
+        self.scanned = offset
+        new_entries = np.concatenate(
+            new_entries + [np.zeros(0, dtype=ENTRY_DTYPE)])
+        self.entries = np.concatenate((self.entries, new_entries))
+        self._save(new_entries)
+        return len(new_entries)
+
+    def seek(self, when):
+        """
+        Get the offset from which to read the file to find all lines with
+        a GPS time at or after a time. This is the offset of the last
+        entry before the time, or 0.
+
+        :param when: the time
+        :type when: datetime.datetime or numpy.datetime64 or str
+        :returns: int
+        """
+        when = np.datetime64(when, "s")
+        entries = self.entries[self.entries["kind"] == TIME_ENTRY]
+        before = np.flatnonzero(entries["time"] <= when)
+        if not len(before):
+            return 0
+        return int(entries["offset"][before[-1]])
+
+    def _stop_offset(self, when):
+        """
+        Get the offset up to which the file has to be read to find all
+        lines with a GPS time up to a time.
+
+        :param when: the time
+        :type when: numpy.datetime64
+        :returns: int
+        """
+        entries = self.entries[self.entries["kind"] == TIME_ENTRY]
+        after = np.flatnonzero(entries["time"] > when.astype("datetime64[s]"))
+        if not len(after):
+            return self.scanned
+        return int(entries["offset"][after[0]])
+
+    def read(self, start=None, end=None):
+        """
+        Read the indexed lines in a time range, from the first trigger
+        line at or after the start to the last trigger line at or before
+        the end.
+
+        :param start: start of the range, open if None
+        :type start: datetime.datetime or numpy.datetime64 or str or None
+        :param end: end of the range, included, open if None
+        :type end: datetime.datetime or numpy.datetime64 or str or None
+        :returns: bytes
+        """
+        if start is not None:
+            start = np.datetime64(start, "ms")
+        if end is not None:
+            end = np.datetime64(end, "ms")
+
+        first = 0 if start is None else self.seek(start)
+        last = self.scanned if end is None else self._stop_offset(end)
+        if last <= first:
+            return b""
+
+        with open(self.filename, "rb") as raw_file:
+            raw_file.seek(first)
+            data = raw_file.read(last - first)
+        return trim_lines(data, start, end)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Index a RAW file and read a time " +
+                                        "range with and without the index")
+    parser.add_argument("filename", help="uncompressed RAW file")
+    parser.add_argument("-i", "--interval", dest="interval", type=int,
+                        default=INDEX_INTERVAL,
+                        help="GPS seconds per index entry")
+    parser.add_argument("-m", "--minutes", dest="minutes", type=float,
+                        default=5., help="length of the time range read " +
+                                         "from the middle of the file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    index = TimeIndex(args.filename, args.interval)
+    start_time = time.time()
+    added = index.update()
+    print("%d new entries in %.2f s, %d entries and %d run markers" %
+          (added, time.time() - start_time, len(index.entries),
+           len(index.runs)))
+
+    times = index.times
+    if not len(times):
+        raise SystemExit("no GPS times in the file")
+    middle = times[len(times) // 2]
+    delta = np.timedelta64(int(60 * args.minutes), "s")
+
+    start_time = time.time()
+    selection = index.read(middle, middle + delta)
+    print("read %d bytes from %s to %s in %.3f s" %
+          (len(selection), middle, middle + delta, time.time() - start_time))
+
+    start_time = time.time()
+    with open(args.filename, "rb") as whole_file:
+        everything = trim_lines(whole_file.read(), np.datetime64(middle, "ms"),
+                                np.datetime64(middle + delta, "ms"))
+    print("read the same range from the whole file in %.3f s" %
+          (time.time() - start_time))
+    assert everything == selection
@@ -0,0 +1,433 @@
+"""
+Provides a DAQ provider for several cards operated side by side. Each card
+is read by its own provider, so that reading, validating and decoding of
+the lines of each card runs in a process of its own. The events of all
+cards are merged into a single stream ordered by their GPS time.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from collections import deque
+import datetime
+import heapq
+import logging
+import time
+
+from muonic.daq import DAQIOError
+from muonic.daq.batch import monotonic
+from muonic.daq.parser import DAQLineParser
+from muonic.daq.provider import BaseDAQProvider, DAQProvider
+
+SECONDS_PER_DAY = 86400
+
+
+def get_event_time(line, pulses):
+    """
+    Get the absolute event time in seconds since 0001-01-01 from the time
+    of day reconstructed by the pulse extraction and the date of the line.
+
+    The pulses of an event are only complete with the next trigger line, so
+    the line may already belong to the next day. This is corrected by
+    comparing the time of day of the event with the one of the line.
+
+    Without GPS fix the card reports the date as '000000', in this case
+    the time of day is used as is.
+
+    :param line: DAQ message which completed the event
+    :type line: str
+    :param pulses: extracted pulses
+    :type pulses: tuple
+    :returns: float
+    """
+    fields = line.split()
+    time_of_day = pulses[0]
+
+    try:
+        date = fields[11]
+        day = datetime.date(2000 + int(date[4:6]), int(date[2:4]),
+                            int(date[0:2])).toordinal()
+        t = fields[10]
+        line_time_of_day = int(t[0:2]) * 3600 + int(t[2:4]) * 60 + int(t[4:6])
+    except (IndexError, ValueError):
+        return time_of_day
+
+    if time_of_day - line_time_of_day > SECONDS_PER_DAY / 2:
+        # event happened before midnight, line after
+        day -= 1
+    elif line_time_of_day - time_of_day > SECONDS_PER_DAY / 2:
+        day += 1
+
+    return day * SECONDS_PER_DAY + time_of_day
+
+
+class EventMerger(object):
+    """
+    K-way merge of the event streams of several cards. Since the stream of
+    each card is ordered by time, an event can be released as soon as every
+    card has delivered an event which is not earlier. To not get stuck on
+    idle cards, events are also released after they waited for the length
+    of the reorder window or if too many events are pending. The events of
+    a card are always released in the order they were added, an event
+    earlier than the previous one of its card is sorted as if it had the
+    time of the previous one.
+
+    :param card_count: number of cards
+    :type card_count: int
+    :param reorder_window: maximum time in seconds an event is held back
+    :type reorder_window: float
+    :param max_pending: maximum number of events held back
+    :type max_pending: int
+    """
+
+    def __init__(self, card_count, reorder_window=2., max_pending=10000):
+        self.card_count = card_count
+        self.reorder_window = reorder_window
+        self.max_pending = max_pending
+
+        self._heap = []
+        self._counter = 0
+        # latest event time seen per card
+        self._latest = [None] * card_count
+
+    def push(self, card, event_time, item, receipt_time):
+        """
+        Add an event of a card.
+
+        :param card: index of the card
+        :type card: int
+        :param event_time: absolute event time
+        :type event_time: float
+        :param item: the event
+        :type item: object
+        :param receipt_time: monotonic time the event was received
+        :type receipt_time: float
+        :returns: None
+        """
+        if self._latest[card] is None or event_time > self._latest[card]:
+            self._latest[card] = event_time
+        else:
+            # keep the order of the card
+            event_time = self._latest[card]
+
+        # the counter keeps events of equal time in order of arrival
+        heapq.heappush(self._heap, (event_time, card, self._counter,
+                                    receipt_time, item))
+        self._counter += 1
+
+    def pop_ready(self, now=None):
+        """
+        Release all events which can be emitted in time order.
+
+        :param now: current monotonic time
+        :type now: float
+        :returns: list of tuples of card index, event time and event
+        """
+        if now is None:
+            now = monotonic()
+
+        ready = []
+
+        while self._heap:
+            event_time, card, _, receipt_time, item = self._heap[0]
+
+            if not (self._is_complete(event_time) or
+                    now - receipt_time >= self.reorder_window or
+                    len(self._heap) > self.max_pending):
+                break
+
+            heapq.heappop(self._heap)
+            ready.append((card, event_time, item))
+
+        return ready
+
+    def flush(self):
+        """
+        Release all pending events.
+
+        :returns: list of tuples of card index, event time and event
+        """
+        ready = []
+        while self._heap:
+            event_time, card, _, _, item = heapq.heappop(self._heap)
+            ready.append((card, event_time, item))
+        return ready
+
+    def _is_complete(self, event_time):
+        """
+        Returns True if all cards delivered an event not earlier than
+        event_time, so that no earlier event can arrive anymore.
+
+        :param event_time: absolute event time
+        :type event_time: float
+        :returns: bool
+        """
+        for latest in self._latest:
+            if latest is None or latest < event_time:
+                return False
+        return True
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class MultiDAQProvider(BaseDAQProvider):
+    """
+    DAQ provider for several cards. The events of all cards are merged
+    into one stream ordered by GPS time. The lines of each card stay in
+    their order: other lines, like command replies and the lines carrying
+    the edges of the next event, are held back until the events of their
+    card before them are released. 'get_card' tells which card the last
+    item came from.
+
+    Cards are either given as provider instances, e.g. a DAQClient
+    connected to a remote DAQServer, or as paths of tty devices. For
+    devices, a DAQProvider with line parsing in the reader process is
+    started, so each card is processed on a core of its own. Lines of
+    providers which do not parse on their own are parsed here.
+
+    :param cards: providers or tty devices of the cards
+    :type cards: list of BaseDAQProvider or str
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param reorder_window: maximum time in seconds an event is held back
+                           waiting for earlier events of other cards
+    :type reorder_window: float
+    :param max_pending: maximum number of events held back
+    :type max_pending: int
+    """
+
+    def __init__(self, cards, logger=None, reorder_window=2.,
+                 max_pending=10000):
+        BaseDAQProvider.__init__(self, logger)
+        self.preparse = True
+
+        self.cards = []
+        self._parsers = []
+
+        for card in cards:
+            if not isinstance(card, BaseDAQProvider):
+                card = DAQProvider(logger=self.logger, preparse=True,
+                                   device=card)
+            self.cards.append(card)
+            self._parsers.append(None if card.preparse
+                                 else DAQLineParser(self.logger))
+
+        self.merger = EventMerger(len(self.cards), reorder_window,
+                                  max_pending)
+
+        # lines of each card after its last event: line, receipt time
+        self._held = [[] for _ in self.cards]
+        # events of each card in the merger
+        self._pending = [0] * len(self.cards)
+        # the first event of a card is empty and is not merged
+        self._started = [False] * len(self.cards)
+
+        # items ready to be consumed: card, line, pulses, receipt time
+        self._ready = deque()
+        self._card = None
+        self._receipt_time = None
+
+    def _poll(self):
+        """
+        Collect the pending items of all cards and release the events which
+        are ready.
+
+        :returns: None
+        """
+        for index, card in enumerate(self.cards):
+            while card.data_available():
+                try:
+                    line, pulses = card.get_event(0)
+                except DAQIOError:
+                    break
+
+                if line is None:
+                    continue
+
+                receipt_time = card.get_receipt_time()
+
+                parser = self._parsers[index]
+                if parser is not None:
+                    parsed = parser.parse(line)
+                    if parsed is None:
+                        continue
+                    line, pulses = parsed
+
+                if pulses is not None and not self._started[index]:
+                    # the event before the first trigger has no time
+                    self._started[index] = True
+                    pulses = None
+
+                if pulses is None:
+                    self._held[index].append((line, receipt_time))
+                    continue
+
+                # the held lines are released before the event
+                self.merger.push(index, get_event_time(line, pulses),
+                                 (self._held[index], line, pulses,
+                                  receipt_time), monotonic())
+                self._held[index] = []
+                self._pending[index] += 1
+
+        self._release(self.merger.pop_ready())
+
+    def _release(self, events):
+        """
+        Make events released by the merger ready together with the lines
+        before them. Lines of cards without events in the merger are made
+        ready too, since no earlier event of their card is left.
+
+        :param events: events released by the merger
+        :type events: list of tuple
+        :returns: None
+        """
+        for index, _, (held, line, pulses, receipt_time) in events:
+            self._pending[index] -= 1
+            for held_line, held_receipt_time in held:
+                self._ready.append((index, held_line, None,
+                                    held_receipt_time))
+            self._ready.append((index, line, pulses, receipt_time))
+
+        for index, held in enumerate(self._held):
+            if held and not self._pending[index]:
+                for line, receipt_time in held:
+                    self._ready.append((index, line, None, receipt_time))
+                del held[:]
+
+    def flush(self):
+        """
+        Release all events held back for reordering, e.g. at the end of a
+        measurement.
+
+        :returns: None
+        """
+        self._poll()
+        self._release(self.merger.flush())
+
+    def get(self, *args):
+        """
+        Get the next line of the merged stream.
+
+        Raises DAQIOError if no line is available.
+
+        :param args: queue arguments, ignored
+        :type args: list
+        :returns: str
+        :raises: DAQIOError
+        """
+        return self.get_event(*args)[0]
+
+    def get_event(self, *args):
+        """
+        Get the next line of the merged stream together with the pulses
+        extracted from it.
+
+        Raises DAQIOError if no line is available.
+
+        :param args: queue arguments, ignored
+        :type args: list
+        :returns: tuple of str and tuple or None
+        :raises: DAQIOError
+        """
+        if not self._ready:
+            self._poll()
+
+        try:
+            self._card, line, pulses, self._receipt_time = \
+                self._ready.popleft()
+        except IndexError:
+            raise DAQIOError("No data available")
+
+        return line, pulses
+
+    def get_card(self):
+        """
+        Get the index of the card the last line returned by 'get' or
+        'get_event' came from.
+
+        :returns: int or None
+        """
+        return self._card
+
+    def get_receipt_time(self):
+        """
+        Get the time the last line returned by 'get' or 'get_event' was
+        received from its card in seconds since the epoch.
+
+        :returns: float
+        """
+        if self._receipt_time is None:
+            return BaseDAQProvider.get_receipt_time(self)
+        return self._receipt_time
+
+    def put(self, *args, **kwargs):
+        """
+        Send a command to one card or to all cards.
+
+        :param args: queue arguments
+        :type args: list
+        :param card: index of the card, sends to all cards if None
+        :type card: int or None
+        :returns: None
+        """
+        card = kwargs.get("card")
+
+        if card is None:
+            for provider in self.cards:
+                provider.put(*args)
+        else:
+            self.cards[card].put(*args)
+
+    def data_available(self):
+        """
+        Tests if data is available from any of the cards.
+
+        :returns: int
+        """
+        self._poll()
+        return len(self._ready)
+
+    def get_downtime(self, card=None):
+        """
+        Get the accumulated time in seconds the connection to a card was
+        lost. For all cards the maximum downtime is returned.
+
+        :param card: index of the card
+        :type card: int or None
+        :returns: float
+        """
+        if card is not None:
+            return self.cards[card].get_downtime()
+        return max([provider.get_downtime() for provider in self.cards])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Print the merged event stream of " +
+                                        "several DAQ cards")
+    parser.add_argument("devices", metavar="DEVICE", nargs="*",
+                        help="tty devices of the cards")
+    parser.add_argument("-s", "--sim", dest="sim", type=int, default=0,
+                        help="number of simulated cards to add")
+    parser.add_argument("-w", "--window", dest="window", type=float,
+                        default=2., help="reorder window in seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger()
+
+    cards = list(args.devices)
+    cards += [DAQProvider(logger=logger, sim=True, preparse=True)
+              for _ in range(args.sim)]
+
+    daq = MultiDAQProvider(cards, logger=logger, reorder_window=args.window)
+
+    try:
+        while True:
+            if not daq.data_available():
+                time.sleep(0.05)
+                continue
+            line, pulses = daq.get_event()
+            if pulses is not None:
+                print("card %d: %.9f %s" % (daq.get_card(), pulses[0],
+                                            repr(pulses[1:])))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,126 @@
+"""
+Provides a line parser which validates DAQ output and builds events from it.
+The parser is meant to run inside the reader process, so that the consumer
+only receives validated lines together with ready-made events.
+"""
+from __future__ import print_function
+import logging
+import re
+
+from muonic.analysis.analyzer import PulseExtractor
+
+# pattern of valid lines received from the DAQ card
+LINE_PATTERN = re.compile("^[a-zA-Z0-9+-.,:()=$/#?!%_@*|~' ]*[\n\r]*$")
+
+# patterns of the replies to the barometer ('BA') and temperature ('TH')
+# commands, e.g. 'BA Pressure mBar = 1013.2', '1013.2 mBar' and 'TH=21.5'
+# a value after the unit is preferred, since the status lines of the card
+# have other values in front of it, e.g. 'GPS_TempC=0.0     mBar=1023.8'
+PRESSURE_PATTERNS = (
+    re.compile(r"mbar\s*[=:]?\s*([-+]?\d+(?:\.\d*)?)", re.IGNORECASE),
+    re.compile(r"([-+]?\d+(?:\.\d*)?)\s*mbar", re.IGNORECASE))
+TEMPERATURE_PATTERN = re.compile(r"^(?:TH(?:\s+te?mp\w*)?|te?mp\w*)" +
+                                 r"\s*[=:]?\s*([-+]?\d+(?:\.\d*)?)",
+                                 re.IGNORECASE)
+
+# whitespace field of the pressure in the reply to 'BA'
+PRESSURE_FIELD = 4
+
+
+def is_trigger_line(fields):
+    """
+    Returns True if the whitespace-split line contains trigger data,
+    False otherwise.
+
+    :param fields: DAQ message split on whitespaces
+    :type fields: list of str
+    :returns: bool
+    """
+    return len(fields) == 16 and len(fields[0]) == 8
+
+
+def parse_pressure(line):
+    """
+    Get the pressure in mBar from the reply to the 'BA' command. The
+    pressure is either next to its unit or, like the card prints it, the
+    fifth field of a line starting with 'BA'.
+
+    Returns None if the line does not contain a pressure.
+
+    :param line: DAQ message
+    :type line: str
+    :returns: float or None
+    """
+    for pattern in PRESSURE_PATTERNS:
+        match = pattern.search(line)
+        if match is not None:
+            return float(match.group(1))
+
+    fields = line.split()
+    if len(fields) > PRESSURE_FIELD and fields[0] == "BA":
+        try:
+            return float(fields[PRESSURE_FIELD])
+        except ValueError:
+            pass
+    return None
+
+
+def parse_temperature(line):
+    """
+    Get the temperature in degree Celsius from the reply to the 'TH'
+    command, e.g. 'TH=21.5'.
+
+    Returns None if the line does not contain a temperature.
+
+    :param line: DAQ message
+    :type line: str
+    :returns: float or None
+    """
+    match = TEMPERATURE_PATTERN.match(line.strip())
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+class DAQLineParser(object):
+    """
+    Validates lines read from the DAQ card and runs the pulse extraction on
+    lines carrying trigger data.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+        # pulses are written to file by the consumer, so no pulse file here
+        self.pulse_extractor = PulseExtractor(logger, None)
+
+    def parse(self, line):
+        """
+        Validate line and extract pulses from it.
+
+        Returns None if the line is invalid. Otherwise a tuple of the line
+        and the extracted pulses is returned. The pulses are None if the line
+        did not complete an event.
+
+        :param line: DAQ message
+        :type line: str
+        :returns: tuple or None
+        """
+        if LINE_PATTERN.match(line) is None:
+            self.logger.warning("Got garbage from the DAQ: %s" %
+                                line.rstrip('\r\n'))
+            return None
+
+        pulses = None
+
+        if is_trigger_line(line.split()):
+            try:
+                pulses = self.pulse_extractor.extract(line)
+            except (ValueError, IndexError):
+                self.logger.debug("Unable to extract pulses from line '%s'" %
+                                  line)
+        return line, pulses
@@ -0,0 +1,272 @@
+"""
+Provides a stateful emulation of the command protocol spoken by the
+QNet DAQ cards. It is used by the virtual DAQ card and the DAQ simulation
+to answer commands like a real card would.
+"""
+from __future__ import print_function
+import datetime
+import logging
+
+from muonic.analysis.analyzer import BIT5, BIT7
+
+
+class DAQCardProtocol(object):
+    """
+    Emulates the replies of a DAQ card to commands. The card configuration
+    (thresholds, control registers, counter state) and the scalers are
+    kept as state. The time the card takes to reply to a command is given
+    by 'get_latency'.
+
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param scaler_source: callable returning the scalers, replaces the
+                          scalers counted with 'count'
+    :type scaler_source: callable
+    """
+
+    DEFAULT_THRESHOLDS = [300, 300, 300, 300]
+
+    # C0: all channels enabled, singles, no veto
+    # C2, C3: gate width of 100 ns in units of 10 ns
+    DEFAULT_REGISTERS = {0: 0x0F, 1: 0x71, 2: 0x0A, 3: 0x00}
+
+    # number of scalers: four channels and the trigger
+    SCALER_COUNT = 5
+
+    # barometer and temperature sensor readings
+    DEFAULT_PRESSURE = 1013.2  # mBar
+    DEFAULT_TEMPERATURE = 21.5  # degree Celsius
+
+    # time in seconds the card takes to reply to a command, the GPS
+    # receiver and the sensors are queried on demand
+    DEFAULT_LATENCY = 0.005
+    LATENCIES = {"BA": 0.05, "DG": 0.25, "TH": 0.05}
+
+    def __init__(self, logger=None, scaler_source=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+        self.scaler_source = scaler_source
+
+        self.thresholds = list(self.DEFAULT_THRESHOLDS)
+        self.registers = dict(self.DEFAULT_REGISTERS)
+        self.counter_enabled = True
+        self.status_interval = 0
+        self.scalers = [0] * self.SCALER_COUNT
+        self.pressure = self.DEFAULT_PRESSURE
+        self.temperature = self.DEFAULT_TEMPERATURE
+
+        self._handlers = {
+            "BA": self._barometer,
+            "CD": self._disable_counter,
+            "CE": self._enable_counter,
+            "DC": self._display_control_registers,
+            "DG": self._display_gps,
+            "DS": self._display_scalers,
+            "ST": self._status,
+            "TH": self._temperature,
+            "TL": self._thresholds,
+            "WC": self._write_control_register
+        }
+
+    def get_latency(self, command):
+        """
+        Get the time in seconds the card takes to reply to a command.
+
+        :param command: command sent to the card
+        :type command: str
+        :returns: float
+        """
+        args = command.split()
+        if not args:
+            return 0.
+        return self.LATENCIES.get(args[0].upper(), self.DEFAULT_LATENCY)
+
+    def get_scalers(self):
+        """
+        Get the scalers of the channels and the trigger.
+
+        :returns: list of int
+        """
+        if self.scaler_source is not None:
+            return self.scaler_source()
+        return self.scalers
+
+    def handle(self, command):
+        """
+        Process a command and return the reply lines of the card.
+        Like a real card, the command is echoed first.
+
+        :param command: command sent to the card
+        :type command: str
+        :returns: list of str
+        """
+        command = command.strip()
+
+        if not command:
+            return []
+
+        args = command.split()
+        handler = self._handlers.get(args[0].upper())
+
+        if handler is None:
+            self.logger.debug("unknown command '%s'" % command)
+            return [command]
+
+        try:
+            return [command] + handler(args[1:])
+        except (ValueError, IndexError):
+            self.logger.debug("invalid arguments for command '%s'" % command)
+            return [command]
+
+    def count(self, line):
+        """
+        Update the scalers with the pulses and triggers contained in a
+        trigger line emitted by the card.
+
+        :param line: DAQ trigger line
+        :type line: str
+        :returns: None
+        """
+        fields = line.split()
+
+        for ch in range(4):
+            if int(fields[1 + 2 * ch], 16) & BIT5:
+                self.scalers[ch] = (self.scalers[ch] + 1) & 0xFFFFFFFF
+
+        if int(fields[1], 16) & BIT7:
+            self.scalers[4] = (self.scalers[4] + 1) & 0xFFFFFFFF
+
+    def _enable_counter(self, args):
+        """
+        CE - enable counters, trigger lines are sent by the card
+
+        :param args: command arguments
+        :type args: list of str
+        :returns: list of str
+        """
+        self.counter_enabled = True
+        return []
+
+    def _disable_counter(self, args):
+        """
+        CD - disable counters, no trigger lines are sent by the card
+
+        :param args: command arguments
+        :type args: list of str
+        :returns: list of str
+        """
+        self.counter_enabled = False
+        return []
+
+    def _display_control_registers(self, args):
+        """
+        DC - display the control registers
+
+        :param args: command arguments
+        :type args: list of str
+        :returns: list of str
+        """
+        return ["DC " + " ".join(["C%d=%02X" % (i, self.registers[i])
+                                  for i in range(4)])]
+
+    def _write_control_register(self, args):
+        """
+        WC - write control register, e.g. 'WC 00 0F'
+
+        :param args: command arguments
+        :type args: list of str
+        :returns: list of str
+        """
+        self.registers[int(args[0], 16) & 0x03] = int(args[1], 16) & 0xFF
+        return []
+
+    def _thresholds(self, args):
+        """
+        TL - display thresholds or set threshold of a channel with
+        'TL <channel> <millivolts>'
+
+        :param args: command arguments
+        :type args: list of str
+        :returns: list of str
+        """
+        if len(args) >= 2:
+            channel = int(args[0])
+            if channel == 4:
+                # the card allows to set all channels at once
+                self.thresholds = [int(args[1])] * 4
+            else:
+                self.thresholds[channel] = int(args[1])
+            return []
+        return ["TL " + " ".join(["L%d=%d" % (i, self.thresholds[i])
+                                  for i in range(4)])]
+
+    def _display_scalers(self, args):
+        """
+        DS - display scalers of the channels and the trigger
+
+        :param args: command arguments
+        :type args: list of str
+        :returns: list of str
+        """
+        scalers = self.get_scalers()
+        return ["DS " + " ".join(["S%d=%08X" % (i, scalers[i])
+                                  for i in range(self.SCALER_COUNT)])]
+
+    def _status(self, args):
+        """
+        ST - set interval of the status reports in minutes with
+        'ST <minutes>' or print a status line
+
+        :param args: command arguments
+        :type args: list of str
+        :returns: list of str
+        """
+        if args:
+            self.status_interval = int(args[0])
+            return []
+        return ["ST %s %s %s %s %s" % tuple(["%08X" % scaler
+                                             for scaler in
+                                             self.get_scalers()])]
+
+    def _barometer(self, args):
+        """
+        BA - display the pressure of the barometer
+
+        :param args: command arguments
+        :type args: list of str
+        :returns: list of str
+        """
+        return ["BA Pressure mBar = %.1f" % self.pressure]
+
+    def _temperature(self, args):
+        """
+        TH - display the temperature of the sensor on the card
+
+        :param args: command arguments
+        :type args: list of str
+        :returns: list of str
+        """
+        return ["TH=%.1f" % self.temperature]
+
+    def _display_gps(self, args):
+        """
+        DG - display GPS information
+
+        :param args: command arguments
+        :type args: list of str
+        :returns: list of str
+        """
+        now = datetime.datetime.utcnow()
+        return ["DG GPS info:",
+                "Date+Time: %s" % now.strftime("%d/%m/%y %H:%M:%S.000"),
+                "Status:    A (valid)",
+                "PosFix#:   1",
+                "Latitude:  52:24.440 N",
+                "Longitude: 013:31.580 E",
+                "Altitude:  58.300m",
+                "Sats used: 7",
+                "PPS delay: +0000 msec",
+                "FPGA time: 00000000",
+                "U.T.C.:    +0000 sec",
+                "ChkSumErr: 0"]
@@ -7,17 +7,14 @@ import abc
 from future.utils import with_metaclass
 import logging
 import multiprocessing as mp
-import re
 import queue
-
-try:
-    import zmq
-except ImportError:
-    # DAQMissingDependencyError will be raised when trying to use zmq
-    pass
+import time
 
 from muonic.daq import DAQIOError, DAQMissingDependencyError
-from muonic.daq import DAQSimulationConnection, DAQConnection
+from muonic.daq.batch import BatchReader
+from muonic.daq.parser import LINE_PATTERN, DAQLineParser
+from muonic.daq.reconnect import CommandJournal
+from muonic.daq.simulation import DAQSimulation, DAQSimulationConnection
 
 
 class BaseDAQProvider(with_metaclass(abc.ABCMeta, object)):
@@ -29,12 +26,14 @@ class BaseDAQProvider(with_metaclass(abc.ABCMeta, object)):
     :type logger: logging.Logger
     """
 
-    LINE_PATTERN = re.compile("^[a-zA-Z0-9+-.,:()=$/#?!%_@*|~' ]*[\n\r]*$")
+    LINE_PATTERN = LINE_PATTERN
 
     def __init__(self, logger=None):
         if logger is None:
             logger = logging.getLogger()
         self.logger = logger
+        # True if lines are validated and decoded by the reader
+        self.preparse = False
 
     @abc.abstractmethod
     def get(self, *args):
@@ -47,6 +46,18 @@ class BaseDAQProvider(with_metaclass(abc.ABCMeta, object)):
         """
         return
 
+    def get_event(self, *args):
+        """
+        Get the next line from the DAQ together with the pulses extracted
+        from it. Providers which do not decode lines on their own always
+        return None as pulses.
+
+        :param args: queue arguments
+        :type args: list
+        :returns: tuple of str or None and tuple or None
+        """
+        return self.get(*args), None
+
     @abc.abstractmethod
     def put(self, *args):
         """
@@ -67,6 +78,25 @@ class BaseDAQProvider(with_metaclass(abc.ABCMeta, object)):
         """
         return
 
+    def get_downtime(self):
+        """
+        Get the accumulated time in seconds the connection to the DAQ card
+        was lost. Providers without reconnect handling always return 0.
+
+        :returns: float
+        """
+        return 0.
+
+    def get_receipt_time(self):
+        """
+        Get the time the last line returned by 'get' or 'get_event' was
+        received from the DAQ card in seconds since the epoch. Providers
+        without receipt timestamps return the current time.
+
+        :returns: float
+        """
+        return time.time()
+
     def _validate_line(self, line):
         """
         Validate line against pattern. Returns None it the provided line is
@@ -93,19 +123,54 @@ class DAQProvider(BaseDAQProvider):
     :type logger: logging.Logger
     :param sim: enables DAQ simulation if set to True
     :type sim: bool
+    :param preparse: validate lines and extract pulses in the reader process
+    :type preparse: bool
+    :param device: path of the tty device, skips device discovery
+    :type device: str
+    :param generator: generator for the trigger lines of the simulation
+    :type generator: muonic.daq.generator.EventGenerator
+    :param sim_rate: target rate of the simulation, unlimited if None or
+                     not positive
+    :type sim_rate: float or None
+    :param sim_rate_unit: unit of the simulation rate, 'lines' or
+                          'triggers' per second
+    :type sim_rate_unit: str
+    :param sim_seed: seed for a deterministic simulation
+    :type sim_seed: int or None
     """
 
-    def __init__(self, logger=None, sim=False):
+    def __init__(self, logger=None, sim=False, preparse=False, device=None,
+                 generator=None, sim_rate=DAQSimulation.DEFAULT_RATE,
+                 sim_rate_unit="lines", sim_seed=None):
         BaseDAQProvider.__init__(self, logger)
         self.out_queue = mp.Queue()
         self.in_queue = mp.Queue()
+        # configuration commands to replay after a reconnect
+        self.journal_queue = mp.Queue()
+        self.downtime = mp.Value('d', 0.)
+        # lines are received in batches with receipt time and sequence number
+        self.batch_reader = BatchReader(self.logger)
+        self.preparse = preparse
+
+        parser = None
+        if preparse:
+            parser = DAQLineParser(self.logger)
 
         if sim:
             self.daq = DAQSimulationConnection(self.in_queue, self.out_queue,
-                                               self.logger)
+                                               self.logger, parser=parser,
+                                               generator=generator,
+                                               rate=sim_rate,
+                                               rate_unit=sim_rate_unit,
+                                               seed=sim_seed)
         else:
+            # the serial connection is only needed for a real card
+            from muonic.daq.connection import DAQConnection
             self.daq = DAQConnection(self.in_queue, self.out_queue,
-                                     self.logger)
+                                     self.logger, parser=parser,
+                                     device=device,
+                                     journal_queue=self.journal_queue,
+                                     downtime=self.downtime)
         
         # Set up the thread to do asynchronous I/O. More can be made if
         # necessary. Set daemon flag so that the threads finish when the main
@@ -131,12 +196,47 @@ class DAQProvider(BaseDAQProvider):
         :returns: str or None -- next item from the queue
         :raises: DAQIOError
         """
-        try:
-            line = self.out_queue.get(*args)
-        except queue.Empty:
-            raise DAQIOError("Queue is empty")
+        if self.preparse:
+            return self.get_event(*args)[0]
 
-        return self._validate_line(line)
+        return self._validate_line(self._next_item(*args))
+
+    def get_event(self, *args):
+        """
+        Get the next line from the DAQ together with the pulses extracted
+        from it. Pulses are only extracted if 'preparse' is enabled.
+
+        Raises DAQIOError if the queue is empty.
+
+        :param args: queue arguments
+        :type args: list
+        :returns: tuple of str or None and tuple or None
+        :raises: DAQIOError
+        """
+        if not self.preparse:
+            return BaseDAQProvider.get_event(self, *args)
+
+        # lines were already validated by the reader
+        return self._next_item(*args)
+
+    def _next_item(self, *args):
+        """
+        Get the next item received from the reader. A new batch is only
+        taken from the queue if no items of the last one are pending.
+
+        Raises DAQIOError if the queue is empty.
+
+        :param args: queue arguments
+        :type args: list
+        :returns: str or tuple
+        :raises: DAQIOError
+        """
+        if not self.batch_reader:
+            try:
+                self.batch_reader.feed(self.out_queue.get(*args))
+            except queue.Empty:
+                raise DAQIOError("Queue is empty")
+        return self.batch_reader.pop()
 
     def put(self, *args):
         """
@@ -148,12 +248,18 @@ class DAQProvider(BaseDAQProvider):
         """
         self.in_queue.put(*args)
 
+        if args and CommandJournal.get_key(args[0]) is not None:
+            self.journal_queue.put(args[0])
+
     def data_available(self):
         """
         Tests if data is available from the DAQ.
 
         :returns: int or bool
         """
+        if self.batch_reader:
+            return len(self.batch_reader)
+
         try:
             size = self.out_queue.qsize()
         except NotImplementedError:
@@ -161,6 +267,46 @@ class DAQProvider(BaseDAQProvider):
             size = not self.out_queue.empty()
         return size
 
+    def get_downtime(self):
+        """
+        Get the accumulated time in seconds the connection to the DAQ card
+        was lost.
+
+        :returns: float
+        """
+        with self.downtime.get_lock():
+            return self.downtime.value
+
+    def get_receipt_time(self):
+        """
+        Get the time the last line returned by 'get' or 'get_event' was
+        received from the DAQ card in seconds since the epoch.
+
+        :returns: float
+        """
+        receipt_time = self.batch_reader.wall_time()
+        if receipt_time is None:
+            return time.time()
+        return receipt_time
+
+    def get_queue_latency(self):
+        """
+        Get the time in seconds the last batch of lines spent between
+        being read from the DAQ card and being taken from the queue.
+
+        :returns: float
+        """
+        return self.batch_reader.latency
+
+    def get_lost_batches(self):
+        """
+        Get the number of batches of lines which went missing between
+        the reader and the consumer.
+
+        :returns: int
+        """
+        return self.batch_reader.lost_batches
+
 
 class DAQClient(BaseDAQProvider):
     """
@@ -180,10 +326,12 @@ class DAQClient(BaseDAQProvider):
     def __init__(self, address='127.0.0.1', port=5556, logger=None):
         BaseDAQProvider.__init__(self, logger)
         try:
-            self.socket = zmq.Context().socket(zmq.PAIR)
-            self.socket.connect("tcp://%s:%d" % (address, port))
-        except NameError:
+            # zmq is only imported when it is used, it is optional
+            import zmq
+        except ImportError:
             raise DAQMissingDependencyError("no zmq installed...")
+        self.socket = zmq.Context().socket(zmq.PAIR)
+        self.socket.connect("tcp://%s:%d" % (address, port))
 
     def get(self, *args):
         """
@@ -0,0 +1,296 @@
+"""
+Provides the automatic reconnect to the DAQ card after the serial
+connection broke, e.g. because of a short USB dropout. The configuration
+of the card is replayed after reconnecting.
+"""
+from __future__ import print_function
+from collections import OrderedDict
+import logging
+import time
+
+import serial
+
+
+class CommandJournal(object):
+    """
+    Journal of the last applied configuration commands. Only the latest
+    command per configuration item is kept, e.g. one threshold per channel
+    and one value per control register.
+    """
+
+    # order in which the commands are replayed
+    REPLAY_ORDER = ["TL", "WC", "ST", "COUNTER"]
+
+    def __init__(self):
+        self._commands = OrderedDict()
+
+    @staticmethod
+    def get_key(command):
+        """
+        Get the journal key of a command. Returns None if the command does
+        not change the configuration of the card.
+
+        :param command: DAQ command
+        :type command: str
+        :returns: tuple or None
+        """
+        args = str(command).strip().split()
+
+        if not args:
+            return None
+
+        name = args[0].upper()
+
+        try:
+            if name == "TL" and len(args) >= 3:
+                return ("TL", int(args[1]))
+            if name == "WC" and len(args) >= 3:
+                return ("WC", int(args[1], 16))
+        except ValueError:
+            return None
+
+        if name == "ST" and len(args) >= 2:
+            return ("ST",)
+        if name in ["CE", "CD"]:
+            return ("COUNTER",)
+        return None
+
+    def record(self, command):
+        """
+        Record a command if it changes the configuration of the card.
+
+        Returns True if the command was recorded, False otherwise.
+
+        :param command: DAQ command
+        :type command: str
+        :returns: bool
+        """
+        key = self.get_key(command)
+
+        if key is None:
+            return False
+
+        if key == ("TL", 4):
+            # threshold for all channels overrides single channels
+            for channel in range(4):
+                self._commands.pop(("TL", channel), None)
+
+        self._commands[key] = str(command).strip()
+        return True
+
+    def commands(self):
+        """
+        Get the journaled commands in replay order.
+
+        :returns: list of str
+        """
+        commands = []
+        for name in self.REPLAY_ORDER:
+            commands += [cmd for key, cmd in self._commands.items()
+                         if key[0] == name]
+        return commands
+
+    def expected_thresholds(self):
+        """
+        Get the thresholds per channel set by the journaled commands.
+
+        :returns: dict
+        """
+        thresholds = dict()
+        if ("TL", 4) in self._commands:
+            value = int(self._commands[("TL", 4)].split()[2])
+            thresholds = dict([(channel, value) for channel in range(4)])
+        for channel in range(4):
+            if ("TL", channel) in self._commands:
+                thresholds[channel] = int(
+                        self._commands[("TL", channel)].split()[2])
+        return thresholds
+
+    def expected_registers(self):
+        """
+        Get the control register values set by the journaled commands.
+
+        :returns: dict
+        """
+        return dict([(key[1], int(cmd.split()[2], 16))
+                     for key, cmd in self._commands.items()
+                     if key[0] == "WC"])
+
+    def __len__(self):
+        return len(self._commands)
+
+
+class ReconnectManager(object):
+    """
+    Reopens the serial port with exponential backoff, replays the
+    configuration journal and verifies it with the 'TL' and 'DC' replies
+    of the card. The time without connection is accumulated as downtime.
+
+    :param open_port: callable which tries to open the serial port once and
+                      raises serial.SerialException or OSError on failure
+    :type open_port: callable
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param journal: configuration journal to replay after reconnecting
+    :type journal: CommandJournal
+    :param downtime: shared value to accumulate the downtime in seconds
+    :type downtime: multiprocessing.Value
+    :param min_delay: first delay between two attempts in seconds
+    :type min_delay: float
+    :param max_delay: maximum delay between two attempts in seconds
+    :type max_delay: float
+    :param factor: factor to increase the delay with after each attempt
+    :type factor: float
+    """
+
+    VERIFY_TIMEOUT = 2.0  # seconds
+
+    def __init__(self, open_port, logger=None, journal=None, downtime=None,
+                 min_delay=0.5, max_delay=30., factor=2.):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+        self.open_port = open_port
+        self.journal = journal
+        self.downtime = downtime
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.reconnects = 0
+
+    def reconnect(self, port, since=None):
+        """
+        Close the broken port and open a new one. Blocks until the
+        connection is reestablished and the configuration is replayed.
+
+        Returns the new port and the lines read from the card while
+        verifying the configuration.
+
+        :param port: the broken serial port
+        :type port: serial.Serial
+        :param since: time the connection broke, defaults to now
+        :type since: float
+        :returns: tuple of serial.Serial and list of str
+        """
+        if since is None:
+            since = time.time()
+
+        try:
+            port.close()
+        except (serial.SerialException, OSError):
+            pass
+
+        delay = self.min_delay
+
+        while True:
+            try:
+                port = self.open_port()
+                break
+            except (serial.SerialException, OSError) as e:
+                self.logger.error("Reconnect failed: %s" % str(e))
+                self.logger.error("Waiting %.1f seconds" % delay)
+                time.sleep(delay)
+                delay = min(delay * self.factor, self.max_delay)
+
+        lines = []
+
+        if self.journal is not None and len(self.journal):
+            lines = self.replay(port)
+
+        downtime = time.time() - since
+        self.reconnects += 1
+
+        if self.downtime is not None:
+            with self.downtime.get_lock():
+                self.downtime.value += downtime
+
+        self.logger.warning("Reconnected to DAQ card after %.2f seconds" %
+                            downtime)
+        return port, lines
+
+    def replay(self, port, retries=1):
+        """
+        Replay the configuration journal and verify the configuration.
+
+        Returns the lines read from the card while verifying.
+
+        :param port: serial port
+        :type port: serial.Serial
+        :param retries: number of replays if verification fails
+        :type retries: int
+        :returns: list of str
+        """
+        lines = []
+
+        for attempt in range(retries + 1):
+            for command in self.journal.commands():
+                self.logger.info("Replaying DAQ command '%s'" % command)
+                port.write((command + "\r").encode("ascii"))
+
+            verified, read_lines = self.verify(port)
+            lines += read_lines
+
+            if verified:
+                self.logger.info("DAQ configuration restored")
+                return lines
+
+        self.logger.error("Could not verify the DAQ configuration after " +
+                          "reconnect")
+        return lines
+
+    def verify(self, port):
+        """
+        Query thresholds and control registers and compare them with the
+        journal.
+
+        Returns a tuple of the verification result and the lines read.
+
+        :param port: serial port
+        :type port: serial.Serial
+        :returns: tuple of bool and list of str
+        """
+        port.write(b"TL\rDC\r")
+
+        thresholds = None
+        registers = None
+        lines = []
+        timeout = time.time() + self.VERIFY_TIMEOUT
+
+        while time.time() < timeout and (thresholds is None or
+                                         registers is None):
+            line = port.readline().decode("ascii", "replace").strip()
+
+            if not line:
+                continue
+
+            lines.append(line)
+            fields = line.split()
+
+            try:
+                if fields[0] == "TL" and len(fields) == 5:
+                    thresholds = dict([(i, int(f.split("=")[1]))
+                                       for i, f in enumerate(fields[1:])])
+                elif fields[0] == "DC" and len(fields) == 5:
+                    registers = dict([(i, int(f.split("=")[1], 16))
+                                      for i, f in enumerate(fields[1:])])
+            except (ValueError, IndexError):
+                continue
+
+        if thresholds is None or registers is None:
+            return False, lines
+
+        for channel, value in self.journal.expected_thresholds().items():
+            if thresholds.get(channel) != value:
+                self.logger.warning("Threshold of channel %d is %s, " %
+                                    (channel, thresholds.get(channel)) +
+                                    "expected %d" % value)
+                return False, lines
+
+        for register, value in self.journal.expected_registers().items():
+            if registers.get(register) != value:
+                self.logger.warning("Register C%d is %s, expected %02X" %
+                                    (register, registers.get(register),
+                                     value))
+                return False, lines
+
+        return True, lines
@@ -0,0 +1,308 @@
+"""
+Provides a DAQ provider which replays recorded RAW files. Lines are paced
+by the DAQ time reconstructed from the trigger counter, either in real
+time, scaled or as fast as possible. Commands are answered by an emulation
+of the card protocol.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from collections import deque
+import logging
+import time
+
+from muonic.analysis.analyzer import DEFAULT_FREQUENCY
+from muonic.daq import DAQIOError
+from muonic.daq.parser import DAQLineParser, is_trigger_line
+from muonic.daq.protocol import DAQCardProtocol
+from muonic.daq.provider import BaseDAQProvider
+from muonic.util import open_data_file
+
+# range of the trigger and 1PPS counters
+COUNTER_RANGE = 1 << 32
+
+
+class DAQClock(object):
+    """
+    Reconstructs the time of the DAQ card from the trigger counter of the
+    lines. Counter rollovers are unwrapped and the frequency of the card
+    is calibrated with the 1PPS counter if GPS is available.
+    """
+
+    def __init__(self):
+        self.time = 0.
+        self.frequency = DEFAULT_FREQUENCY
+        self._last_count = None
+        self._last_one_pps = None
+
+    def reset(self):
+        """
+        Forget the last counter values, e.g. when a new run starts. The
+        time continues from its current value.
+
+        :returns: None
+        """
+        self._last_count = None
+        self._last_one_pps = None
+
+    def update(self, fields):
+        """
+        Advance the clock to the time of a trigger line.
+
+        :param fields: DAQ trigger line split on whitespaces
+        :type fields: list of str
+        :returns: float -- DAQ time in seconds
+        """
+        count = int(fields[0], 16)
+        one_pps = int(fields[9], 16)
+
+        if self._last_one_pps is not None and one_pps != self._last_one_pps:
+            ticks = (one_pps - self._last_one_pps) % COUNTER_RANGE
+            # only consecutive 1PPS give the frequency
+            if 0.5 * DEFAULT_FREQUENCY < ticks < 1.5 * DEFAULT_FREQUENCY:
+                self.frequency = float(ticks)
+        self._last_one_pps = one_pps
+
+        if self._last_count is not None:
+            self.time += ((count - self._last_count) % COUNTER_RANGE /
+                          self.frequency)
+        self._last_count = count
+
+        return self.time
+
+
+class ReplayDAQProvider(BaseDAQProvider):
+    """
+    Replays a RAW file as if it was read from a DAQ card. Lines are
+    released when they are due according to the reconstructed DAQ time
+    and the replay speed. Commands are answered like a card would, the
+    scalers count the replayed pulses.
+
+    Replay is deterministic: no processes are started and lines are only
+    read when they are asked for.
+
+    :param filename: path of the RAW file, may be compressed with gzip or
+                     bzip2
+    :type filename: str
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param speed: replay speed relative to real time, replays as fast as
+                  possible if None or not positive
+    :type speed: float or None
+    :param preparse: extract pulses while replaying
+    :type preparse: bool
+    :param loop: start over at the end of the file
+    :type loop: bool
+    """
+
+    def __init__(self, filename, logger=None, speed=1., preparse=False,
+                 loop=False):
+        BaseDAQProvider.__init__(self, logger)
+        self.filename = filename
+        self.speed = speed if speed is not None and speed > 0 else None
+        self.preparse = preparse
+        self.loop = loop
+
+        self.protocol = DAQCardProtocol(self.logger)
+        self.clock = DAQClock()
+        self.parser = DAQLineParser(self.logger) if preparse else None
+
+        self.lines_replayed = 0
+        self.finished = False
+
+        self._data = open_data_file(self.filename)
+        self._replies = deque()
+        self._next_line = None
+        self._next_due = None
+        self._start_time = None
+        self._start_daq_time = None
+        self._receipt_time = None
+
+    def _read_next(self):
+        """
+        Read the next line from the file and compute when it is due.
+
+        :returns: None
+        """
+        while self._next_line is None:
+            line = self._data.readline()
+
+            if not line:
+                if not self.loop:
+                    self.finished = True
+                    return
+                self._data.close()
+                self._data = open_data_file(self.filename)
+                self.clock.reset()
+                continue
+
+            line = line.strip()
+
+            if not line:
+                continue
+
+            if line.startswith("#"):
+                # a new run starts, the trigger counter is not continuous
+                self.clock.reset()
+                continue
+
+            fields = line.split()
+            if is_trigger_line(fields):
+                try:
+                    daq_time = self.clock.update(fields)
+                except ValueError:
+                    daq_time = self.clock.time
+            else:
+                daq_time = self.clock.time
+
+            self._next_line = line
+
+            if self.speed is None:
+                self._next_due = None
+                continue
+
+            if self._start_time is None:
+                self._start_time = time.time()
+                self._start_daq_time = daq_time
+
+            self._next_due = (self._start_time +
+                              (daq_time - self._start_daq_time) / self.speed)
+
+    def _is_due(self):
+        """
+        Returns True if the next line of the file is due.
+
+        :returns: bool
+        """
+        self._read_next()
+
+        if self._next_line is None:
+            return False
+        return self._next_due is None or self._next_due <= time.time()
+
+    def get(self, *args):
+        """
+        Get the next reply or replayed line.
+
+        Raises DAQIOError if no line is due.
+
+        :param args: queue arguments, ignored
+        :type args: list
+        :returns: str
+        :raises: DAQIOError
+        """
+        return self.get_event(*args)[0]
+
+    def get_event(self, *args):
+        """
+        Get the next reply or replayed line together with the pulses
+        extracted from it. Pulses are only extracted if 'preparse' is
+        enabled.
+
+        Raises DAQIOError if no line is due.
+
+        :param args: queue arguments, ignored
+        :type args: list
+        :returns: tuple of str and tuple or None
+        :raises: DAQIOError
+        """
+        if self._replies:
+            self._receipt_time = time.time()
+            return self._replies.popleft(), None
+
+        if not self._is_due():
+            raise DAQIOError("No data available")
+
+        line = self._next_line
+        self._receipt_time = self._next_due or time.time()
+        self._next_line = None
+        self.lines_replayed += 1
+
+        fields = line.split()
+        if is_trigger_line(fields):
+            try:
+                self.protocol.count(line)
+            except ValueError:
+                pass
+
+        if self.parser is None:
+            return self._validate_line(line), None
+
+        parsed = self.parser.parse(line)
+        if parsed is None:
+            return None, None
+        return parsed
+
+    def put(self, *args):
+        """
+        Send a command to the emulated card. The replies are returned by
+        the next calls to 'get'.
+
+        :param args: queue arguments
+        :type args: list
+        :returns: None
+        """
+        self._replies.extend(self.protocol.handle(str(args[0])))
+
+    def data_available(self):
+        """
+        Tests if a reply or a replayed line is available.
+
+        :returns: int or bool
+        """
+        return len(self._replies) or self._is_due()
+
+    def get_receipt_time(self):
+        """
+        Get the time the last line returned by 'get' or 'get_event' was
+        scheduled for in seconds since the epoch.
+
+        :returns: float
+        """
+        if self._receipt_time is None:
+            return BaseDAQProvider.get_receipt_time(self)
+        return self._receipt_time
+
+    def close(self):
+        """
+        Close the RAW file.
+
+        :returns: None
+        """
+        self._data.close()
+        self.finished = True
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Replay a RAW file and report the " +
+                                        "replay rate")
+    parser.add_argument("filename", help="RAW file, may be compressed")
+    parser.add_argument("-x", "--speed", dest="speed", type=float,
+                        default=None, help="replay speed relative to real " +
+                                           "time (default: as fast as " +
+                                           "possible)")
+    parser.add_argument("--preparse", dest="preparse", action="store_true",
+                        default=False, help="extract pulses while replaying")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    daq = ReplayDAQProvider(args.filename, speed=args.speed,
+                            preparse=args.preparse)
+    events = 0
+    start = time.time()
+
+    while not daq.finished:
+        if not daq.data_available():
+            time.sleep(0.001)
+            continue
+        if daq.get_event()[1] is not None:
+            events += 1
+
+    elapsed = time.time() - start
+    daq.close()
+
+    print("replayed %d lines (%d events) in %.2f s: %.0f lines/s" %
+          (daq.lines_replayed, events, elapsed,
+           daq.lines_replayed / elapsed))
+    print("DAQ time %.2f s, frequency %.0f Hz" % (daq.clock.time,
+                                                  daq.clock.frequency))
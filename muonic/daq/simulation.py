@@ -3,53 +3,364 @@ Provides a simple DAQ card simulation, so that software can be tested.
 """
 from __future__ import print_function
 import abc
+from argparse import ArgumentParser
+from collections import deque
+import datetime
 from future.utils import with_metaclass
+import hashlib
 import logging
+import mmap
 import numpy as np
+import os
 from os import path
 import queue
-from random import choice
+import tempfile
 import time
 
-try:
-    import zmq
-except ImportError:
-    # DAQMissingDependencyError will be raised when trying to use zmq
-    pass
-
 from muonic.daq import DAQMissingDependencyError
+from muonic.daq.batch import BatchWriter, monotonic
+from muonic.daq.decoder import cumulative_scalers, decode_lines, find_lines
+from muonic.daq.decoder import trigger_flags
+from muonic.daq.generator import EventGenerator
+from muonic.daq.protocol import DAQCardProtocol
+
+
+class TokenBucket(object):
+    """
+    Token bucket to pace the simulation. Tokens are added with a constant
+    rate up to the capacity of the bucket, each emitted unit consumes one
+    token.
+
+    :param rate: tokens per second, unlimited if None or not positive
+    :type rate: float or None
+    :param burst: time in seconds the capacity of the bucket lasts
+    :type burst: float
+    """
+
+    def __init__(self, rate, burst=0.1):
+        self.rate = rate if rate is not None and rate > 0 else None
+        self.capacity = 1.
+        if self.rate is not None:
+            self.capacity = max(self.rate * burst, 1.)
+        self.tokens = 0.
+        self._last_refill = monotonic()
+
+    def refill(self):
+        """
+        Add the tokens accumulated since the last refill.
+
+        :returns: None
+        """
+        now = monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.tokens + (now - self._last_refill) *
+                              self.rate, self.capacity)
+        self._last_refill = now
+
+    def available(self, tokens=1.):
+        """
+        Returns True if the bucket holds enough tokens.
+
+        :param tokens: number of tokens needed
+        :type tokens: float
+        :returns: bool
+        """
+        if self.rate is None:
+            return True
+        self.refill()
+        return self.tokens >= tokens
+
+    def consume(self, tokens=1.):
+        """
+        Take tokens from the bucket. The bucket may run into debt which is
+        paid back by the following refills.
+
+        :param tokens: number of tokens to take
+        :type tokens: float
+        :returns: None
+        """
+        if self.rate is not None:
+            self.tokens -= tokens
+
+    def wait_time(self, tokens=1.):
+        """
+        Get the time in seconds until enough tokens are available.
+
+        :param tokens: number of tokens needed
+        :type tokens: float
+        :returns: float
+        """
+        if self.rate is None:
+            return 0.
+        self.refill()
+        return max(tokens - self.tokens, 0.) / self.rate
+
+
+class LineBlock(object):
+    """
+    Lines held in a buffer together with their trigger flags and the
+    cumulative counts of the scalers, so that the scalers after any number
+    of lines are known without counting again.
+
+    :param buf: buffer holding the lines
+    :type buf: memoryview
+    :param starts: start offsets of the lines
+    :type starts: numpy.ndarray
+    :param ends: end offsets of the lines
+    :type ends: numpy.ndarray
+    :param decoded: decoded lines
+    :type decoded: numpy.ndarray of muonic.daq.decoder.DECODED_DTYPE
+    """
+
+    def __init__(self, buf, starts, ends, decoded):
+        self._view = buf
+        self.starts = starts
+        self.ends = ends
+        self.decoded = decoded
+        self.triggers = trigger_flags(decoded)
+        self.scalers = cumulative_scalers(decoded)
+
+    def line(self, index):
+        """
+        Get a line without line ending.
+
+        :param index: index of the line
+        :type index: int
+        :returns: memoryview
+        """
+        return self._view[self.starts[index]:self.ends[index]]
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class SimulationData(LineBlock):
+    """
+    Memory mapped simulation data file. The lines are located once and
+    returned as memoryview slices of the mapping, so reading a line copies
+    nothing and starting over at the end of the file is free.
+
+    The line index and the decoded trigger lines are cached in the cache
+    directory, so that they are only computed once per file.
+
+    :param filename: path of the simulation data file
+    :type filename: str
+    :param logger: logger object
+    :type logger: logging.Logger
+    :param cache_dir: directory for the cached index, caching is disabled
+                      if None
+    :type cache_dir: str
+    :raises: ValueError
+    """
+
+    DEFAULT_CACHE_DIR = path.join(tempfile.gettempdir(), "muonic")
+    # increase if the format of the cached index changes
+    CACHE_VERSION = 1
+
+    def __init__(self, filename, logger=None, cache_dir=DEFAULT_CACHE_DIR):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+        self.filename = filename
+
+        self._file = open(filename, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("simulation data file '%s' is empty" % filename)
+        self._view = memoryview(self._mmap)
+        self.starts = self.ends = self.decoded = None
+
+        self._cache_file = None
+        if cache_dir is not None:
+            self._cache_file = self._get_cache_file(cache_dir)
+
+        if not self._load_cache():
+            self._build_index()
+            self._save_cache()
+
+        if not len(self.starts):
+            self.close()
+            raise ValueError("simulation data file '%s' has no lines" %
+                             filename)
+
+        LineBlock.__init__(self, self._view, self.starts, self.ends,
+                           self.decoded)
+
+    def _get_cache_file(self, cache_dir):
+        """
+        Get the path of the cache file. The name depends on the path, size
+        and modification time of the data file, so outdated caches are not
+        used.
+
+        :param cache_dir: cache directory
+        :type cache_dir: str
+        :returns: str
+        """
+        stat = os.stat(self.filename)
+        key = "%s:%d:%d:%d" % (path.abspath(self.filename), stat.st_size,
+                               int(stat.st_mtime), self.CACHE_VERSION)
+        return path.join(cache_dir, "%s-%s.npz" % (
+            path.basename(self.filename),
+            hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]))
+
+    def _build_index(self):
+        """
+        Locate and decode the lines of the data file.
+
+        :returns: None
+        """
+        data = np.frombuffer(self._mmap, dtype=np.uint8)
+        self.starts, self.ends = find_lines(data)
+        self.decoded = decode_lines(data, self.starts, self.ends)
+        # release the buffer, so that the mapping can be closed
+        del data
+
+    def _load_cache(self):
+        """
+        Load the line index from the cache.
+
+        Returns True if the cache was loaded.
+
+        :returns: bool
+        """
+        if self._cache_file is None or not path.exists(self._cache_file):
+            return False
+
+        try:
+            with np.load(self._cache_file) as cache:
+                self.starts = cache["starts"]
+                self.ends = cache["ends"]
+                self.decoded = cache["decoded"]
+        except (IOError, OSError, KeyError, ValueError) as e:
+            self.logger.debug("Could not load simulation cache: %s" % str(e))
+            return False
+
+        self.logger.debug("Loaded simulation cache %s" % self._cache_file)
+        return True
+
+    def _save_cache(self):
+        """
+        Save the line index to the cache. Errors are only logged, the index
+        is rebuilt next time.
+
+        :returns: None
+        """
+        if self._cache_file is None:
+            return
+
+        tmp_file = "%s.%d.tmp" % (self._cache_file, os.getpid())
+
+        try:
+            if not path.exists(path.dirname(self._cache_file)):
+                os.makedirs(path.dirname(self._cache_file))
+            with open(tmp_file, "wb") as f:
+                np.savez(f, starts=self.starts, ends=self.ends,
+                         decoded=self.decoded)
+            os.rename(tmp_file, self._cache_file)
+        except (IOError, OSError) as e:
+            self.logger.debug("Could not save simulation cache: %s" % str(e))
+
+    def close(self):
+        """
+        Close the mapping and the file.
+
+        :returns: None
+        """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+            self._mmap.close()
+            self._file.close()
 
 
 class DAQSimulation(object):
     """
     Simulates reading from and writing to DAQ card.
 
+    The output is paced by a token bucket with a target rate of either
+    lines or triggers per second. Without a rate, lines are delivered as
+    fast as they are read.
+
+    Commands are answered by an emulation of the card protocol. Replies
+    are delivered after the latency of the card and take precedence over
+    the simulated trigger lines.
+
+    If a seed is given, the simulation is deterministic: the trigger lines
+    are generated by an EventGenerator seeded with it and starting at a
+    fixed time, so the same seed always yields the same lines regardless
+    of the pacing.
+
     :param logger: logger object
     :type logger: logging.Logger
     :param simulation_file: path to the simulation data file
     :type simulation_file: str
+    :param generator: generator for trigger lines, replaces the simulation
+                      data file
+    :type generator: muonic.daq.generator.EventGenerator
+    :param rate: target rate, unlimited if None or not positive
+    :type rate: float or None
+    :param rate_unit: unit of the rate, 'lines' or 'triggers' per second
+    :type rate_unit: str
+    :param seed: seed for deterministic simulation, ignored if a generator
+                 is given
+    :type seed: int or None
+    :raises: ValueError
     """
 
     DEFAULT_SIMULATION_FILE = path.abspath(path.join(
             path.dirname(__file__), "simdaq.txt"))
-    LINES_TO_PUSH = 10
+    DEFAULT_RATE = 10.
+    RATE_UNITS = ["lines", "triggers"]
+    # number of muons to generate at once if a generator is used
+    GENERATOR_BATCH_SIZE = 1000
+    # UTC time of the first event of deterministic simulations
+    SEEDED_START_TIME = datetime.datetime(2020, 1, 1)
+
+    def __init__(self, logger, simulation_file=None, generator=None,
+                 rate=DEFAULT_RATE, rate_unit="lines", seed=None):
+        if rate_unit not in self.RATE_UNITS:
+            raise ValueError("unknown rate unit '%s'" % rate_unit)
 
-    def __init__(self, logger, simulation_file=None):
         self.logger = logger
-        self.initial = True
-        self._pushed_lines = 0
 
         if simulation_file is None:
             # use packaged simulation file
             simulation_file = self.DEFAULT_SIMULATION_FILE
         self._simulation_file = simulation_file
-        self._daq = open(self._simulation_file)
-        self._in_waiting = True
-        self._return_info = False
 
-        self._scalars_ch = [0, 0, 0, 0]
-        self._scalars_trigger = 0
-        self._scalars_to_return = ''
+        self.seed = seed
+        if generator is None and seed is not None:
+            self.logger.info("Deterministic simulation with seed %d" % seed)
+            generator = EventGenerator(start_time=self.SEEDED_START_TIME,
+                                       seed=seed)
+        self._generator = generator
+        self._data = None
+        if generator is None:
+            self._data = SimulationData(simulation_file, self.logger)
+
+        # lines are emitted from blocks, either the whole simulation data
+        # file or a batch of generated lines
+        self._block = None
+        self._block_pos = 0
+        # next line and whether it carries the trigger flag
+        self._next = None
+
+        self.rate_unit = rate_unit
+        self.bucket = TokenBucket(rate)
+        self.lines_emitted = 0
+        self.triggers_emitted = 0
+
+        # scalers of all blocks emitted completely
+        self._scaler_base = np.zeros(5, dtype=np.int64)
+
+        self.protocol = DAQCardProtocol(self.logger,
+                                        scaler_source=self.get_scalers)
+        # replies to commands with the time they are due
+        self._replies = deque()
+        self._next_status = None
 
     def __del__(self):
         """
@@ -57,93 +368,190 @@ class DAQSimulation(object):
 
         :returns: None
         """
-        if isinstance(self._daq, file) and not self._daq.closed:
-            self._daq.close()
+        data = getattr(self, "_data", None)
+        if data is not None:
+            data.close()
 
-    def _physics(self):
+    def get_scalers(self):
         """
-        This routine will increase the scalars variables using predefined
-        rates. Rates are drawn from Poisson distributions.
+        Get the scalers of channels 0 to 3 and of the trigger. They count
+        the leading edges and trigger flags of all lines emitted so far and
+        roll over at 32 bits like the scalers of the card.
+
+        :returns: list of int
+        """
+        scalers = self._scaler_base.copy()
+        if self._block is not None:
+            scalers += self._block.scalers[self._block_pos]
+        return [int(value) % (1 << 32) for value in scalers]
+
+    def _next_block(self):
+        """
+        Continue with the next block of lines. The simulation data file is
+        started over, the generator generates a new batch.
 
         :returns: None
         """
-        def poisson_choice(lam, size):
-            return int(choice(np.random.poisson(lam, size)))
-
-        def format_to_8digits(hex_string):
-            return hex_string.zfill(8)
-
-        def format_scalar(val):
-            return format_to_8digits(hex(val)[2:])
-
-        # draw rates from a poisson distribution.
-        self._scalars_ch[0] += poisson_choice(12, 100)
-        self._scalars_ch[1] += poisson_choice(10, 100)
-        self._scalars_ch[2] += poisson_choice(8, 100)
-        self._scalars_ch[3] += poisson_choice(11, 100)
-        self._scalars_trigger += poisson_choice(2, 100)
-        self._scalars_to_return = 'DS S0=%s S1=%s S2=%s S3=%s S4=%s' % \
-                                  (format_scalar(self._scalars_ch[0]),
-                                   format_scalar(self._scalars_ch[1]),
-                                   format_scalar(self._scalars_ch[2]),
-                                   format_scalar(self._scalars_ch[3]),
-                                   format_scalar(self._scalars_trigger))
-        self.logger.debug("Scalars to return %s" % self._scalars_to_return)
+        if self._block is not None:
+            self._scaler_base += self._block.scalers[-1]
+
+        if self._generator is None:
+            self._block = self._data
+        else:
+            buf = np.zeros(0, dtype=np.uint8)
+            # muons may miss all channels
+            while not len(buf):
+                buf = self._generator.generate(
+                        self.GENERATOR_BATCH_SIZE).ravel()
+            starts, ends = find_lines(buf)
+            self._block = LineBlock(memoryview(buf), starts, ends,
+                                    decode_lines(buf, starts, ends))
+
+        self._block_pos = 0
+
+    def _peek(self):
+        """
+        Read the next simulated line ahead, so that its cost is known
+        before it is emitted.
+
+        :returns: tuple of str and bool -- line and trigger flag
+        """
+        if self._next is not None:
+            return self._next
+
+        if self._block is None or self._block_pos >= len(self._block):
+            self._next_block()
+
+        line = self._block.line(self._block_pos).tobytes().decode("ascii",
+                                                                  "replace")
+        self._next = line, bool(self._block.triggers[self._block_pos])
+        return self._next
+
+    def _cost(self, trigger):
+        """
+        Get the number of tokens needed to emit a line.
+
+        :param trigger: True if the line carries the trigger flag
+        :type trigger: bool
+        :returns: float
+        """
+        if self.rate_unit == "triggers":
+            return 1. if trigger else 0.
+        return 1.
+
+    def _reply_due(self):
+        """
+        Returns True if a reply to a command is due. Status lines are
+        queued as replies when the status interval set with 'ST' passed.
+
+        :returns: bool
+        """
+        now = monotonic()
+
+        if self.protocol.status_interval > 0:
+            if self._next_status is None:
+                self._next_status = now + self.protocol.status_interval * 60
+            elif self._next_status <= now:
+                self._next_status += self.protocol.status_interval * 60
+                for line in self.protocol.handle("ST")[1:]:
+                    self._replies.append((now, line))
+        else:
+            self._next_status = None
+
+        return bool(self._replies) and self._replies[0][0] <= now
 
     def readline(self):
         """
-        Read dummy pulses from the simdaq file till the configured value is
-        reached.
+        Read the next dummy line from the simulation data file or the
+        generator. Replies to commands which are due are returned first.
 
         :returns: str -- next simulated DAQ output
         """
-        if self.initial:
-            self.initial = False
-            return "T0=42  T1=42  T2=42  T3=42"
+        if self._reply_due():
+            return self._replies.popleft()[1]
 
-        if self._return_info:
-            self._return_info = False
-            return self._scalars_to_return
+        line, trigger = self._peek()
+        self._next = None
+        self._block_pos += 1
 
-        self._pushed_lines += 1
-        if self._pushed_lines < self.LINES_TO_PUSH:
-            line = self._daq.readline()
-            if not line:
-                self._daq = open(self._simulation_file)
-                self.logger.debug("File reloaded")
-                line = self._daq.readline()
+        self.bucket.consume(self._cost(trigger))
 
-            return line
-        else:
-            self._pushed_lines = 0
-            self._in_waiting = False
-            return self._daq.readline()
+        self.lines_emitted += 1
+        if trigger:
+            self.triggers_emitted += 1
+
+        return line
 
     def write(self, command):
         """
-        Trigger a simulated daq response with command.
+        Send commands to the simulated DAQ card. The card echoes each
+        command and replies after its latency.
 
-        :param command: Command to send (simulated) to the DAQ card
+        :param command: Command to send (simulated) to the DAQ card, several
+                        commands are separated by carriage returns
         :type command: str
         :returns: None
         """
         self.logger.debug("got the following command %s" % command)
-        if "DS" in command:
-            self._return_info = True
+
+        for cmd in command.split("\r"):
+            lines = self.protocol.handle(cmd)
+            if not lines:
+                continue
+
+            now = monotonic()
+            # replies of a command follow the previous ones
+            due = now + self.protocol.get_latency(cmd)
+            if self._replies:
+                due = max(due, self._replies[-1][0])
+
+            self._replies.append((now, lines[0]))
+            self._replies.extend([(due, line) for line in lines[1:]])
 
     def in_waiting(self):
         """
-        Simulate a busy DAQ.
+        Returns True if a reply or the next simulated line is due.
 
         :returns: bool
         """
-        if self._in_waiting:
-            time.sleep(0.1)
-            self._physics()
+        if self._reply_due():
             return True
-        else:
-            self._in_waiting = True
+        if not self.protocol.counter_enabled:
             return False
+        return self.bucket.available(self._cost(self._peek()[1]))
+
+    def wait_time(self):
+        """
+        Get the time in seconds until a reply or the next simulated line is
+        due.
+
+        :returns: float
+        """
+        wait_time = None
+
+        if self._replies:
+            wait_time = max(self._replies[0][0] - monotonic(), 0.)
+
+        if self.protocol.counter_enabled:
+            line_wait_time = self.bucket.wait_time(
+                    self._cost(self._peek()[1]))
+            if wait_time is None or line_wait_time < wait_time:
+                wait_time = line_wait_time
+
+        if wait_time is None:
+            # nothing will happen before the next command
+            return float("inf")
+        return wait_time
+
+    def get_target_rate(self):
+        """
+        Get a description of the target rate.
+
+        :returns: str
+        """
+        if self.bucket.rate is None:
+            return "unlimited"
+        return "%g %s/s" % (self.bucket.rate, self.rate_unit)
 
 
 class BaseDAQSimulationConnection(with_metaclass(abc.ABCMeta, object)):
@@ -152,15 +560,68 @@ class BaseDAQSimulationConnection(with_metaclass(abc.ABCMeta, object)):
 
     :param logger: logger object
     :type logger: logging.Logger
+    :param generator: generator for trigger lines, see DAQSimulation
+    :type generator: muonic.daq.generator.EventGenerator
+    :param rate: target rate of the simulation, see DAQSimulation
+    :type rate: float or None
+    :param rate_unit: unit of the rate, see DAQSimulation
+    :type rate_unit: str
+    :param seed: seed for deterministic simulation, see DAQSimulation
+    :type seed: int or None
     """
 
-    def __init__(self, logger=None):
+    # maximum number of lines handed over at once
+    MAX_BATCH_SIZE = 1000
+    # maximum time in seconds to wait for the next line, so that commands
+    # are still handled in time
+    MAX_WAIT_TIME = 0.01
+    # interval in seconds to report the achieved rate in
+    REPORT_INTERVAL = 10.
+
+    def __init__(self, logger=None, generator=None,
+                 rate=DAQSimulation.DEFAULT_RATE, rate_unit="lines",
+                 seed=None):
         if logger is None:
             logger = logging.getLogger()
         self.logger = logger
-        self.serial_port = DAQSimulation(self.logger)
+        self.serial_port = DAQSimulation(self.logger, generator=generator,
+                                         rate=rate, rate_unit=rate_unit,
+                                         seed=seed)
         self.running = 1
 
+        self._last_report = monotonic()
+        self._last_lines = 0
+        self._last_triggers = 0
+
+    def report_rate(self):
+        """
+        Log the rate the simulation achieved since the last report, once
+        every REPORT_INTERVAL seconds.
+
+        Returns the achieved lines and triggers per second or None if no
+        report is due.
+
+        :returns: tuple of float or None
+        """
+        now = monotonic()
+        elapsed = now - self._last_report
+
+        if elapsed < self.REPORT_INTERVAL:
+            return None
+
+        sim = self.serial_port
+        line_rate = (sim.lines_emitted - self._last_lines) / elapsed
+        trigger_rate = (sim.triggers_emitted - self._last_triggers) / elapsed
+
+        self._last_report = now
+        self._last_lines = sim.lines_emitted
+        self._last_triggers = sim.triggers_emitted
+
+        self.logger.info("Simulation achieved %.1f lines/s and " % line_rate +
+                         "%.1f triggers/s (target: %s)" %
+                         (trigger_rate, sim.get_target_rate()))
+        return line_rate, trigger_rate
+
     @abc.abstractmethod
     def read(self):
         """
@@ -177,16 +638,33 @@ class DAQSimulationConnection(BaseDAQSimulationConnection):
 
     :param in_queue: queue for incoming data
     :type in_queue: multiprocessing.Queue
-    :param out_queue: queue for outgoing data
+    :param out_queue: queue for outgoing batches of lines, see
+                      muonic.daq.batch.BatchWriter
     :type out_queue: multiprocessing.Queue
     :param logger: logger object
     :type logger: logging.Logger
+    :param parser: parser to validate and decode lines before they are
+                   put into the outgoing queue
+    :type parser: muonic.daq.parser.DAQLineParser
+    :param generator: generator for trigger lines, see DAQSimulation
+    :type generator: muonic.daq.generator.EventGenerator
+    :param rate: target rate of the simulation, see DAQSimulation
+    :type rate: float or None
+    :param rate_unit: unit of the rate, see DAQSimulation
+    :type rate_unit: str
+    :param seed: seed for deterministic simulation, see DAQSimulation
+    :type seed: int or None
     """
 
-    def __init__(self, in_queue, out_queue, logger=None):
-        BaseDAQSimulationConnection.__init__(self, logger)
+    def __init__(self, in_queue, out_queue, logger=None, parser=None,
+                 generator=None, rate=DAQSimulation.DEFAULT_RATE,
+                 rate_unit="lines", seed=None):
+        BaseDAQSimulationConnection.__init__(self, logger, generator, rate,
+                                             rate_unit, seed)
         self.in_queue = in_queue
         self.out_queue = out_queue
+        self.batch_writer = BatchWriter(out_queue)
+        self.parser = parser
 
     def read(self):
         """
@@ -212,9 +690,23 @@ class DAQSimulationConnection(BaseDAQSimulationConnection):
                     except queue.Empty:
                         pass
 
-            while self.serial_port.in_waiting():
-                self.out_queue.put(self.serial_port.readline().strip())
-            time.sleep(0.02)
+            # hand over all lines which are due in one batch
+            receipt_time = monotonic()
+            items = []
+            while (len(items) < self.MAX_BATCH_SIZE and
+                   self.serial_port.in_waiting()):
+                items.append(self.serial_port.readline().strip())
+
+            if self.parser is not None:
+                items = [item for item in map(self.parser.parse, items)
+                         if item is not None]
+            self.batch_writer.put(items, receipt_time)
+            self.report_rate()
+
+            # only sleep until the next line is due
+            wait_time = min(self.serial_port.wait_time(), self.MAX_WAIT_TIME)
+            if wait_time > 0:
+                time.sleep(wait_time)
 
 
 class DAQSimulationServer(BaseDAQSimulationConnection):
@@ -229,16 +721,27 @@ class DAQSimulationServer(BaseDAQSimulationConnection):
     :type port: int
     :param logger: logger object
     :type logger: logging.Logger
+    :param rate: target rate of the simulation, see DAQSimulation
+    :type rate: float or None
+    :param rate_unit: unit of the rate, see DAQSimulation
+    :type rate_unit: str
+    :param seed: seed for deterministic simulation, see DAQSimulation
+    :type seed: int or None
     :raises: DAQMissingDependencyError
     """
 
-    def __init__(self, address='127.0.0.1', port=5556, logger=None):
-        BaseDAQSimulationConnection.__init__(self, logger)
+    def __init__(self, address='127.0.0.1', port=5556, logger=None,
+                 rate=DAQSimulation.DEFAULT_RATE, rate_unit="lines",
+                 seed=None):
+        BaseDAQSimulationConnection.__init__(self, logger, rate=rate,
+                                             rate_unit=rate_unit, seed=seed)
         try:
-            self.socket = zmq.Context().socket(zmq.PAIR)
-            self.socket.bind("tcp://%s:%d" % (address, port))
-        except NameError:
+            # zmq is only imported when it is used, it is optional
+            import zmq
+        except ImportError:
             raise DAQMissingDependencyError("no zmq installed...")
+        self.socket = zmq.Context().socket(zmq.PAIR)
+        self.socket.bind("tcp://%s:%d" % (address, port))
 
     def serve(self):
         """
@@ -256,14 +759,123 @@ class DAQSimulationServer(BaseDAQSimulationConnection):
         :returns: None
         """
         while self.running:
-            msg = self.socket.recv_string()
-            self.serial_port.write(str(msg) + "\r")
-            
-            while self.serial_port.in_waiting():
+            # wait for commands until the next line is due, replies are
+            # sent once their latency passed
+            wait_time = min(self.serial_port.wait_time(), self.MAX_WAIT_TIME)
+            if self.socket.poll(int(wait_time * 1000)):
+                msg = self.socket.recv_string()
+                self.serial_port.write(str(msg) + "\r")
+
+            lines = 0
+            while (lines < self.MAX_BATCH_SIZE and
+                   self.serial_port.in_waiting()):
                 self.socket.send_string(self.serial_port.readline().strip())
-            time.sleep(0.02)
+                lines += 1
+            self.report_rate()
+
+
+def benchmark_round_trip(commands=("DS", "TL", "DC", "BA", "TH", "DG"),
+                         repeat=20, rate=DAQSimulation.DEFAULT_RATE,
+                         rate_unit="lines", logger=None):
+    """
+    Measure the round trip time of commands through a simulated DAQ card,
+    i.e. the time from putting a command into a DAQProvider until its last
+    reply line was received.
+
+    :param commands: commands to measure
+    :type commands: list of str
+    :param repeat: number of measurements per command
+    :type repeat: int
+    :param rate: target rate of the simulation, see DAQSimulation
+    :type rate: float or None
+    :param rate_unit: unit of the rate, see DAQSimulation
+    :type rate_unit: str
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: dict -- median and maximum round trip time per command
+    """
+    from muonic.daq.exceptions import DAQIOError
+    from muonic.daq.parser import is_trigger_line
+    from muonic.daq.provider import DAQProvider
+
+    if logger is None:
+        logger = logging.getLogger()
+
+    protocol = DAQCardProtocol(logger)
+    daq = DAQProvider(logger=logger, sim=True, sim_rate=rate,
+                      sim_rate_unit=rate_unit)
+    results = dict()
+    timeout = 5.
+
+    try:
+        for command in commands:
+            # echo and reply lines
+            expected = len(protocol.handle(command))
+            round_trips = []
+
+            for _ in range(repeat):
+                start = time.time()
+                daq.put(command)
+                received = 0
+
+                while received < expected and time.time() - start < timeout:
+                    if not daq.data_available():
+                        time.sleep(0.0005)
+                        continue
+                    try:
+                        line = daq.get(0)
+                    except DAQIOError:
+                        continue
+                    if line is not None and not is_trigger_line(line.split()):
+                        received += 1
+
+                if received == expected:
+                    round_trips.append(time.time() - start)
+
+            round_trips.sort()
+            results[command] = {
+                "median": (round_trips[len(round_trips) // 2]
+                           if round_trips else None),
+                "max": round_trips[-1] if round_trips else None,
+                "timeouts": repeat - len(round_trips)
+            }
+    finally:
+        daq.read_thread.terminate()
+
+    return results
+
 
 if __name__ == "__main__":
+    parser = ArgumentParser(description="Serve a simulated DAQ card")
+    parser.add_argument("-r", "--rate", dest="rate", type=float,
+                        default=DAQSimulation.DEFAULT_RATE,
+                        help="target rate, 0 for unlimited (default: %g)" %
+                             DAQSimulation.DEFAULT_RATE)
+    parser.add_argument("-u", "--rate-unit", dest="rate_unit",
+                        choices=DAQSimulation.RATE_UNITS, default="lines",
+                        help="count the rate in lines or triggers per second")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=None,
+                        help="seed for a deterministic simulation")
+    parser.add_argument("-b", "--benchmark", dest="benchmark", type=int,
+                        default=None, metavar="REPEAT",
+                        help="measure the round trip time of the commands " +
+                             "with the given number of repetitions and exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger()
-    server = DAQSimulationServer(port=5556, logger=logger)
-    server.serve()
+
+    if args.benchmark is not None:
+        results = benchmark_round_trip(repeat=args.benchmark, rate=args.rate,
+                                       rate_unit=args.rate_unit,
+                                       logger=logger)
+        for command, result in sorted(results.items()):
+            print("%-2s median %s s, max %s s, %d timeouts" %
+                  (command, result["median"], result["max"],
+                   result["timeouts"]))
+    else:
+        server = DAQSimulationServer(port=5556, logger=logger,
+                                     rate=args.rate,
+                                     rate_unit=args.rate_unit,
+                                     seed=args.seed)
+        server.serve()
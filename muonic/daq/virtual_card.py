@@ -0,0 +1,322 @@
+"""
+Provides a virtual DAQ card on a pseudo-terminal. Since the virtual card
+is attached to a real tty device, the complete serial code path of muonic
+can be tested and benchmarked without hardware.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import logging
+import os
+import select
+import threading
+import time
+import tty
+
+from muonic.analysis.analyzer import BIT7
+from muonic.daq.protocol import DAQCardProtocol
+from muonic.daq.simulation import DAQSimulation
+
+
+class VirtualDAQCard(object):
+    """
+    A virtual DAQ card which opens a pseudo-terminal pair and speaks the
+    card protocol on the master side. The slave side can be opened like
+    the serial device of a real card, see 'device'.
+
+    Trigger lines are taken from the simulation data file and emitted
+    with the configured trigger rate while the counters are enabled.
+
+    :param rate: trigger rate in events per second
+    :type rate: float
+    :param simulation_file: path to the simulation data file
+    :type simulation_file: str
+    :param logger: logger object
+    :type logger: logging.Logger
+    """
+
+    def __init__(self, rate=10., simulation_file=None, logger=None):
+        if logger is None:
+            logger = logging.getLogger()
+        self.logger = logger
+        self.rate = rate
+
+        if simulation_file is None:
+            simulation_file = DAQSimulation.DEFAULT_SIMULATION_FILE
+        self._simulation_file = simulation_file
+        self._data = open(self._simulation_file)
+        self._next_line = None
+
+        self.protocol = DAQCardProtocol(self.logger)
+
+        self.lines_written = 0
+        self.events_written = 0
+
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+
+    @property
+    def device(self):
+        """
+        Path of the tty device to connect to.
+
+        :returns: str or None
+        """
+        if self._slave is None:
+            return None
+        return os.ttyname(self._slave)
+
+    def start(self):
+        """
+        Open the pseudo-terminal and start serving in a background thread.
+
+        :returns: str -- path of the tty device
+        """
+        if self._running:
+            return self.device
+
+        self._master, self._slave = os.openpty()
+        # raw mode, so that the tty neither echoes nor translates anything
+        tty.setraw(self._slave)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._serve,
+                                        name="VirtualDAQCard")
+        self._thread.daemon = True
+        self._thread.start()
+
+        self.logger.info("Virtual DAQ card listening on %s" % self.device)
+        return self.device
+
+    def stop(self):
+        """
+        Stop serving and close the pseudo-terminal.
+
+        :returns: None
+        """
+        if not self._running:
+            return
+
+        self._running = False
+        self._thread.join()
+
+        os.close(self._master)
+        os.close(self._slave)
+        self._master = None
+        self._slave = None
+        self._data.close()
+
+    def __enter__(self):
+        """
+        Start the card on entering 'with' block.
+
+        :returns: VirtualDAQCard
+        """
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Stop the card on leaving 'with' block.
+
+        :returns: None
+        """
+        self.stop()
+
+    def _readline(self):
+        """
+        Read the next trigger data line from the simulation file. Status
+        lines contained in the file are skipped, since the status is
+        reported by the protocol emulation. The file is rewound if its end
+        is reached.
+
+        :returns: str
+        """
+        while True:
+            line = self._data.readline()
+            if not line:
+                self._data.seek(0)
+                continue
+            if len(line.split()) == 16:
+                return line.strip()
+
+    def _next_event(self):
+        """
+        Get the lines of the next event. An event starts with a line which
+        has the trigger flag set and ends before the next one.
+
+        :returns: list of str
+        """
+        if self._next_line is None:
+            self._next_line = self._readline()
+
+        lines = [self._next_line]
+
+        while True:
+            line = self._readline()
+            if int(line.split()[1], 16) & BIT7:
+                self._next_line = line
+                return lines
+            lines.append(line)
+
+    def _write(self, lines):
+        """
+        Write lines to the tty, terminated like the card does.
+
+        :param lines: lines to write
+        :type lines: list of str
+        :returns: None
+        """
+        if not lines:
+            return
+
+        data = "".join([line + "\r\n" for line in lines]).encode("ascii")
+
+        while data:
+            written = os.write(self._master, data)
+            data = data[written:]
+
+        self.lines_written += len(lines)
+
+    def _serve(self):
+        """
+        Serve the card protocol until stopped.
+
+        :returns: None
+        """
+        buf = b""
+        next_event_time = time.time()
+
+        while self._running:
+            timeout = max(0., min(next_event_time - time.time(), 0.05))
+            readable = select.select([self._master], [], [], timeout)[0]
+
+            if readable:
+                try:
+                    buf += os.read(self._master, 4096)
+                except OSError:
+                    # the slave side is closed
+                    continue
+
+                # commands are terminated by a carriage return
+                while b"\r" in buf:
+                    command, buf = buf.split(b"\r", 1)
+                    command = command.decode("ascii", "replace").strip()
+                    self.logger.debug("got the following command %s" %
+                                      command)
+                    self._write(self.protocol.handle(command))
+
+            now = time.time()
+
+            if self.rate <= 0 or not self.protocol.counter_enabled:
+                next_event_time = now
+                continue
+
+            # emit all events which are due since the last iteration
+            while next_event_time <= now:
+                lines = self._next_event()
+                for line in lines:
+                    self.protocol.count(line)
+                self._write(lines)
+                self.events_written += 1
+                next_event_time += 1. / self.rate
+
+
+def benchmark_serial_path(duration=10., rate=1000., logger=None):
+    """
+    Measure throughput and command round trip latency of the serial code
+    path by connecting a DAQProvider to a virtual DAQ card.
+
+    :param duration: duration of the measurement in seconds
+    :type duration: float
+    :param rate: trigger rate of the virtual card in events per second
+    :type rate: float
+    :param logger: logger object
+    :type logger: logging.Logger
+    :returns: dict
+    """
+    from muonic.daq.exceptions import DAQIOError
+    from muonic.daq.provider import DAQProvider
+
+    if logger is None:
+        logger = logging.getLogger()
+
+    with VirtualDAQCard(rate=rate, logger=logger) as card:
+        daq = DAQProvider(logger=logger, device=card.device)
+
+        lines = 0
+        latencies = []
+        query_time = None
+        start = time.time()
+        next_query = start
+
+        while time.time() - start < duration:
+            now = time.time()
+
+            if query_time is None and now >= next_query:
+                daq.put("DS")
+                query_time = now
+
+            if not daq.data_available():
+                time.sleep(0.001)
+                continue
+
+            try:
+                line = daq.get(0)
+            except DAQIOError:
+                continue
+
+            lines += 1
+
+            if query_time is not None and line.startswith("DS S0"):
+                latencies.append(time.time() - query_time)
+                query_time = None
+                next_query = time.time() + 0.1
+
+        elapsed = time.time() - start
+        max_queue_latency = daq.batch_reader.max_latency
+        lost_batches = daq.get_lost_batches()
+
+    latencies = sorted(latencies)
+
+    return {
+        "lines": lines,
+        "lines_per_second": lines / elapsed,
+        "lines_written": card.lines_written,
+        "queries": len(latencies),
+        "median_latency": (latencies[len(latencies) // 2]
+                           if latencies else None),
+        "max_latency": latencies[-1] if latencies else None,
+        "max_queue_latency": max_queue_latency,
+        "lost_batches": lost_batches
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run a virtual DAQ card on a " +
+                                        "pseudo-terminal")
+    parser.add_argument("-r", "--rate", dest="rate", type=float,
+                        default=10., help="trigger rate in events per second")
+    parser.add_argument("-b", "--benchmark", dest="benchmark", type=float,
+                        default=None, metavar="SECONDS",
+                        help="benchmark the serial code path for the " +
+                             "given time and exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger()
+
+    if args.benchmark is not None:
+        results = benchmark_serial_path(args.benchmark, args.rate, logger)
+        for key, value in sorted(results.items()):
+            print("%-20s = %s" % (key, value))
+    else:
+        with VirtualDAQCard(rate=args.rate, logger=logger) as card:
+            print("Virtual DAQ card running, connect with:\n" +
+                  "  MUONIC_DAQ_DEVICE=%s muonic XY" % card.device)
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
@@ -753,7 +753,7 @@ class Application(QtGui.QMainWindow):
         """
         while self.daq.data_available():
             try:
-                msg = self.daq.get(0)
+                msg, pulses = self.daq.get_event(0)
             except DAQIOError:
                 self.logger.debug("Queue empty!")
                 return None
@@ -798,6 +798,11 @@ class Application(QtGui.QMainWindow):
             if self.get_channels_from_msg(msg):
                 continue
 
+            # check for barometer and temperature readings
+            if self.get_widget(
+                    "rate").extract_pressure_temperature_from_message(msg):
+                continue
+
             # ignore status messages
             if msg.startswith('ST') or len(msg) < 50:
                 continue
@@ -807,7 +812,11 @@ class Application(QtGui.QMainWindow):
                 continue
 
             # extract pulses if needed
-            if (get_setting("write_pulses") or
+            if self.daq.preparse:
+                # pulses were already extracted by the reader
+                self.pulses = pulses
+                self.pulse_extractor.store_pulses(pulses)
+            elif (get_setting("write_pulses") or
                     self.is_widget_active("pulse") or
                     self.is_widget_active("decay") or
                     self.is_widget_active("velocity")):
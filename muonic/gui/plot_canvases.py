@@ -13,6 +13,9 @@ except ImportError:
 
 import numpy as np
 
+from muonic.analysis.histogram import Histogram
+from muonic.util.ring_buffer import RingBuffer
+
 
 class BasePlotCanvas(FigureCanvas):
     """
@@ -84,7 +87,9 @@ class BasePlotCanvas(FigureCanvas):
 
 class BaseHistogramCanvas(BasePlotCanvas):
     """
-    A base class for all canvases with a histogram
+    A base class for all canvases with a histogram. The bin contents are
+    accumulated in a muonic.analysis.histogram.Histogram, the canvas only
+    renders it.
 
     :param parent: parent widget
     :param logger: logger object
@@ -102,176 +107,135 @@ class BaseHistogramCanvas(BasePlotCanvas):
 
         # setup binning
         self.binning = np.asarray(binning)
-        self.bincontent = np.zeros(len(self.binning))
-        self.hist_patches = self.ax.hist(np.array([self.binning[0] - 1]),
-                                         self.binning, fc=hist_color,
-                                         alpha=0.25)[2]
-        self.heights = []
+        self.histogram = Histogram(self.binning)
+        self.hist_color = hist_color
         self.dimension = r"$\mu$s"
 
-        # FIXME the current implementation does not know about outliers
-        self.underflow = 0
-        # FIXME the current implementation does not know about outliers
-        self.overflow = 0
-
         # fixed xrange for histogram
         self.xmin = self.binning[0]
         self.xmax = (self.binning[-1] +
                      (self.binning[:-1] - self.binning[1:])[-1])
 
+    @property
+    def heights(self):
+        """
+        The bin contents
+
+        :returns: numpy.ndarray
+        """
+        return self.histogram.counts
+
+    @property
+    def underflow(self):
+        """
+        Number of values below the first bin
+
+        :returns: int
+        """
+        return self.histogram.underflow
+
+    @property
+    def overflow(self):
+        """
+        Number of values above the last bin
+
+        :returns: int
+        """
+        return self.histogram.overflow
+
     def update_plot(self, data):
         """
-        Update the plot
+        Fill new data into the histogram and update the plot
 
-        :param data: the data to plot
-        :type data: list of lists
+        :param data: the data to add
+        :type data: list
         :return: None
         """
-        if not data:
+        if not len(data):
             return
 
+        self.histogram.fill(data)
+        self.draw_histogram()
+
+    def draw_histogram(self):
+        """
+        Draw the histogram with statistical errors
+
+        :return: None
+        """
         # avoid memory leak
         self.ax.clear()
         if self.title is not None:
             self.ax.set_title(self.title)
 
-        # we have to do some bad hacking here,
-        # because the p histogram is rather
-        # simple and it is not possible to add two of them...
-        # however, since we do not want to run into a memory leak
-        # and we also be not dependent on dashi (but maybe
-        # sometimes in the future?) we have to do it
-        # by manipulating rectangles...
-
-        # we want to find the non-empty bins
-        # tmp_hist is compatible with the decay_time hist...
-        tmp_hist = self.ax.hist(data, self.binning, fc="b", alpha=0.25)[0]
-
-        for hist_bin in enumerate(tmp_hist):
-            if hist_bin[1]:
-                self.hist_patches[hist_bin[0]].set_height(
-                        self.hist_patches[hist_bin[0]].get_height() +
-                        hist_bin[1])
-
-        # we want to get the maximum for the ylims
-        # self.heights contains the bincontent!
-
-        self.heights = []
-        for patch in self.hist_patches:
-            self.heights.append(patch.get_height())
-
-        self.logger.debug("Histogram patch heights %s" % self.heights)
-        self.ax.set_ylim(ymax=max([h+np.sqrt(h) for h in self.heights]) * 1.1)
+        counts = self.histogram.counts
+        errors = np.sqrt(counts)
+
+        self.logger.debug("Histogram bin contents %s" % counts.tolist())
+
+        self.ax.bar(self.histogram.edges[:-1], counts,
+                    width=self.histogram.widths, align="edge",
+                    fc=self.hist_color, alpha=0.25)
+        self.ax.errorbar(self.histogram.centers, counts, yerr=errors,
+                         fmt="none", color="b")
+
+        self.ax.set_ylim(ymax=max(np.max(counts + errors) * 1.1, 1))
         self.ax.set_ylim(ymin=0)
         self.ax.set_xlabel(self.xlabel)
         self.ax.set_ylabel(self.ylabel)
         self.ax.set_xlim(xmin=self.xmin, xmax=self.xmax)
 
-        # always get rid of unused stuff
-        del tmp_hist
-
-        # try to add errorbars
-        bincenters = (self.binning[1:]+self.binning[:-1])/2.
-        for i, height in enumerate(self.heights):
-            self.ax.errorbar(bincenters[i], height,
-                     yerr=np.sqrt(height), color='b')
-
         # some beautification
         self.ax.grid()
-
-        # we now have to pass our new patches
-        # to the figure we created..
-        self.ax.patches = self.hist_patches
         self.fig.canvas.draw()
 
-    def show_fit(self, bin_centers, bincontent, fitx, decay, p, covar,
-                 chisquare, nbins):
+    def show_fit(self, result, interval=None):
         """
         Plot the fit onto the diagram
 
-        :param bin_centers: bin centers
-        :param bincontent: bincontents
-        :param fitx: the fit
-        :type fitx: numpy.ndarray
-        :param decay: decay function
-        :type decay: function
-        :param p: fit parameters
-        :type p: list
-        :param covar: covariance matrix
-        :type covar: matrix
-        :param chisquare: chi-squared
-        :type chisquare: float
-        :param nbins: number of bins
-        :type nbins: int
+        If the fit has no covariance, the uncertainty is taken from the
+        interval, e.g. of a bootstrap.
+
+        :param result: fit result
+        :type result: muonic.analysis.fit.FitResult
+        :param interval: lower and upper limit of the fitted value
+        :type interval: tuple or None
         :returns: None
         """
 
         # clears a previous fit from the canvas
         self.ax.lines = []
-        self.ax.plot(bin_centers, bincontent, "b^", fitx, decay(p, fitx), "b-")
-
-        ## print fit function formula start
-        #x = bin_centers
-        #y = bincontent
-        #poly = pl.polyfit(x, y, 2)
-
-        #def poly2latex(poly, variable="x", width=2):
-        #  t = ["{0:0.{width}f}"]
-        #  t.append(t[-1] + " {variable}")
-        #  t.append(t[-1] + "^{1}")
-
-        #  def f():
-        #    for i, v in enumerate(reversed(poly)):
-        #      idx = i if i < 2 else 2
-        #      yield t[idx].format(v, i, variable=variable, width=width)
-
-        #  return "${}$".format("+".join(f()))
-
-        #self.ax.plot(x, y, "o", alpha=0.4)
-        #x2 = np.linspace(-2, 2, 100)
-        #y2 = np.polyval(poly, x2)
-        #self.ax.plot(x2, y2, lw=2, color="r")
-        #self.ax.text(x2[5], y2[5], poly2latex(poly), fontsize=16)
-        # print fit function formula end
+        fitx, fity = result.curve()
+        self.ax.plot(result.x, result.y, "b^", fitx, fity, "b-")
 
         # FIXME: this seems to crop the histogram
         # self.ax.set_ylim(0,max(bincontent)*1.2)
         self.ax.set_xlabel(self.xlabel)
         self.ax.set_ylabel(self.ylabel)
 
-        # compute the errors on the fit, nb that this calculation assumes that
-        # scipy.optimize.leastsq was used
-        error = []
-        for i in range(len(p)):
-            try:
-                error.append(np.absolute(covar[i][i]) ** 0.5)
-            except Exception:
-                error.append(0.00)
-
-        perr_leastsq = np.array(error)
-
-        try:
-            if chisquare / (nbins-len(p)) > 10000:
-                self.ax.legend(("Data", ("Fit: (%4.2f $\pm$ %4.2f) %s \n" +
-                                     " chisq/ndf=%.4g") %
-                            (p[2], perr_leastsq[2], self.dimension,
-                             chisquare / (nbins-len(p)))), loc=1)
-            self.ax.legend(("Data", ("Fit: (%4.2f $\pm$ %4.2f) %s \n" +
-                                     " chisq/ndf=%4.2f") %
-                            (p[2], perr_leastsq[2], self.dimension,
-                             chisquare / (nbins-len(p)))), loc=1)
-        except TypeError:
-            if chisquare / (nbins-len(p)) > 10000:
-                self.ax.legend(("Data", ("Fit: (%4.2f $\pm$ %4.2f) %s \n" +
-                                     " chisq/ndf=%.4g") %
-                            (p[2], perr_leastsq[2], self.dimension,
-                             chisquare / (nbins-len(p)))), loc=1)
+        if result.chisquare_per_ndf > 10000:
+            chisquare_format = "%.4g"
+        else:
+            chisquare_format = "%4.2f"
+
+        if result.covariance is not None:
+            self.ax.legend(("Data", ("Fit: (%4.2f $\\pm$ %4.2f) %s \n" +
+                                     " chisq/ndf=" + chisquare_format) %
+                            (result.value, result.error, self.dimension,
+                             result.chisquare_per_ndf)), loc=1)
+        elif interval is not None:
+            self.ax.legend(("Data", ("Fit: (%4.2f$^{+%4.2f}_{-%4.2f}$) %s " +
+                                     "\n chisq/ndf=" + chisquare_format) %
+                            (result.value, interval[1] - result.value,
+                             result.value - interval[0], self.dimension,
+                             result.chisquare_per_ndf)), loc=1)
+        else:
             self.logger.warn("Covariance Matrix is 'None', could " +
                              "not calculate fit error!")
             self.ax.legend(("Data", ("Fit: (%4.2f) %s \n " +
-                                     " chisq/ndf=%4.2f") %
-                            (p[2], self.dimension,
-                             chisquare / (nbins-len(p)))), loc=1)
+                                     " chisq/ndf=" + chisquare_format) %
+                            (result.value, self.dimension,
+                             result.chisquare_per_ndf)), loc=1)
 
         self.fig.canvas.draw()
 
@@ -348,6 +312,9 @@ class ScalarsCanvas(BasePlotCanvas):
     """
     A plot canvas to display scalars
 
+    The rates are kept in a ring buffer, so appending a point and finding
+    the plot range does not depend on the number of points shown.
+
     :param parent: parent widget
     :param logger: logger object
     :type logger: logging.Logger
@@ -358,16 +325,23 @@ class ScalarsCanvas(BasePlotCanvas):
     CHANNEL_COLORS = ['y', 'm', 'c', 'b']
     TRIGGER_COLOR = 'g'
 
+    # columns of the rate buffer
+    TRIGGER_COLUMN = 4
+    TIME_COLUMN = 5
+
     def __init__(self, parent, logger, max_length=40):
 
         BasePlotCanvas.__init__(self, parent, logger, ymin=0, ymax=20,
                                 xlabel="Time (s)", ylabel="Rate (1/s)")
         self.show_trigger = True
         self.max_length = max_length
-        self.channel_data = [[], [], [], []]
-        self.trigger_data = []
-        self.time_data = []
+        # rates of channel 0-3, trigger rate and measurement time
+        self.rate_data = RingBuffer(max_length, 6)
         self.time_window = 0
+        self.channel_lines = []
+        self.trigger_line = None
+        self.pending_text = None
+        self.legend_config = None
         self.reset()
 
     def reset(self, show_pending=False):
@@ -385,32 +359,63 @@ class ScalarsCanvas(BasePlotCanvas):
         self.ax.set_xlim((self.xmin, self.xmax))
         self.ax.set_ylim((self.ymin, self.ymax))
 
-        self.channel_data = [[], [], [], []]
-        self.trigger_data = []
-        self.time_data = []
+        self.rate_data.clear()
         self.time_window = 0
-
-        for ch in range(4):
-            self.ax.plot(self.time_data, self.channel_data[ch],
-                         c=self.CHANNEL_COLORS[ch],
-                         label=("ch%d" % ch), lw=3)
-        if self.show_trigger:
-            self.ax.plot(self.time_data, self.trigger_data, c='g',
-                         label='trigger', lw=3)
-
+        self.legend_config = None
+
+        # the lines are kept and only get new data on updates
+        self.channel_lines = [
+            self.ax.plot([], [], c=self.CHANNEL_COLORS[ch],
+                         label=("ch%d" % ch), lw=2, marker='v')[0]
+            for ch in range(4)]
+        self.trigger_line = self.ax.plot([], [], c=self.TRIGGER_COLOR,
+                                         label='trg', lw=2, marker='x')[0]
+        self.trigger_line.set_visible(self.show_trigger)
+
+        self.pending_text = None
         if show_pending:
             left, width = .25, .5
             bottom, height = .35, .8
             right = left + width
             top = bottom + height
-            self.ax.text(0.5 * (left + right), 0.5 * (bottom + top),
-                         'Measuring...', horizontalalignment='center',
-                         verticalalignment='center', fontsize=56, color='red',
-                         fontweight="heavy", alpha=.8, rotation=30,
-                         transform=self.fig.transFigure)
+            self.pending_text = self.ax.text(
+                    0.5 * (left + right), 0.5 * (bottom + top),
+                    'Measuring...', horizontalalignment='center',
+                    verticalalignment='center', fontsize=56, color='red',
+                    fontweight="heavy", alpha=.8, rotation=30,
+                    transform=self.fig.transFigure)
 
         self.fig.canvas.draw()
 
+    def update_legend(self, enabled_channels):
+        """
+        Show the visible lines in the legend
+
+        :param enabled_channels: enabled channels
+        :type enabled_channels: list of bool
+        :returns: None
+        """
+        lines = [line for ch, line in enumerate(self.channel_lines)
+                 if enabled_channels[ch]]
+        if self.show_trigger:
+            lines.append(self.trigger_line)
+
+        if not lines:
+            legend = self.ax.get_legend()
+            if legend is not None:
+                legend.remove()
+            return
+
+        try:
+            self.ax.legend(lines, [line.get_label() for line in lines],
+                           bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
+                           ncol=len(lines), mode="expand", borderaxespad=0.,
+                           handlelength=2)
+        except Exception as e:
+            self.logger.info("An error with the legend occurred: %s" % e)
+            self.ax.legend(lines, [line.get_label() for line in lines],
+                           loc=2)
+
     def update_plot(self, data, show_trigger=True,
                     enabled_channels=DEFAULT_CHANNEL_CONFIG):
         """
@@ -424,62 +429,43 @@ class ScalarsCanvas(BasePlotCanvas):
         :type enabled_channels: list of bool
         :returne: None
         """
-        # do a complete redraw of the plot to avoid memory leak!
-        self.ax.clear()
         self.show_trigger = show_trigger
 
-        self.ax.grid()
-        self.ax.set_xlabel(self.xlabel)
-        self.ax.set_ylabel(self.ylabel)
-
         self.logger.debug("result : %s" % data)
 
-        # update lines data using the lists with new data
+        # update lines data using the buffer with new data
         self.time_window += data[5]
-        self.time_data.append(self.time_window)
+        self.rate_data.append(list(data[:5]) + [self.time_window])
 
-        for ch in range(4):
-            self.channel_data[ch].append(data[ch])
-            if enabled_channels[ch]:
-                self.ax.plot(self.time_data, self.channel_data[ch],
-                             c=self.CHANNEL_COLORS[ch],
-                             label=("ch%d" % ch), lw=2, marker='v')
+        time_data = self.rate_data.column(self.TIME_COLUMN)
 
-        self.trigger_data.append(data[4])
-
-        if self.show_trigger:
-            self.ax.plot(self.time_data, self.trigger_data,
-                         c=self.TRIGGER_COLOR,
-                         label='trg', lw=2, marker='x')
+        for ch, line in enumerate(self.channel_lines):
+            line.set_data(time_data, self.rate_data.column(ch))
+            line.set_visible(bool(enabled_channels[ch]))
 
-        try:
-            # get count of active cannels
-            channels = enabled_channels + [show_trigger]
-            active_count = sum(channels)
+        self.trigger_line.set_data(
+                time_data, self.rate_data.column(self.TRIGGER_COLUMN))
+        self.trigger_line.set_visible(self.show_trigger)
 
-            self.ax.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
-                           ncol=active_count, mode="expand", borderaxespad=0.,
-                           handlelength=2)
-        except Exception as e:
-            self.logger.info("An error with the legend occurred: %s" % e)
-            self.ax.legend(loc=2)
+        if self.pending_text is not None:
+            self.pending_text.remove()
+            self.pending_text = None
 
-        if len(self.channel_data[0]) > self.max_length:
-            for ch in range(4):
-                self.channel_data[ch].remove(self.channel_data[ch][0])
-            self.trigger_data.remove(self.trigger_data[0])
-            self.time_data.remove(self.time_data[0])
+        # the legend only changes with the channel configuration
+        legend_config = tuple(enabled_channels) + (show_trigger,)
+        if legend_config != self.legend_config:
+            self.update_legend(enabled_channels)
+            self.legend_config = legend_config
 
-        ma = max(max(self.channel_data[0]), max(self.channel_data[1]),
-                 max(self.channel_data[2]), max(self.channel_data[3]),
-                 max(self.trigger_data))
+        ma = max([self.rate_data.maximum(column)
+                  for column in range(self.TRIGGER_COLUMN + 1)])
 
         self.ax.set_ylim(0, ma * 1.1)
 
         # do not set x-range if time_data consists of only one item to
         # avoid matlibplot UserWarning
-        if len(self.time_data) > 1:
-            self.ax.set_xlim(self.time_data[0], self.time_data[-1])
+        if len(time_data) > 1:
+            self.ax.set_xlim(time_data[0], time_data[-1])
 
         self.fig.canvas.draw()
 
@@ -19,17 +19,24 @@ from PyQt4 import QtGui
 from PyQt4 import QtCore
 
 from muonic.daq.provider import BaseDAQProvider
+from muonic.daq.parser import parse_pressure, parse_temperature
 from muonic.gui.helpers import HistoryAwareLineEdit
 from muonic.gui.plot_canvases import ScalarsCanvas, LifetimeCanvas
 from muonic.gui.plot_canvases import PulseCanvas, PulseWidthCanvas
 from muonic.gui.plot_canvases import VelocityCanvas
 from muonic.gui.dialogs import DecayConfigDialog
 from muonic.gui.dialogs import VelocityConfigDialog, FitRangeConfigDialog
-from muonic.analysis import fit, gaussian_fit
+from muonic.analysis import fit, gaussian_fit, POISSON
 from muonic.analysis import VelocityTrigger, DecayTriggerThorough
+from muonic.analysis import OnlineLifetimeEstimator
+from muonic.analysis import bootstrap_fit, DECAY, VELOCITY
 from muonic.util import rename_muonic_file, get_hours_from_duration
 from muonic.util import get_setting, WrappedFile
 
+# replicas of the bootstrap of fits without covariance, the refits run in
+# the gui thread
+BOOTSTRAP_REPLICAS = 200
+
 
 class BaseWidget(QtGui.QWidget):
     """
@@ -45,6 +52,8 @@ class BaseWidget(QtGui.QWidget):
         self.logger = logger
         self.parent = parent
         self._active = False
+        # bootstrap interval of the shown fit
+        self._fit_interval = None
 
     def update(self, *args):
         """
@@ -94,6 +103,33 @@ class BaseWidget(QtGui.QWidget):
         """
         pass
 
+    def _get_fit_interval(self, kind, refresh=False):
+        """
+        Get a bootstrap interval of the fitted value if the fit of the
+        widget has no covariance. Bootstrapping refits the histogram many
+        times, so the interval is only calculated when a fit is requested.
+        The refits on updates change the fitted value, so they get no
+        interval rather than a stale one.
+
+        :param kind: fit to bootstrap
+        :type kind: str
+        :param refresh: calculate the interval for a requested fit
+        :type refresh: bool
+        :returns: tuple or None
+        """
+        self._fit_interval = None
+        if self.fit_result.covariance is not None or not refresh:
+            return None
+
+        self.logger.debug("No covariance, bootstrapping the fit error")
+        bootstrap = bootstrap_fit(
+                kind, np.asarray(self.plot_canvas.heights), self.binning,
+                fitrange=self.fit_range, method=POISSON,
+                replicas=BOOTSTRAP_REPLICAS, processes=1, logger=self.logger)
+        if bootstrap is not None:
+            self._fit_interval = bootstrap.interval()
+        return self._fit_interval
+
     def daq_put(self, msg):
         """
         Send message to DAQ cards. Reuses the connection of the parent widget
@@ -114,6 +150,33 @@ class BaseWidget(QtGui.QWidget):
             return True
         return False
 
+    def daq_get_downtime(self):
+        """
+        Get the accumulated time in seconds the connection to the DAQ card
+        was lost. Reuses the connection of the parent widget if present.
+
+        :returns: float
+        """
+        if self.parent is None or self.parent.daq is None:
+            return 0.
+
+        if isinstance(self.parent.daq, BaseDAQProvider):
+            return self.parent.daq.get_downtime()
+        return 0.
+
+    def daq_get_receipt_time(self):
+        """
+        Get the time the last DAQ message was received as UTC datetime.
+        Reuses the connection of the parent widget if present.
+
+        :returns: datetime.datetime
+        """
+        if (self.parent is not None and
+                isinstance(self.parent.daq, BaseDAQProvider)):
+            return datetime.datetime.utcfromtimestamp(
+                    self.parent.daq.get_receipt_time())
+        return datetime.datetime.utcnow()
+
     def daq_get_last_msg(self):
         """
         Get the last DAQ message received by the parent, if present.
@@ -124,23 +187,6 @@ class BaseWidget(QtGui.QWidget):
             return self.parent.last_daq_msg
         return None
 
-    def daq_get_last_pressure_temperature(self):
-
-	msgStack = []
-
-	while self.parent.daq.data_available():
-
-	    try: msgStack.append(self.parent.daq.get(0))
-	    except DAQIOError:
-		self.parent.logger.debug("Error, no element on stack")
-
-	#for i in range(0,len(msgStack)):
-	#    print("Line: " + str(i) + " : " + msgStack[i])
-
-	a=[msgStack[3], msgStack[5]]
-
-        return a
-
     def finish(self):
         """
         Gets called upon closing application. Implement cleanup routines like
@@ -173,9 +219,16 @@ class RateWidget(BaseWidget):
         # define the begin of the time interval for the rate calculation
         self.last_query_time = 0
         self.query_time = time.time()
+        # accumulated DAQ downtime at the last two queries
+        self.last_query_downtime = 0.
+        self.query_downtime = 0.
         self.time_window = 0
         self.show_trigger = True
 
+        # last barometer and temperature readings of the card
+        self.pressure = float("nan")
+        self.temperature = float("nan")
+
         # lists of channel and trigger scalars
         # 0..3: channel 0-3
         # 4:    trigger
@@ -304,10 +357,12 @@ class RateWidget(BaseWidget):
         :returns: None
         """
         self.last_query_time = self.query_time
+        self.last_query_downtime = self.query_downtime
         self.daq_put("DS")
         self.query_time = time.time()
+        self.query_downtime = self.daq_get_downtime()
         self.daq_put("ba")
-	self.daq_put("th")
+        self.daq_put("th")
 
     def extract_scalars_from_message(self, msg):
         """
@@ -326,6 +381,28 @@ class RateWidget(BaseWidget):
                     scalars[i] = int(item[3:], 16)
         return scalars
 
+    def extract_pressure_temperature_from_message(self, msg):
+        """
+        Extracts the pressure or the temperature from the replies to the
+        'BA' and 'TH' commands.
+
+        Returns True if the message contained either of them.
+
+        :param msg: DAQ message
+        :type msg: str
+        :returns: bool
+        """
+        pressure = parse_pressure(msg)
+        if pressure is not None:
+            self.pressure = pressure
+            return True
+
+        temperature = parse_temperature(msg)
+        if temperature is not None:
+            self.temperature = temperature
+            return True
+        return False
+
     def calculate(self):
         """
         Get the rates from the observed counts by dividing by the
@@ -337,10 +414,6 @@ class RateWidget(BaseWidget):
         """
         msg = self.daq_get_last_msg()
 
-        msg2=self.daq_get_last_pressure_temperature()
-        pressure=float(msg2[0].split()[4])
-        temp	=float(msg2[1].split("=")[1])
-
         if not (len(msg) >= 2 and msg.startswith("DS")):
             return False
 
@@ -363,9 +436,21 @@ class RateWidget(BaseWidget):
         # in the next cycle
         for i in range(self.SCALAR_BUF_SIZE):
             scalar_diffs[i] = scalars[i] - self.previous_scalars[i]
+            if scalar_diffs[i] < 0:
+                # the card was reset, e.g. after losing power on a USB
+                # dropout, so it started counting from zero again
+                scalar_diffs[i] = scalars[i]
             self.previous_scalars[i] = scalars[i]
 
-        time_window = self.query_time - self.last_query_time
+        # the time without connection to the card does not count as
+        # measurement time
+        downtime = self.query_downtime - self.last_query_downtime
+        time_window = self.query_time - self.last_query_time - downtime
+
+        if time_window <= 0:
+            self.logger.warning("No live time in the last interval, " +
+                                "skipping rate calculation")
+            return False
 
         # rates for scalars of channels and trigger
         self.rates = [(_scalar / time_window) for _scalar in scalar_diffs]
@@ -402,7 +487,7 @@ class RateWidget(BaseWidget):
                          self.rates[3], self.rates[4],
                          scalar_diffs[0], scalar_diffs[1],
                          scalar_diffs[2], scalar_diffs[3], scalar_diffs[4],
-                         self.rates[5], pressure, temp))
+                         self.rates[5], self.pressure, self.temperature))
 
                 self.logger.debug("Rate plot data was written to %s" %
                                   repr(self.data_file))
@@ -1003,6 +1088,8 @@ class VelocityWidget(BaseWidget):
 
         # default fit range
         self.fit_range = (self.binning[0], self.binning[1])
+        # last fit, refitted on every update once the fit was requested
+        self.fit_result = None
 
         self.event_data = []
         self.last_event_time = None
@@ -1067,15 +1154,29 @@ class VelocityWidget(BaseWidget):
         """
         Fit the muon velocity histogram
 
+        :returns: None
+        """
+        self.refit(refresh=True)
+
+    def refit(self, refresh=False):
+        """
+        Fit the muon velocity histogram again
+
+        :param refresh: calculate the bootstrap interval again
+        :type refresh: bool
         :returns: None
         """
         self.logger.debug("Using fit range of %s" % repr(self.fit_range))
-        fit_results = gaussian_fit(
+        self.fit_result = gaussian_fit(
                 bincontent=np.asarray(self.plot_canvas.heights),
-                binning=self.binning, fitrange=self.fit_range)
+                binning=self.binning, fitrange=self.fit_range,
+                method=POISSON, previous=self.fit_result,
+                logger=self.logger)
 
-        if fit_results is not None:
-            self.plot_canvas.show_fit(*fit_results)
+        if self.fit_result is not None:
+            self.plot_canvas.show_fit(self.fit_result,
+                                      self._get_fit_interval(VELOCITY,
+                                                             refresh))
 
     def on_fit_range_clicked(self):
         """
@@ -1091,6 +1192,7 @@ class VelocityWidget(BaseWidget):
             upper_limit = dialog.get_widget_value("upper_limit")
             lower_limit = dialog.get_widget_value("lower_limit")
             self.fit_range = (lower_limit, upper_limit)
+            self._fit_interval = None
 
     def on_checkbox_clicked(self):
         """
@@ -1121,7 +1223,8 @@ class VelocityWidget(BaseWidget):
         if flight_time is not None and flight_time > 0:
             self.event_data.append(flight_time)
             self.muon_counter += 1
-            self.last_event_time = datetime.datetime.utcnow()
+            # the event was received together with the current message
+            self.last_event_time = self.daq_get_receipt_time()
             self.logger.info("measured flight time %s" % flight_time)
 
     def update(self):
@@ -1137,6 +1240,9 @@ class VelocityWidget(BaseWidget):
         self.fit_button.setEnabled(True)
         self.plot_canvas.update_plot(self.event_data)
 
+        if self.fit_result is not None:
+            self.refit()
+
         self.muon_counter_label.setText("We have detected %d muons " %
                                         self.muon_counter)
         self.last_event_label.setText(
@@ -1301,6 +1407,11 @@ class DecayWidget(BaseWidget):
 
         # default fit range
         self.fit_range = (1.5, 10.)
+        # last fit, refitted on every update once the fit was requested
+        self.fit_result = None
+        # lifetime estimate updated with every decay
+        self.lifetime_estimator = OnlineLifetimeEstimator(
+                fitrange=self.fit_range, logger=logger)
 
         self.event_data = []
         self.last_event_time = None
@@ -1349,6 +1460,7 @@ class DecayWidget(BaseWidget):
         self.muon_counter_label = QtGui.QLabel(self)
         self.last_event_label = QtGui.QLabel(self)
         self.active_since_label = QtGui.QLabel(self)
+        self.lifetime_label = QtGui.QLabel(self)
 
         navigation_toolbar = NavigationToolbar(self.plot_canvas, self)
 
@@ -1358,10 +1470,11 @@ class DecayWidget(BaseWidget):
         layout.addWidget(self.muon_counter_label, 1, 0)
         layout.addWidget(self.last_event_label, 2, 0)
         layout.addWidget(self.active_since_label, 3, 0)
-        layout.addWidget(self.plot_canvas, 4, 0, 1, 3)
-        layout.addWidget(navigation_toolbar, 5, 0)
-        layout.addWidget(self.fit_range_button, 5, 1)
-        layout.addWidget(self.fit_button, 5, 2)
+        layout.addWidget(self.lifetime_label, 4, 0)
+        layout.addWidget(self.plot_canvas, 5, 0, 1, 3)
+        layout.addWidget(navigation_toolbar, 6, 0)
+        layout.addWidget(self.fit_range_button, 6, 1)
+        layout.addWidget(self.fit_button, 6, 2)
 
     def set_previous_coincidence_times(self, time_03, time_02):
         """
@@ -1382,11 +1495,24 @@ class DecayWidget(BaseWidget):
 
         :returns: None
         """
-        fit_results = fit(bincontent=np.asarray(self.plot_canvas.heights),
-                          binning=self.binning, fitrange=self.fit_range)
+        self.refit(refresh=True)
+
+    def refit(self, refresh=False):
+        """
+        Fit the muon decay histogram again
+
+        :param refresh: calculate the bootstrap interval again
+        :type refresh: bool
+        :returns: None
+        """
+        self.fit_result = fit(bincontent=np.asarray(self.plot_canvas.heights),
+                              binning=self.binning, fitrange=self.fit_range,
+                              method=POISSON, previous=self.fit_result,
+                              logger=self.logger)
 
-        if fit_results is not None:
-            self.plot_canvas.show_fit(*fit_results)
+        if self.fit_result is not None:
+            self.plot_canvas.show_fit(self.fit_result,
+                                      self._get_fit_interval(DECAY, refresh))
 
     def on_fit_range_clicked(self):
         """
@@ -1403,6 +1529,8 @@ class DecayWidget(BaseWidget):
             upper_limit = dialog.get_widget_value("upper_limit")
             lower_limit = dialog.get_widget_value("lower_limit")
             self.fit_range = (lower_limit, upper_limit)
+            self._fit_interval = None
+            self.lifetime_estimator.set_fit_range(self.fit_range)
 
     def on_checkbox_clicked(self):
         """
@@ -1434,11 +1562,13 @@ class DecayWidget(BaseWidget):
                 max_double_pulse_width=self.max_double_pulse_width)
 
         if decay is not None:
-            when = datetime.datetime.utcnow()
+            # the event was received together with the current message
+            when = self.daq_get_receipt_time()
             self.event_data.append((decay / 1000, 
                                     when.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]))
             self.muon_counter += 1
             self.last_event_time = when
+            self.lifetime_estimator.add(decay / 1000)
             self.logger.info("We have found a decaying muon with a " +
                              "decay time of %f at %s" % (decay, when))
 
@@ -1457,12 +1587,22 @@ class DecayWidget(BaseWidget):
         self.fit_range_button.setEnabled(True)
         self.plot_canvas.update_plot(decay_times)
 
+        if self.fit_result is not None:
+            self.refit()
+
         self.muon_counter_label.setText("We have %d decayed muons " %
                                         self.muon_counter)
         self.last_event_label.setText(
                 "Last detected decay at time %s " %
                 self.last_event_time.strftime("%a %d %b %Y %H:%M:%S UTC"))
 
+        if self.lifetime_estimator.covariance is not None:
+            self.lifetime_label.setText(
+                    "Estimated lifetime %.2f +- %.2f microseconds " %
+                    (self.lifetime_estimator.lifetime,
+                     self.lifetime_estimator.lifetime_error) +
+                    "from %d decays" % self.lifetime_estimator.decays)
+
         for decay in self.event_data:
             decay_time = decay[1]#.replace(' ', '_')
             self.mu_file.write("%s Decay %s\n" % (repr(decay_time),
@@ -1890,7 +2030,7 @@ class GPSWidget(BaseWidget):
         # sometimes, the widget will not register the line where the DG command is put
         if not self.gps_dump[1].startswith('DG'):
             self.msg_offset = -1
-	
+        
         gps_time = ''
         pos_fix = 0
         latitude = ''
@@ -2,8 +2,13 @@
 Utility functions
 """
 from __future__ import print_function
+import bz2
+import gzip
+import importlib
+import io
 import os
 import shutil
+import sys
 
 from muonic import DATA_PATH
 
@@ -121,6 +126,62 @@ def format_date(date, fmt="%Y-%m-%d_%H-%M-%S"):
     return date.strftime(fmt)
 
 
+def open_data_file(filename):
+    """
+    Open a data file for reading text. Files ending with '.gz' or '.bz2'
+    are decompressed on the fly.
+
+    :param filename: path of the data file
+    :type filename: str
+    :returns: file object
+    """
+    if filename.endswith(".gz"):
+        data_file = gzip.GzipFile(filename, "rb")
+    elif filename.endswith(".bz2"):
+        data_file = bz2.BZ2File(filename, "rb")
+    else:
+        data_file = io.open(filename, "rb")
+    return io.TextIOWrapper(data_file, encoding="ascii", errors="replace")
+
+
+def iter_line_chunks(filename, chunk_size, offset=0, incomplete=True):
+    """
+    Read a data file in buffers of complete lines. Files ending with '.gz'
+    or '.bz2' are decompressed on the fly.
+
+    :param filename: path of the data file
+    :type filename: str
+    :param chunk_size: bytes read at once
+    :type chunk_size: int
+    :param offset: offset in the uncompressed data to start reading at
+    :type offset: int
+    :param incomplete: also return a last line without newline at the end
+                       of the file, unless it is blank
+    :type incomplete: bool
+    :returns: generator of bytes
+    """
+    text_file = open_data_file(filename)
+    data_file = text_file.buffer
+    rest = b""
+
+    try:
+        if offset:
+            data_file.seek(offset)
+        while True:
+            chunk = data_file.read(chunk_size)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            end = chunk.rfind(b"\n") + 1
+            rest = chunk[end:]
+            if end:
+                yield chunk[:end]
+        if incomplete and rest.strip():
+            yield rest
+    finally:
+        text_file.close()
+
+
 class WrappedFile(object):
     """
     A file wrapper which keeps track of open files.
@@ -242,3 +303,38 @@ class WrappedFile(object):
         :returns: set of str
         """
         return WrappedFile.open_files
+
+
+def lazy_attributes(package, attributes):
+    """
+    Get module level '__getattr__' and '__dir__' functions for a package
+    which import attributes from their submodules on first access, see
+    PEP 562. Python versions without module '__getattr__' import all
+    attributes at once.
+
+    :param package: name of the package
+    :type package: str
+    :param attributes: submodule of each attribute, relative to the package
+    :type attributes: dict
+    :returns: tuple of functions
+    """
+    module = sys.modules[package]
+
+    def __getattr__(name):
+        try:
+            submodule = attributes[name]
+        except KeyError:
+            raise AttributeError("module '%s' has no attribute '%s'" %
+                                 (package, name))
+        value = getattr(importlib.import_module(submodule, package), name)
+        setattr(module, name, value)
+        return value
+
+    def __dir__():
+        return sorted(set(vars(module)) | set(attributes))
+
+    if sys.version_info < (3, 7):
+        for name in attributes:
+            __getattr__(name)
+
+    return __getattr__, __dir__
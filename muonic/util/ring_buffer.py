@@ -0,0 +1,189 @@
+"""
+Provides a preallocated circular buffer for time series like rates, which
+keeps the most recent rows and their minimum and maximum at constant cost
+per appended row.
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+from collections import deque
+import time
+
+import numpy as np
+
+
+class RingBuffer(object):
+    """
+    Circular buffer of rows with a fixed number of columns. Once the
+    buffer is full, appending a row drops the oldest one.
+
+    Every row is stored twice, 'capacity' rows apart, so the rows in
+    chronological order are always a contiguous view into the storage.
+    Minimum and maximum of each column are tracked with monotonic queues.
+
+    Raises ValueError if the capacity is not positive.
+
+    :param capacity: maximum number of rows
+    :type capacity: int
+    :param columns: number of columns
+    :type columns: int
+    :param dtype: data type of the values
+    :type dtype: numpy.dtype
+    :raises: ValueError
+    """
+
+    def __init__(self, capacity, columns=1, dtype=float):
+        if capacity < 1:
+            raise ValueError("capacity has to be positive")
+
+        self.capacity = capacity
+        self.columns = columns
+        self._data = np.zeros((2 * capacity, columns), dtype=dtype)
+        self._start = 0
+        self._size = 0
+        # number of rows appended since the last clear
+        self._count = 0
+        self._minima = [deque() for _ in range(columns)]
+        self._maxima = [deque() for _ in range(columns)]
+
+    def __len__(self):
+        return self._size
+
+    def clear(self):
+        """
+        Remove all rows.
+
+        :returns: None
+        """
+        self._start = 0
+        self._size = 0
+        self._count = 0
+        for queue in self._minima + self._maxima:
+            queue.clear()
+
+    def append(self, row):
+        """
+        Append a row, dropping the oldest row if the buffer is full.
+
+        :param row: values of the columns
+        :type row: list or numpy.ndarray
+        :returns: None
+        """
+        end = (self._start + self._size) % self.capacity
+        self._data[end] = row
+        self._data[end + self.capacity] = row
+        values = self._data[end]
+
+        if self._size < self.capacity:
+            self._size += 1
+        else:
+            self._start = (self._start + 1) % self.capacity
+
+        index = self._count
+        self._count += 1
+        oldest = self._count - self._size
+
+        for column in range(self.columns):
+            value = values[column]
+            minima = self._minima[column]
+            maxima = self._maxima[column]
+
+            while minima and minima[-1][1] >= value:
+                minima.pop()
+            minima.append((index, value))
+            if minima[0][0] < oldest:
+                minima.popleft()
+
+            while maxima and maxima[-1][1] <= value:
+                maxima.pop()
+            maxima.append((index, value))
+            if maxima[0][0] < oldest:
+                maxima.popleft()
+
+    @property
+    def values(self):
+        """
+        The rows in chronological order. The array is a view, it changes
+        when rows are appended.
+
+        :returns: numpy.ndarray
+        """
+        return self._data[self._start:self._start + self._size]
+
+    def column(self, column):
+        """
+        The values of a column in chronological order.
+
+        :param column: index of the column
+        :type column: int
+        :returns: numpy.ndarray
+        """
+        return self.values[:, column]
+
+    @property
+    def last(self):
+        """
+        The most recent row.
+
+        Raises IndexError if the buffer is empty.
+
+        :returns: numpy.ndarray
+        :raises: IndexError
+        """
+        if not self._size:
+            raise IndexError("buffer is empty")
+        return self.values[-1]
+
+    def minimum(self, column=0):
+        """
+        The minimum of a column.
+
+        Raises IndexError if the buffer is empty.
+
+        :param column: index of the column
+        :type column: int
+        :returns: value
+        :raises: IndexError
+        """
+        if not self._size:
+            raise IndexError("buffer is empty")
+        return self._minima[column][0][1]
+
+    def maximum(self, column=0):
+        """
+        The maximum of a column.
+
+        Raises IndexError if the buffer is empty.
+
+        :param column: index of the column
+        :type column: int
+        :returns: value
+        :raises: IndexError
+        """
+        if not self._size:
+            raise IndexError("buffer is empty")
+        return self._maxima[column][0][1]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Append random rows to ring " +
+                                        "buffers of different capacity " +
+                                        "and report the cost per row")
+    parser.add_argument("-n", "--rows", dest="rows", type=int,
+                        default=100000, help="number of rows")
+    args = parser.parse_args()
+
+    rows = np.random.RandomState(0).exponential(10., (args.rows, 6))
+
+    for size in (40, 1000, 50000):
+        buf = RingBuffer(size, 6)
+        start = time.time()
+        for r in rows:
+            buf.append(r)
+            buf.maximum(0)
+            buf.values
+        elapsed = time.time() - start
+
+        assert buf.maximum(3) == buf.column(3).max()
+        assert buf.minimum(3) == buf.column(3).min()
+        print("capacity %6d: %.1f us per row" %
+              (size, 1e6 * elapsed / args.rows))